@@ -1,6 +1,47 @@
-from diagnostics.autocorrelations import make_autocorrelation_plots
-from diagnostics.rhats import make_rhat_plots
-from diagnostics.traces import make_trace_plots
-from diagnostics.split_chains import make_split_posteriors
-from diagnostics.sampler_metadata import SamplerMetadata
-from diagnostics.step_acceptance import print_step_acceptance
\ No newline at end of file
+import importlib
+
+# Public names of the package and the modules they come from. The modules are
+# only imported when one of their names is first used (PEP 562), so that e.g.
+# diagnose_mcmc --summary-only never imports matplotlib.
+EXPORTS = {
+  "autocorrelations": ["make_autocorrelation_plots", "AutocorrelationAccumulator"],
+  "rhats": ["make_rhat_plots", "plot_rhat_matrix", "write_rhat_matrix", "RHAT_THRESHOLDS"],
+  "convergence": ["ConvergenceAccumulator", "get_convergence_summary"],
+  "traces": ["make_trace_plots", "TraceAccumulator"],
+  "split_chains": ["make_split_posteriors", "SplitPosteriorAccumulator"],
+  "sampler_metadata": ["SamplerMetadata", "SAMPLER_TREES"],
+  "manifest": ["Manifest", "load_manifest", "check_manifest", "MANIFEST_FILE"],
+  "step_acceptance": ["print_step_acceptance", "print_acceptance_details", "write_acceptance_windows", "StepAcceptanceAccumulator"],
+  "chain_loader": ["ChainAccumulator", "get_branches", "get_keys", "get_ranges", "run_accumulators", "DEFAULT_CHUNK_ENTRIES"],
+  "chain_cache": ["ChainCache", "DEFAULT_CACHE_DIR"],
+  "effective_samples": ["report_effective_samples", "get_effective_sample_sizes", "get_recommended_thinning", "load_recommendations", "RECOMMENDATIONS_FILE"],
+  "burn_in": ["BurnInScanAccumulator", "print_burn_in_scan", "scan_burn_in"],
+  "chain_merger": ["merge_chains", "iterate_merged_chunks"],
+  "chain_writers": ["COMPRESSIONS", "DEFAULT_COMPRESSIONS", "WRITERS", "EXTENSIONS"],
+  "plot_pages": ["render_pdf", "get_flagged_keys", "select_pages", "PLOT_SELECTIONS"],
+  "synthetic_chains": ["generate_chains", "expected_properties", "load_truth", "SAMPLER_LAYOUTS", "TRUTH_FILE"],
+  "benchmarks": ["run_benchmark", "check_truth", "compare_to_baseline", "load_benchmark_results", "save_benchmark_results", "BENCHMARKS", "BASELINE_FILE"],
+  "profiling": ["enable_profiling", "get_profile", "profile_stage", "print_profile", "save_profile"],
+  "moments": ["MomentsAccumulator"],
+  "quantiles": ["QuantileAccumulator", "KLLSketch", "print_quantiles", "write_quantiles", "CREDIBLE_MASSES"],
+  "covariance": ["CovarianceAccumulator", "print_correlations", "write_covariance", "plot_correlations"],
+  "mcse": ["MCSEAccumulator", "print_mcse", "write_mcse", "get_enough_steps", "MCSE_THRESHOLD"],
+  "quick_look": ["quick_look", "print_quick_look", "QUICK_SEGMENTS", "QUICK_MAX_LAG"],
+  "summary": ["make_summary", "write_summary", "SUMMARY_COLUMNS"],
+  "shards": ["parse_shard", "get_shard_files", "prepare_shard", "save_state", "load_state", "reduce_states", "STATE_VERSION"],
+  "watch": ["ChainWatcher", "load_watcher", "save_watcher", "print_watch_status", "WATCH_STATE_FILE"],
+}
+
+MODULES = {name: module for module, names in EXPORTS.items() for name in names}
+
+__all__ = list(MODULES)
+
+def __getattr__(name):
+  if name not in MODULES:
+    raise AttributeError(f"module 'diagnostics' has no attribute '{name}'")
+  value = getattr(importlib.import_module(f"diagnostics.{MODULES[name]}"), name)
+  globals()[name] = value
+  return value
+
+def __dir__():
+  return sorted(list(globals()) + __all__)
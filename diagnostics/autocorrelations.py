@@ -1,134 +1,241 @@
-import uproot
-
 import numpy as np
 
-from tqdm import tqdm
-
 from colorama import Fore, Back
 
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-
-def autocorr_fft_padded(x, lags):
-    n=len(x)
-    # pad 0s to 2n-1
-    ext_size=2*n-1
-    # nearest power of 2
-    fsize=2**np.ceil(np.log2(ext_size)).astype('int')
-
-    # subtract mean and calculate variance
-    xp=x-np.mean(x)
-    var=np.var(x)
-
-    # do fft and ifft
-    cf=np.fft.fft(xp,fsize)
-    sf=cf.conjugate()*cf
-    corr=np.fft.ifft(sf).real
-    corr=corr/var/n
-
-    return corr[:len(lags)]
+from .chain_loader import ChainAccumulator, get_keys, run_accumulators
+from .plot_pages import PageRenderer, new_figure, render_pdf
+from .profiling import profile_stage
 
 def autocorr_naive(x, lags):
+  # One lag at a time, the reference the batched versions are tested against
   mean = x.mean()
-  var= np.sum((x - mean)**2)
+  var = np.sum((x - mean)**2)
 
   autocors = []
   for lag in lags:
     lhs = (x[:len(x) - lag] - mean)
     rhs = (x[lag:] - mean)
     autocors.append(np.sum(lhs * rhs) / var)
-  
-  return np.asarray(autocors)
 
-def plot_autocorrelation(autocorrelation, key, pdf):
-
-  plt.plot(autocorrelation)
-  
-  plt.title(f"Autocorrelations per chain for {key}")
-
-  plt.axhline(0, color='black', linestyle='--')
-  plt.xlabel("Lag")
-  plt.ylabel("Autocorrelation")
-
-  plt.tight_layout()
-  pdf.savefig()
-  plt.close()
-
-def plot_all_autocorrelations_one_plot(autocorrelations, branch_keywords, pdf):
-  first_systematic = True
-  for [key, autocorrelation] in autocorrelations.items():
-    interesting = False
-    for oscpar in branch_keywords:
-      if oscpar in key:
-        interesting = True
-        break
-    if interesting:
-      newkey = key
-      if newkey.startswith("_"):
-        newkey = newkey[1:]
-
-      plt.plot(autocorrelation, label=f"{newkey}")
-    else:
-      if first_systematic:
-        plt.plot(autocorrelation, label="systematic", color="black", linewidth=0.1)
-        first_systematic = False
-      else:
-        plt.plot(autocorrelation, color="black", linewidth=0.1)
+  return np.asarray(autocors)
 
-  plt.title("Autocorrelation per parameter")
-  plt.axhline(0, color='black', linestyle='--')
-  plt.xlabel("Lag")
-  plt.ylabel("Autocorrelation")
-  plt.legend()
-  #plt.tight_layout()
-  pdf.savefig()
-  plt.close()
+def next_fast_len(n):
+  # Smallest 5-smooth number (2^a * 3^b * 5^c) not below n. FFTs of these
+  # lengths are fast, and they are much closer to n than the next power of 2.
+  best = 2**int(np.ceil(np.log2(n)))
+  p5 = 1
+  while p5 < best:
+    p35 = p5
+    while p35 < best:
+      p = p35
+      while p < n:
+        p *= 2
+      best = min(best, p)
+      p35 *= 3
+    p5 *= 5
+  return best
+
+def autocorr_direct_batched(x, max_lag):
+  # x has shape (n_parameters, n_steps)
+  n = x.shape[1]
+  xp = x - x.mean(axis=1, keepdims=True)
+  var = np.einsum("ij,ij->i", xp, xp)
+
+  corr = np.empty((x.shape[0], max_lag))
+  for lag in range(max_lag):
+    corr[:, lag] = np.einsum("ij,ij->i", xp[:, :n - lag], xp[:, lag:])
+  return corr / var[:, None]
+
+def autocorr_rfft_batched(x, max_lag):
+  # x has shape (n_parameters, n_steps). Only the first max_lag lags are kept,
+  # so padding to n + max_lag - 1 is enough to avoid the circular wrap-around.
+  n = x.shape[1]
+  fsize = next_fast_len(n + max_lag - 1)
+
+  xp = x - x.mean(axis=1, keepdims=True)
+  var = np.var(x, axis=1)
+
+  cf = np.fft.rfft(xp, fsize, axis=1)
+  corr = np.fft.irfft(cf.real**2 + cf.imag**2, fsize, axis=1)[:, :max_lag]
+  return corr / var[:, None] / n
+
+def use_direct_sum(n, max_lag):
+  # The direct sum costs ~max_lag passes over the chain, the FFT ~log2(fsize)
+  fsize = next_fast_len(n + max_lag - 1)
+  return max_lag <= 2 * np.log2(fsize)
+
+def lagged_products(x, max_lag):
+  """
+  Sums of x[:, t] * x[:, t + lag] over t, for every lag below max_lag and x of
+  shape (n_parameters, n_steps). Unlike the autocorrelations, nothing is
+  subtracted or normalised, so the sums of consecutive pieces of a chain can
+  be added up.
+  """
+  n = x.shape[1]
+  products = np.zeros((x.shape[0], max_lag))
+  if n == 0:
+    return products
+
+  if use_direct_sum(n, max_lag):
+    for lag in range(min(max_lag, n)):
+      products[:, lag] = np.einsum("ij,ij->i", x[:, :n - lag], x[:, lag:])
+    return products
+
+  fsize = next_fast_len(n + max_lag - 1)
+  cf = np.fft.rfft(x, fsize, axis=1)
+  corr = np.fft.irfft(cf.real**2 + cf.imag**2, fsize, axis=1)
+  products[:, :min(max_lag, n)] = corr[:, :min(max_lag, n)]
+  return products
+
+def lagged_covariances(n, sums, products, head, tail):
+  """
+  Sums of (x[t] - mean) * (x[t + lag] - mean) over t for every lag below
+  max_lag, from the running sums of a chain of n samples: the sum of the
+  samples, their lagged_products, and its first and last max_lag samples.
+  """
+  max_lag = products.shape[1]
+  lags = np.arange(max_lag)
+  mean = sums / n
+  # Sums of the first and of the last `lag` samples
+  head_sums = np.concatenate([np.zeros((len(sums), 1)), np.cumsum(head, axis=1)], axis=1)[:, :max_lag]
+  tail_sums = np.concatenate([np.zeros((len(sums), 1)), np.cumsum(tail[:, ::-1], axis=1)], axis=1)[:, :max_lag]
+  return products - mean[:, None] * (2 * sums[:, None] - head_sums - tail_sums) + (n - lags[None, :]) * mean[:, None]**2
+
+def autocorr_batched(columns, keys, max_lag, block_size=32, method="auto"):
+  """
+  Autocorrelations of all the keys of one chain, up to max_lag.
+
+  The parameters are stacked into blocks of block_size rows, so that the peak
+  memory is bounded by the block rather than by the number of parameters.
+  method is "fft", "direct" or "auto", which picks the direct sum for small
+  max_lag.
+  """
+  n = len(columns[keys[0]])
+  if method == "auto":
+    method = "direct" if use_direct_sum(n, max_lag) else "fft"
+  autocorr = autocorr_direct_batched if method == "direct" else autocorr_rfft_batched
 
-def get_autocorrelations(metadata, max_lag=100, burn_in=0):
   autocorrelations = {}
-
-  if burn_in == 0:
-    print(Back.RED + "Warning: burn-in is 0, this may lead to incorrect autocorrelation results" + Back.RESET)
-
-  # Get the key names
-  with uproot.open(metadata.files[0]) as f:
-      example_chain = f[metadata.ttree_location]
-      keys = [key for key in example_chain.keys() if key not in metadata.ignored_branches]
-
-  # Initialise the autocorrelations
-  for key in keys:
-    autocorrelations[key] = np.zeros(max_lag)
-
-  # Iterate over the files
-  for filename in tqdm(metadata.files, desc="Getting autocorrelations"):
-    chain = uproot.open(filename)[metadata.ttree_location]
-
-    if max_lag > chain.num_entries - burn_in:
-        raise ValueError(f"Max lag ({max_lag}) is larger than the number of"\
-                         f"(MCMC steps - burn-in) ({chain.num_entries - burn_in}) in file"\
-                         f" {filename}. Please reduce max_lag, or provide larger chains.")
-
-    # Add the autocorrelations to the total for each key
-    for key in keys:
-      data = np.asarray(chain[key].array()[burn_in:])
-      autocorrelations[key] += autocorr_fft_padded(data, range(max_lag))
-  
-  # Average over the chains
-  for key in autocorrelations:
-    autocorrelations[key] /= len(metadata.files)
-  
+  for start in range(0, len(keys), block_size):
+    block_keys = keys[start:start + block_size]
+    block = np.stack([np.asarray(columns[key], dtype=np.float64) for key in block_keys])
+    with profile_stage(f"autocorrelation {method}"):
+      for key, corr in zip(block_keys, autocorr(block, max_lag)):
+        autocorrelations[key] = corr
   return autocorrelations
 
-def make_autocorrelation_plots(metadata, max_lag=100, burn_in=0, output_file="autocorrelations.pdf"):
-  autocorrelations = get_autocorrelations(metadata, max_lag, burn_in)
+class AutocorrelationRenderer(PageRenderer):
+  def setup(self):
+    self.figure = new_figure()
+    self.axes = self.figure.add_subplot()
+    self.line, = self.axes.plot([], [])
+    self.axes.axhline(0, color='black', linestyle='--')
+    self.axes.set_xlabel("Lag")
+    self.axes.set_ylabel("Autocorrelation")
+
+  def draw(self, key):
+    autocorrelation = self.data[key]
+    self.line.set_data(np.arange(len(autocorrelation)), autocorrelation)
+    self.axes.relim()
+    self.axes.autoscale_view()
+    self.axes.set_title(f"Autocorrelations per chain for {key}")
+
+class AutocorrelationSummaryRenderer(PageRenderer):
+  # A single page with the autocorrelations of all the parameters
+  tight_layout = False
+
+  def __init__(self, autocorrelations, branch_keywords):
+    super().__init__({"summary": autocorrelations})
+    self.branch_keywords = branch_keywords
+
+  def setup(self):
+    self.figure = new_figure()
+    self.axes = self.figure.add_subplot()
+
+  def draw(self, key):
+    first_systematic = True
+    for [key, autocorrelation] in self.data[key].items():
+      interesting = False
+      for oscpar in self.branch_keywords:
+        if oscpar in key:
+          interesting = True
+          break
+      if interesting:
+        newkey = key
+        if newkey.startswith("_"):
+          newkey = newkey[1:]
+
+        self.axes.plot(autocorrelation, label=f"{newkey}")
+      else:
+        if first_systematic:
+          self.axes.plot(autocorrelation, label="systematic", color="black", linewidth=0.1)
+          first_systematic = False
+        else:
+          self.axes.plot(autocorrelation, color="black", linewidth=0.1)
+
+    self.axes.set_title("Autocorrelation per parameter")
+    self.axes.axhline(0, color='black', linestyle='--')
+    self.axes.set_xlabel("Lag")
+    self.axes.set_ylabel("Autocorrelation")
+    self.axes.legend()
+
+class AutocorrelationAccumulator(ChainAccumulator):
+  def __init__(self, metadata, keys, max_lag=100, burn_in=0, block_size=32):
+    if burn_in == 0:
+      print(Back.RED + "Warning: burn-in is 0, this may lead to incorrect autocorrelation results" + Back.RESET)
+
+    self.branches = keys
+    self.burn_in = burn_in
+    self.max_lag = max_lag
+    self.block_size = block_size
+    self.metadata = metadata
+
+    self.reset()
+
+  def reset(self):
+    # Initialise the autocorrelations
+    self.autocorrelations = {key: np.zeros(self.max_lag) for key in self.branches}
+    self.n_chains = 0
+    self.n_draws = 0
+
+  def fill(self, file_idx, columns):
+    n_entries = len(columns[self.branches[0]])
+    if self.max_lag > n_entries:
+        raise ValueError(f"Max lag ({self.max_lag}) is larger than the number of"\
+                         f"(MCMC steps - burn-in) ({n_entries}) in file"\
+                         f" {self.metadata.files[file_idx]}. Please reduce max_lag, or provide larger chains.")
 
-  with open(output_file, "wb") as f:
-    pdf = PdfPages(f)
-    # Plot all autocorrelations in one plot
-    plot_all_autocorrelations_one_plot(autocorrelations, metadata.key_branches, pdf)
+    # Add the autocorrelations to the total for each key
+    autocorrelations = autocorr_batched(columns, self.branches, self.max_lag, self.block_size)
+    for key in self.branches:
+      self.autocorrelations[key] += autocorrelations[key]
+    self.n_chains += 1
+    self.n_draws += n_entries
+
+  def merge(self, other):
+    for key in self.branches:
+      self.autocorrelations[key] += other.autocorrelations[key]
+    self.n_chains += other.n_chains
+    self.n_draws += other.n_draws
+
+  def result(self):
+    # Average over the chains
+    return {key: autocorrelation / self.n_chains for key, autocorrelation in self.autocorrelations.items()}
 
-    # Plot each autocorrelation separately
-    for key in autocorrelations:
-      plot_autocorrelation(autocorrelations[key], key, pdf)
-    pdf.close()
-    print(f"Autocorrelations saved to {output_file}")
+def get_autocorrelations(metadata, max_lag=100, burn_in=0):
+  accumulator = AutocorrelationAccumulator(metadata, get_keys(metadata), max_lag, burn_in)
+  run_accumulators(metadata, [accumulator], desc="Getting autocorrelations")
+  return accumulator.result()
+
+def make_autocorrelation_plots(metadata, max_lag=100, burn_in=0, output_file="autocorrelations.pdf", autocorrelations=None, keys=None, jobs=1):
+  # One page with all the autocorrelations, then a page per parameter in keys
+  # (all of them by default)
+  if autocorrelations is None:
+    autocorrelations = get_autocorrelations(metadata, max_lag, burn_in)
+  if keys is None:
+    keys = list(autocorrelations)
+
+  renderers = [AutocorrelationSummaryRenderer(autocorrelations, metadata.key_branches),
+               AutocorrelationRenderer({key: autocorrelations[key] for key in keys})]
+  render_pdf(output_file, renderers, jobs, desc="Generating autocorrelation plots")
+  print(f"Autocorrelations saved to {output_file}")
@@ -0,0 +1,189 @@
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import uproot
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .autocorrelations import AutocorrelationAccumulator
+from .burn_in import BurnInScanAccumulator
+from .chain_loader import get_keys, run_accumulators
+from .chain_merger import merge_chains
+from .convergence import ConvergenceAccumulator
+from .effective_samples import get_effective_sample_sizes
+from .sampler_metadata import SamplerMetadata
+from .split_chains import SplitPosteriorAccumulator
+from .step_acceptance import StepAcceptanceAccumulator
+from .traces import TraceAccumulator
+
+BASELINE_FILE = "benchmark_baseline.json"
+
+# Result metrics that have an analytic value in the truth file of the
+# synthetic chains
+TRUTH_METRICS = {
+  "acceptance": "acceptance",
+  "tau_mean": "tau",
+  "ess_mean": "ess",
+  "rhat_mean": "rhat",
+}
+
+def bench_step_acceptance(metadata, keys, options):
+  accumulator = StepAcceptanceAccumulator(metadata, keys, options["burn_in"])
+  run_accumulators(metadata, [accumulator], jobs=options["jobs"])
+  return {"acceptance": accumulator.result()[0]}
+
+def bench_traces(metadata, keys, options):
+  accumulator = TraceAccumulator(metadata, keys)
+  run_accumulators(metadata, [accumulator], jobs=options["jobs"])
+  return {"entries": int(accumulator.counts.sum())}
+
+def bench_autocorrelations(metadata, keys, options):
+  accumulator = AutocorrelationAccumulator(metadata, keys, options["max_lag"], options["burn_in"])
+  run_accumulators(metadata, [accumulator], jobs=options["jobs"])
+  effective = get_effective_sample_sizes(accumulator.result(), accumulator.n_draws)
+  return {"tau_mean": float(np.mean([values["tau"] for values in effective.values()])),
+          "ess_mean": float(np.mean([values["ess"] for values in effective.values()]))}
+
+def bench_rhats(metadata, keys, options):
+  accumulator = ConvergenceAccumulator(metadata, keys, options["burn_in"])
+  run_accumulators(metadata, [accumulator], jobs=options["jobs"])
+  summary = accumulator.result()
+  return {"rhat_mean": float(np.mean([values["rhat_bulk"] for values in summary.values()])),
+          "ess_bulk_mean": float(np.mean([values["ess_bulk"] for values in summary.values()]))}
+
+def bench_split_posterior(metadata, keys, options):
+  accumulator = SplitPosteriorAccumulator(metadata, keys, 100, options["burn_in"])
+  run_accumulators(metadata, [accumulator], jobs=options["jobs"])
+  return {"entries": float(sum(np.sum(histograms["full"]) for histograms in accumulator.histograms.values()))}
+
+def bench_scan_burn_in(metadata, keys, options):
+  accumulator = BurnInScanAccumulator(metadata, keys)
+  run_accumulators(metadata, [accumulator], jobs=options["jobs"])
+  burn_in = accumulator.recommended_burn_in(accumulator.result())
+  return {"burn_in": -1 if burn_in is None else burn_in}
+
+def bench_all(metadata, keys, options):
+  # All the diagnostics of diagnose_mcmc --all in a single pass
+  accumulators = [StepAcceptanceAccumulator(metadata, keys, options["burn_in"]),
+                  TraceAccumulator(metadata, keys),
+                  ConvergenceAccumulator(metadata, keys, options["burn_in"]),
+                  AutocorrelationAccumulator(metadata, keys, options["max_lag"], options["burn_in"]),
+                  SplitPosteriorAccumulator(metadata, keys, 100, options["burn_in"])]
+  run_accumulators(metadata, accumulators, jobs=options["jobs"])
+  for accumulator in accumulators[2:4]:
+    accumulator.result()
+  return {}
+
+def bench_merge_chains(metadata, keys, options):
+  with tempfile.TemporaryDirectory() as directory:
+    output_file = os.path.join(directory, "merged_chain.root")
+    merge_chains(metadata, keys, output_file, burn_in=options["burn_in"])
+    with uproot.open(output_file) as f:
+      return {"entries": f[metadata.ttree_location].num_entries}
+
+BENCHMARKS = {
+  "step_acceptance": bench_step_acceptance,
+  "traces": bench_traces,
+  "autocorrelations": bench_autocorrelations,
+  "rhats": bench_rhats,
+  "split_posterior": bench_split_posterior,
+  "scan_burn_in": bench_scan_burn_in,
+  "all": bench_all,
+  "merge_chains": bench_merge_chains,
+}
+
+def read_io():
+  # Bytes read by this process and its finished children (Linux only).
+  # rchar counts every read, read_bytes only the ones that reached the disk.
+  try:
+    with open("/proc/self/io") as f:
+      return {name: int(value) for name, value in (line.split(":") for line in f)}
+  except OSError:
+    return {}
+
+def peak_rss():
+  # ru_maxrss is in kB on Linux
+  own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  return max(own, children) * 1024
+
+def measure(name, files, options):
+  """
+  Runs one benchmark, in a fresh process so that the peak RSS is its own.
+  uproot reads the files with plain reads rather than memory mapping them, so
+  that the bytes read show up in /proc/self/io.
+  """
+  uproot.reading.open.defaults["handler"] = uproot.source.file.MultithreadedFileSource
+
+  metadata = SamplerMetadata(files)
+  keys = get_keys(metadata)
+
+  rss_before = peak_rss()
+  io_before = read_io()
+  start = time.perf_counter()
+  result = BENCHMARKS[name](metadata, keys, options)
+  wall_time = time.perf_counter() - start
+  io_after = read_io()
+
+  return {"wall_time": wall_time,
+          "peak_rss": peak_rss(),
+          "rss_before": rss_before,
+          "bytes_read": io_after.get("rchar", 0) - io_before.get("rchar", 0),
+          "disk_bytes_read": io_after.get("read_bytes", 0) - io_before.get("read_bytes", 0),
+          "result": result}
+
+def run_benchmark(name, files, options, repeat=1):
+  # The fastest of the repeats
+  context = multiprocessing.get_context("spawn")
+  runs = []
+  for _ in range(repeat):
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+      runs.append(executor.submit(measure, name, files, options).result())
+  return min(runs, key=lambda run: run["wall_time"])
+
+def check_truth(measurement, truth):
+  # Relative difference of the results to their analytic values
+  return {metric: float(measurement["result"][metric] / truth[key] - 1)
+          for metric, key in TRUTH_METRICS.items() if metric in measurement["result"]}
+
+def compare_to_baseline(results, baseline, tolerance=0.2, rtol=1e-6):
+  """
+  Compares two sets of benchmark results. Time, peak RSS and bytes read
+  more than `tolerance` above the baseline are regressions, as are results
+  that changed by more than rtol. Returns rows of (configuration, benchmark,
+  quantity, baseline, current, regression).
+  """
+  rows = []
+  for label, config in results.items():
+    # Only the same chains with the same options can be compared
+    if label not in baseline or baseline[label]["options"] != config["options"]:
+      continue
+    for name, measurement in config["benchmarks"].items():
+      reference = baseline[label]["benchmarks"].get(name)
+      if reference is None:
+        continue
+
+      for quantity in ["wall_time", "peak_rss", "bytes_read"]:
+        regression = measurement[quantity] > (1 + tolerance) * reference[quantity] and measurement[quantity] > 0
+        rows.append((label, name, quantity, reference[quantity], measurement[quantity], regression))
+
+      for metric, value in measurement["result"].items():
+        old = reference["result"].get(metric)
+        changed = old is None or not np.isclose(value, old, rtol=rtol, atol=0)
+        rows.append((label, name, metric, old, value, changed))
+  return rows
+
+def load_benchmark_results(path=BASELINE_FILE):
+  with open(path) as f:
+    return json.load(f)
+
+def save_benchmark_results(results, path=BASELINE_FILE):
+  with open(path, "w") as f:
+    json.dump(results, f, indent=2)
+  print(f"Benchmark results saved to {path}")
@@ -0,0 +1,42 @@
+import numpy as np
+
+from .profiling import profile_stage
+
+# Maximum number of samples binned at once, bounds the memory of the index
+# arrays
+MAX_BLOCK_ELEMENTS = 2**24
+
+def bin_indices(data, low, high, n_bins):
+  """
+  Indices of uniform bins between low and high for data of shape
+  (n_parameters, n_samples), with low and high per parameter. Like np.histogram
+  the last bin includes high. Samples outside the range (or NaN) get -1.
+  """
+  low = np.asarray(low, dtype=np.float64)[:, None]
+  high = np.asarray(high, dtype=np.float64)[:, None]
+
+  with profile_stage("bin indices"):
+    indices = ((data - low) * (n_bins / (high - low))).astype(np.int64)
+    np.minimum(indices, n_bins - 1, out=indices)
+    indices[~((data >= low) & (data <= high))] = -1
+  return indices
+
+def bin_traces(data, low, high, xbins, ybins, length, start=0):
+  """
+  Trace heatmaps of all the parameters at once, for data of shape
+  (n_parameters, n_steps) starting at iteration `start`. The iteration axis has
+  xbins bins from 0 to length, the value axis ybins bins from low to high (per
+  parameter). Everything is filled with a single bincount on the flattened
+  (parameter, xbin, ybin) index. Returns the counts with shape
+  (n_parameters, xbins, ybins).
+  """
+  n_parameters, n_steps = data.shape
+  n_steps = max(0, min(n_steps, length - start))
+
+  xindices = ((start + np.arange(n_steps)) * xbins) // length
+  yindices = bin_indices(data[:, :n_steps], low, high, ybins)
+
+  with profile_stage("bin traces"):
+    flat = (np.arange(n_parameters)[:, None] * xbins + xindices[None, :]) * ybins + yindices
+    flat = flat[yindices >= 0]
+    return np.bincount(flat, minlength=n_parameters * xbins * ybins).reshape(n_parameters, xbins, ybins)
@@ -0,0 +1,181 @@
+import csv
+
+import numpy as np
+
+from colorama import Fore, Back
+
+from .chain_loader import ChainAccumulator, get_keys, get_important_keys, run_accumulators
+from .effective_samples import save_recommendations, RECOMMENDATIONS_FILE
+
+# Geweke windows: the first 10% and the last 50% of the post-burn-in chain
+GEWEKE_FIRST = 0.1
+GEWEKE_LAST = 0.5
+
+def prefix_sums(x):
+  # Centre the chain first, so that the sums of squares don't lose precision.
+  # The centre is returned, means from the sums are relative to it.
+  x = np.asarray(x, dtype=np.float64)
+  centre = np.mean(x)
+  x = x - centre
+  s1 = np.zeros(len(x) + 1)
+  s2 = np.zeros(len(x) + 1)
+  np.cumsum(x, out=s1[1:])
+  np.cumsum(x * x, out=s2[1:])
+  return s1, s2, centre
+
+def window_mean_and_error(s1, start, stop, n_batches):
+  # Mean of x[start:stop] and the variance of that mean from batch means, for
+  # arrays of windows. Batch means account for the autocorrelation, and only
+  # need the prefix sums at the batch edges.
+  edges = start[:, None] + ((stop - start)[:, None] * np.arange(n_batches + 1)[None, :]) // n_batches
+  batch_means = np.diff(s1[edges], axis=1) / np.diff(edges, axis=1)
+  mean = (s1[stop] - s1[start]) / (stop - start)
+  return mean, np.var(batch_means, axis=1, ddof=1) / n_batches
+
+def geweke_z_scores(s1, candidates, n_batches=10):
+  n = len(s1) - 1
+  length = n - candidates
+  first_stop = candidates + (length * GEWEKE_FIRST).astype(int)
+  last_start = n - (length * GEWEKE_LAST).astype(int)
+
+  mean_first, var_first = window_mean_and_error(s1, candidates, first_stop, n_batches)
+  mean_last, var_last = window_mean_and_error(s1, last_start, np.full_like(candidates, n), n_batches)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    return (mean_first - mean_last) / np.sqrt(var_first + var_last)
+
+def split_half_moments(s1, s2, candidates):
+  # Mean and variance of the two halves of x[candidate:] for every candidate
+  n = len(s1) - 1
+  half = (n - candidates) // 2
+  starts = np.stack([candidates, n - half], axis=1)
+  stops = starts + half[:, None]
+
+  means = (s1[stops] - s1[starts]) / half[:, None]
+  variances = (s2[stops] - s2[starts] - half[:, None] * means**2) / (half[:, None] - 1)
+  return means, variances, half
+
+def chi2_quantile(p_z, dof):
+  # Wilson-Hilferty approximation, p_z is the normal quantile of the level
+  return dof * (1 - 2 / (9 * dof) + p_z * np.sqrt(2 / (9 * dof)))**3
+
+class BurnInScanAccumulator(ChainAccumulator):
+  """
+  Scores many candidate burn-ins in a single pass over each chain. The prefix
+  sums of the chain (and of its squares) are calculated once, after which the
+  Geweke z-score and the split-Rhat moments of any candidate cost O(1).
+  """
+
+  def __init__(self, metadata, keys, n_candidates=40, n_batches=10):
+    self.branches = get_important_keys(metadata, keys) or keys
+    self.burn_in = 0
+    self.n_candidates = n_candidates
+    self.n_batches = n_batches
+    self.candidates = None
+    self.reset()
+
+  def reset(self):
+    self.z_scores = {key: [] for key in self.branches}
+    self.half_means = {key: [] for key in self.branches}
+    self.half_vars = {key: [] for key in self.branches}
+    self.half_lengths = []
+
+  def set_candidates(self, n):
+    # Candidates between 0 and half of a chain of n steps
+    self.candidates = np.unique(np.linspace(0, n // 2, self.n_candidates, endpoint=False).astype(int))
+
+  def fill(self, file_idx, columns):
+    n = len(columns[self.branches[0]])
+
+    # The first file defines the candidates
+    if self.candidates is None:
+      self.set_candidates(n)
+    candidates = self.candidates[self.candidates < n // 2]
+    if len(candidates) < len(self.candidates):
+      raise ValueError(f"Chain {file_idx} has only {n} steps, fewer than twice the largest burn-in candidate ({self.candidates[-1]})")
+
+    for key in self.branches:
+      s1, s2, centre = prefix_sums(columns[key])
+      self.z_scores[key].append(geweke_z_scores(s1, candidates, self.n_batches))
+      means, variances, half = split_half_moments(s1, s2, candidates)
+      self.half_means[key].append(means + centre)
+      self.half_vars[key].append(variances)
+    self.half_lengths.append(half)
+
+  def merge(self, other):
+    for key in self.branches:
+      self.z_scores[key] += other.z_scores[key]
+      self.half_means[key] += other.half_means[key]
+      self.half_vars[key] += other.half_vars[key]
+    self.half_lengths += other.half_lengths
+
+  def result(self, rhat_threshold=1.01, p_z=2.326):
+    """
+    Split-Rhat over all the half-chains and the Geweke chi-square (sum of the
+    z-scores squared over the chains) for every key branch and candidate. A
+    branch passes if the split-Rhat is below the threshold and the z-scores are
+    consistent with a standard normal at the level given by p_z (1% by
+    default).
+    """
+    n = np.mean(self.half_lengths, axis=0)
+    n_chains = len(self.half_lengths)
+    chi2_threshold = chi2_quantile(p_z, n_chains)
+
+    scan = {}
+    for key in self.branches:
+      # Shape (candidates, 2 * chains)
+      means = np.concatenate(self.half_means[key], axis=1)
+      variances = np.concatenate(self.half_vars[key], axis=1)
+
+      W = np.mean(variances, axis=1)
+      B = n * np.var(means, axis=1, ddof=1)
+      with np.errstate(divide="ignore", invalid="ignore"):
+        rhat = np.sqrt(((n - 1) / n * W + B / n) / W)
+
+      chi2 = np.sum(np.stack(self.z_scores[key])**2, axis=0)
+      scan[key] = {"rhat": rhat,
+                   "geweke_chi2": chi2,
+                   "passed": (rhat < rhat_threshold) & (chi2 < chi2_threshold)}
+    return scan
+
+  def recommended_burn_in(self, scan):
+    passed = np.all([values["passed"] for values in scan.values()], axis=0)
+    if not np.any(passed):
+      return None
+    return int(self.candidates[np.argmax(passed)])
+
+def write_burn_in_scan(candidates, scan, output_file="burn_in_scan.csv"):
+  with open(output_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["burn_in"] + [f"{key}_{column}" for key in scan for column in ["rhat", "geweke_chi2", "passed"]])
+    for i, candidate in enumerate(candidates):
+      writer.writerow([candidate] + [values[column][i] for values in scan.values() for column in ["rhat", "geweke_chi2", "passed"]])
+  print(f"Burn-in scan saved to {output_file}")
+
+def print_burn_in_scan(metadata, accumulator, output_file="burn_in_scan.csv", recommendations_file=RECOMMENDATIONS_FILE):
+  scan = accumulator.result()
+  candidates = accumulator.candidates
+
+  print(f"Burn-in scan over {len(candidates)} candidates for chains from {metadata.sampler_name} sampler:")
+  for i, candidate in enumerate(candidates):
+    failed = [key for key, values in scan.items() if not values["passed"][i]]
+    max_rhat = np.max([values["rhat"][i] for values in scan.values()])
+    foreground = Fore.GREEN if not failed else Fore.RED
+    print(f"  - {candidate:>10}: max split-Rhat = {max_rhat:.4f}, {foreground}{len(failed)} key branches failing{Fore.RESET}")
+
+  write_burn_in_scan(candidates, scan, output_file)
+
+  burn_in = accumulator.recommended_burn_in(scan)
+  if burn_in is None:
+    print(Back.RED + "Warning: no candidate burn-in passes for all the key branches, the chains need more steps!" + Back.RESET)
+    return None
+
+  print(Back.GREEN + f"Smallest burn-in where all the key branches pass: {burn_in}" + Back.RESET)
+  # Under its own key, so that the --burn-in of other diagnostics can't replace it
+  save_recommendations(recommendations_file, sampler_name=metadata.sampler_name, n_files=len(metadata.files),
+                       recommended_burn_in=burn_in)
+  return burn_in
+
+def scan_burn_in(metadata, n_candidates=40):
+  accumulator = BurnInScanAccumulator(metadata, get_keys(metadata), n_candidates)
+  run_accumulators(metadata, [accumulator], desc="Scanning burn-in candidates")
+  return print_burn_in_scan(metadata, accumulator)
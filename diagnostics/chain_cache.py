@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = ".mcmc_cache"
+
+class ChainCache:
+  """
+  On-disk cache of decompressed chains, one .npy file per branch.
+
+  Each chain file gets its own entry directory keyed by the path, size and
+  modification time of the file, so a chain that is rewritten is read again.
+  Cached branches are opened with np.load(mmap_mode="r"), so slicing them
+  (e.g. [burn_in:]) does not copy. Once the cache grows beyond `max_bytes` the
+  least recently used entries are removed.
+  """
+
+  def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=100 * 1024**3):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+
+  def entry_path(self, filename, ttree_location):
+    stat = os.stat(filename)
+    identity = f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}:{ttree_location}"
+    return os.path.join(self.directory, hashlib.sha1(identity.encode()).hexdigest())
+
+  def branch_path(self, entry, branch):
+    # Branch names are not always valid file names (e.g. "delta(pi)")
+    return os.path.join(entry, hashlib.sha1(branch.encode()).hexdigest()[:16] + ".npy")
+
+  def load(self, filename, ttree_location, branches):
+    """
+    Return a dictionary with the cached branches, memory-mapped. Branches that
+    are not in the cache are left out.
+    """
+    entry = self.entry_path(filename, ttree_location)
+    if not os.path.isdir(entry):
+      return {}
+
+    columns = {}
+    for branch in branches:
+      path = self.branch_path(entry, branch)
+      if os.path.exists(path):
+        columns[branch] = np.load(path, mmap_mode="r")
+
+    # Mark the entry as recently used
+    os.utime(entry)
+    return columns
+
+  def store(self, filename, ttree_location, columns):
+    entry = self.entry_path(filename, ttree_location)
+    os.makedirs(entry, exist_ok=True)
+
+    index_path = os.path.join(entry, "index.json")
+    index = {"file": os.path.abspath(filename), "ttree_location": ttree_location, "branches": {}}
+    if os.path.exists(index_path):
+      with open(index_path) as f:
+        index = json.load(f)
+
+    for branch, data in columns.items():
+      path = self.branch_path(entry, branch)
+      # Write to a temporary file first, so that a concurrent reader never sees
+      # a partially written array
+      tmp_path = f"{path}.{os.getpid()}.tmp"
+      with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(data))
+      os.replace(tmp_path, path)
+      index["branches"][branch] = os.path.basename(path)
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+  def size(self, entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+  def evict(self):
+    entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+    entries = [entry for entry in entries if os.path.isdir(entry)]
+
+    # Oldest first
+    entries.sort(key=os.path.getmtime)
+    sizes = [self.size(entry) for entry in entries]
+    total = sum(sizes)
+
+    for entry, size in zip(entries, sizes):
+      if total <= self.max_bytes:
+        break
+      shutil.rmtree(entry, ignore_errors=True)
+      total -= size
@@ -0,0 +1,318 @@
+import copy
+import time
+import uproot
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+from .profiling import enable_profiling, get_profile, profile_stage
+
+# Entries per chunk when all the accumulators can be filled chunk by chunk
+DEFAULT_CHUNK_ENTRIES = 1_000_000
+
+def get_num_entries(filename, metadata):
+  # From the manifest when there is one, without opening the file
+  manifest = getattr(metadata, "manifest", None)
+  if manifest is not None and filename in manifest.entries:
+    return manifest.entries[filename]
+  with uproot.open(filename) as f:
+    return f[metadata.ttree_location].num_entries
+
+def get_branches(metadata):
+  # All the branches, from the manifest or the first file
+  manifest = getattr(metadata, "manifest", None)
+  if manifest is not None:
+    return list(manifest.branches)
+  with uproot.open(metadata.files[0]) as f:
+    return list(f[metadata.ttree_location].keys())
+
+def get_keys(metadata):
+  # Non-ignored branches
+  return [key for key in get_branches(metadata) if key not in metadata.ignored_branches]
+
+def get_important_keys(metadata, keys):
+  return [key for key in keys if any(samplerkey in key for samplerkey in metadata.key_branches)]
+
+class ChainAccumulator:
+  """
+  Base class for a diagnostic fed by the chain loader.
+
+  Subclasses set `branches` (the branches they need) and `burn_in` (the first
+  entry they want to see), and implement `fill`, which is called once per file
+  with a dictionary of numpy arrays already sliced to start at `burn_in`.
+
+  The accumulated state lives in whatever `reset` creates, and `merge` adds the
+  state of another accumulator (filled with later files) to this one. Anything
+  fixed by the first file, like histogram ranges, is not part of that state.
+
+  Accumulators with `needs_ranges` get the global minimum and maximum of their
+  branches (after their burn-in) through `set_ranges` before the first `fill`.
+
+  `streaming` accumulators can also be filled with consecutive chunks of a
+  file: every `fill` continues the chain of `file_idx` where the previous one
+  stopped.
+  """
+
+  branches = []
+  burn_in = 0
+  needs_ranges = False
+  streaming = False
+
+  def reset(self):
+    raise NotImplementedError
+
+  def fill(self, file_idx, columns):
+    raise NotImplementedError
+
+  def merge(self, other):
+    raise NotImplementedError
+
+  def set_ranges(self, ranges):
+    pass
+
+  def empty_copy(self):
+    other = copy.copy(self)
+    other.reset()
+    return other
+
+class RangeAccumulator(ChainAccumulator):
+  """
+  Global minimum and maximum of every branch, and the longest chain.
+  """
+
+  def __init__(self, branches, burn_in=0):
+    self.branches = branches
+    self.burn_in = burn_in
+    self.reset()
+
+  def reset(self):
+    self.minima = {branch: np.inf for branch in self.branches}
+    self.maxima = {branch: -np.inf for branch in self.branches}
+    self.max_entries = 0
+
+  def fill(self, file_idx, columns):
+    for branch in self.branches:
+      self.minima[branch] = min(self.minima[branch], np.nanmin(columns[branch]))
+      self.maxima[branch] = max(self.maxima[branch], np.nanmax(columns[branch]))
+    self.max_entries = max(self.max_entries, len(columns[self.branches[0]]))
+
+  def merge(self, other):
+    for branch in self.branches:
+      self.minima[branch] = min(self.minima[branch], other.minima[branch])
+      self.maxima[branch] = max(self.maxima[branch], other.maxima[branch])
+    self.max_entries = max(self.max_entries, other.max_entries)
+
+  def get_range(self, branch, absolute=False):
+    low, high = self.minima[branch], self.maxima[branch]
+    if absolute:
+      low, high = (0.0 if low < 0 < high else min(abs(low), abs(high))), max(abs(low), abs(high))
+    # Constant branches still need a non-empty range to bin in
+    if high <= low:
+      high = low + 1.0
+    return low, high
+
+def get_needed_branches(accumulators):
+  branches = []
+  for accumulator in accumulators:
+    for branch in accumulator.branches:
+      if branch not in branches:
+        branches.append(branch)
+  return branches
+
+def read_chain(filename, metadata, branches, entry_start=0, cache=None):
+  if cache is None:
+    return read_root_chain(filename, metadata, branches, entry_start)
+
+  # The cache holds whole branches, so anything missing is read from the start
+  # of the chain. The cached arrays are memory-mapped, so slicing off the
+  # entries before entry_start does not copy anything.
+  with profile_stage("read cache"):
+    columns = cache.load(filename, metadata.ttree_location, branches)
+  missing = [branch for branch in branches if branch not in columns]
+  if missing:
+    new_columns = read_root_chain(filename, metadata, missing)
+    cache.store(filename, metadata.ttree_location, new_columns)
+    columns.update(new_columns)
+
+  return {branch: columns[branch][entry_start:] for branch in branches}
+
+def read_root_chain(filename, metadata, branches, entry_start=0, entry_stop=None):
+  # Bulk read of all the needed branches in one go, rather than one
+  # decompression per branch. Branch names are matched exactly, as some of them
+  # (e.g. Aria's "delta(pi)") are not valid uproot expressions.
+  wanted = set(branches)
+  with profile_stage("read root"), uproot.open(filename) as f:
+    chain = f[metadata.ttree_location]
+    if get_profile() is not None:
+      return read_root_branches_profiled(chain, branches, entry_start, entry_stop)
+    return chain.arrays(filter_name=lambda name: name in wanted,
+                        entry_start=entry_start,
+                        entry_stop=entry_stop,
+                        library="np")
+
+def read_root_branches_profiled(chain, branches, entry_start=0, entry_stop=None):
+  # When profiling, the branches are read one at a time to get the time,
+  # baskets and bytes of each of them
+  profile = get_profile()
+  columns = {}
+  for branch in branches:
+    start = time.perf_counter()
+    columns[branch] = chain[branch].array(entry_start=entry_start, entry_stop=entry_stop, library="np")
+    profile.add_branch_read(chain[branch], entry_start, chain.num_entries if entry_stop is None else entry_stop,
+                            time.perf_counter() - start, columns[branch].nbytes)
+  return columns
+
+def iterate_chain(filename, metadata, branches, entry_start=0, chunk_entries=None, cache=None):
+  """
+  Yields (first entry, columns) for chunks of at most chunk_entries entries of
+  a chain, or for the whole chain if chunk_entries is None.
+  """
+  if chunk_entries is None:
+    yield entry_start, read_chain(filename, metadata, branches, entry_start, cache)
+    return
+
+  if cache is not None:
+    # Memory-mapped, the chunks are read as they are sliced
+    columns = read_chain(filename, metadata, branches, entry_start, cache)
+    n_entries = len(columns[branches[0]])
+    for start in range(0, n_entries, chunk_entries):
+      yield entry_start + start, {branch: columns[branch][start:start + chunk_entries] for branch in branches}
+    return
+
+  wanted = set(branches)
+  with uproot.open(filename) as f:
+    chunks = f[metadata.ttree_location].iterate(filter_name=lambda name: name in wanted,
+                                                entry_start=entry_start,
+                                                step_size=chunk_entries,
+                                                library="np",
+                                                report=True)
+    while True:
+      with profile_stage("read root"):
+        chunk = next(chunks, None)
+      if chunk is None:
+        return
+      columns, report = chunk
+      yield report.tree_entry_start, columns
+
+def fill_accumulators(file_idx, columns, accumulators, entry_start=0):
+  # columns start at entry_start, the entries before the burn-in of each
+  # accumulator are sliced off
+  for accumulator in accumulators:
+    offset = max(0, accumulator.burn_in - entry_start)
+    with profile_stage(f"fill {type(accumulator).__name__}"):
+      accumulator.fill(file_idx, {branch: columns[branch][offset:] for branch in accumulator.branches})
+
+def fill_file(file_idx, metadata, branches, entry_start, accumulators, chunk_entries=None, cache=None):
+  for chunk_start, columns in iterate_chain(metadata.files[file_idx], metadata, branches, entry_start, chunk_entries, cache):
+    fill_accumulators(file_idx, columns, accumulators, chunk_start)
+
+def process_file(file_idx, metadata, branches, entry_start, accumulators, chunk_entries=None, cache=None, profiling=None):
+  # Fill empty copies of the accumulators with a single file. Runs in the
+  # worker processes, so it only returns the (small) partial results. When
+  # profiling (set to whether allocations are tracked), the profile records of
+  # this file are returned too.
+  if profiling is not None:
+    enable_profiling(profiling)
+  partials = [accumulator.empty_copy() for accumulator in accumulators]
+  fill_file(file_idx, metadata, branches, entry_start, partials, chunk_entries, cache)
+  return partials, get_profile().to_dict() if profiling is not None else None
+
+def run_accumulators(metadata, accumulators, desc="Reading MCMC chains", jobs=1, cache=None, chunk_entries=None,
+                     file_indices=None, ranges=None):
+  """
+  Read every file once and feed the columns to all the accumulators.
+
+  If any accumulator needs the global ranges of its branches, a cheaper
+  min/max pass over just those branches comes first (free with the cache).
+
+  With jobs > 1 the files are spread over a process pool. The first file is
+  still read here, so that ranges fixed by it are shared with the workers, and
+  the partial results are merged back in file order so that the result is the
+  same as the serial one.
+
+  With a ChainCache, the branches are read from (and added to) the cache
+  instead of decompressing the ROOT files on every run.
+
+  With chunk_entries, the files are read in chunks of that many entries if
+  all the accumulators are streaming, which bounds the memory whatever the
+  length of the chains.
+
+  file_indices restricts the pass to some of the files of the metadata (e.g.
+  a shard), and ranges (as returned by get_ranges) replaces the min/max pass.
+  """
+  accumulators = list(accumulators)
+  if not all(accumulator.streaming for accumulator in accumulators):
+    chunk_entries = None
+  fill_ranges(metadata, accumulators, jobs, cache, file_indices, ranges)
+  return run_pass(metadata, accumulators, desc, jobs, cache, chunk_entries, file_indices)
+
+def get_ranges(metadata, accumulators, jobs=1, cache=None, file_indices=None):
+  # One range accumulator per burn-in, as the ranges depend on it
+  needing = {}
+  for accumulator in accumulators:
+    if accumulator.needs_ranges:
+      needing.setdefault(accumulator.burn_in, []).append(accumulator)
+  if not needing:
+    return {}
+
+  ranges = {burn_in: RangeAccumulator(get_needed_branches(accs), burn_in) for burn_in, accs in needing.items()}
+  run_pass(metadata, ranges.values(), "Finding the ranges of the chains", jobs, cache, file_indices=file_indices)
+  return ranges
+
+def fill_ranges(metadata, accumulators, jobs=1, cache=None, file_indices=None, ranges=None):
+  if ranges is None:
+    ranges = get_ranges(metadata, accumulators, jobs, cache, file_indices)
+  for accumulator in accumulators:
+    if accumulator.needs_ranges:
+      if accumulator.burn_in not in ranges or not set(accumulator.branches) <= set(ranges[accumulator.burn_in].branches):
+        raise ValueError(f"No ranges for the branches of {type(accumulator).__name__} with a burn-in of {accumulator.burn_in}")
+      accumulator.set_ranges(ranges[accumulator.burn_in])
+
+def run_pass(metadata, accumulators, desc, jobs=1, cache=None, chunk_entries=None, file_indices=None):
+  accumulators = list(accumulators)
+  branches = get_needed_branches(accumulators)
+  if file_indices is None:
+    file_indices = range(len(metadata.files))
+  file_indices = list(file_indices)
+
+  # Nothing before the earliest burn-in is needed by anyone
+  entry_start = min(accumulator.burn_in for accumulator in accumulators)
+
+  if jobs <= 1 or len(file_indices) <= 1:
+    for file_idx in tqdm(file_indices, desc=desc):
+      fill_file(file_idx, metadata, branches, entry_start, accumulators, chunk_entries, cache)
+    if cache is not None:
+      cache.evict()
+    return accumulators
+
+  with tqdm(total=len(file_indices), desc=desc) as progress:
+    fill_file(file_indices[0], metadata, branches, entry_start, accumulators, chunk_entries, cache)
+    progress.update()
+
+    # Only the empty accumulators (with the ranges fixed) go to the workers
+    prototypes = [accumulator.empty_copy() for accumulator in accumulators]
+    n_rest = len(file_indices) - 1
+    profile = get_profile()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      results = executor.map(process_file,
+                             file_indices[1:],
+                             [metadata] * n_rest,
+                             [branches] * n_rest,
+                             [entry_start] * n_rest,
+                             [prototypes] * n_rest,
+                             [chunk_entries] * n_rest,
+                             [cache] * n_rest,
+                             [profile.track_allocations if profile is not None else None] * n_rest)
+      for partials, records in results:
+        with profile_stage("merge partial results"):
+          for accumulator, partial in zip(accumulators, partials):
+            accumulator.merge(partial)
+        if records is not None:
+          profile.merge(records)
+        progress.update()
+
+  if cache is not None:
+    cache.evict()
+  return accumulators
@@ -0,0 +1,100 @@
+import uproot
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from .chain_loader import get_num_entries
+from .chain_writers import WRITERS
+
+def get_entry_range(num_entries, burn_in=0, max_steps=None):
+  # Same meaning as chain[burn_in:max_steps]
+  entry_stop = num_entries if max_steps is None else min(num_entries, max_steps)
+  entry_start = min(burn_in, entry_stop)
+  return entry_start, entry_stop
+
+def get_merged_entries(metadata, burn_in=0, thin=1, max_steps=None):
+  # Number of entries in the merged chain, known before reading any data
+  n_entries = 0
+  for filename in metadata.files:
+    entry_start, entry_stop = get_entry_range(get_num_entries(filename, metadata), burn_in, max_steps)
+    n_entries += max(0, -(-(entry_stop - entry_start) // thin))
+  return n_entries
+
+def get_branch_types(metadata, keys):
+  # Keep the source dtypes. Branches that are not plain numbers are stored as
+  # doubles, as before.
+  manifest = getattr(metadata, "manifest", None)
+  if manifest is not None:
+    return {key: np.dtype(manifest.dtypes[key] or np.float64) for key in keys}
+  with uproot.open(metadata.files[0]) as f:
+    chain = f[metadata.ttree_location]
+    types = {}
+    for key in keys:
+      to_dtype = getattr(chain[key].interpretation, "to_dtype", None)
+      types[key] = np.dtype(to_dtype) if to_dtype is not None and to_dtype.shape == () else np.dtype(np.float64)
+    return types
+
+def iterate_merged_chunks(metadata, keys, burn_in=0, thin=1, max_steps=None,
+                          step_size="100 MB", basket_size=100_000, n_threads=4):
+  """
+  Stream the merged chains as dictionaries of numpy arrays with basket_size
+  entries each (the last one can be shorter).
+
+  Only the entries between burn_in and max_steps of each file are read, and
+  the thinning is applied with respect to the start of that range, so it does
+  not restart with every chunk read from the file. Decompression runs on a
+  thread pool with n_threads threads.
+  """
+  types = get_branch_types(metadata, keys)
+  wanted = set(keys)
+
+  buffer = {key: [] for key in keys}
+  n_buffered = 0
+
+  with ThreadPoolExecutor(max_workers=n_threads) as executor:
+    for filename in tqdm(metadata.files, desc="Merging chains"):
+      with uproot.open(filename) as f:
+        chain = f[metadata.ttree_location]
+        entry_start, entry_stop = get_entry_range(chain.num_entries, burn_in, max_steps)
+        if entry_stop <= entry_start:
+          continue
+
+        for arrays, report in chain.iterate(filter_name=lambda name: name in wanted,
+                                            entry_start=entry_start,
+                                            entry_stop=entry_stop,
+                                            step_size=step_size,
+                                            decompression_executor=executor,
+                                            library="np",
+                                            report=True):
+          # First entry of this chunk that is on the thinning grid
+          phase = (-(report.tree_entry_start - entry_start)) % thin
+          for key in keys:
+            buffer[key].append(np.asarray(arrays[key][phase::thin], dtype=types[key]))
+          n_buffered += len(buffer[keys[0]][-1])
+
+          if n_buffered >= basket_size:
+            data = {key: np.concatenate(values) for key, values in buffer.items()}
+            n_baskets = n_buffered // basket_size
+            for i in range(n_baskets):
+              yield {key: values[i * basket_size:(i + 1) * basket_size] for key, values in data.items()}
+            buffer = {key: [values[n_baskets * basket_size:]] for key, values in data.items()}
+            n_buffered -= n_baskets * basket_size
+
+  if n_buffered > 0:
+    yield {key: np.concatenate(values) for key, values in buffer.items()}
+
+def merge_chains(metadata, keys, output_file, burn_in=0, thin=1, max_steps=None,
+                 compression="zlib", compression_level=1, basket_size=100_000,
+                 step_size="100 MB", n_threads=4, output_format="root"):
+  # Every chunk is written as one basket (or row group, record batch, ...)
+  types = get_branch_types(metadata, keys)
+  n_entries = get_merged_entries(metadata, burn_in, thin, max_steps)
+  writer = WRITERS[output_format](output_file, metadata.ttree_location, types, n_entries,
+                                  compression, compression_level, basket_size)
+  try:
+    for arrays in iterate_merged_chunks(metadata, keys, burn_in, thin, max_steps, step_size, basket_size, n_threads):
+      writer.write(arrays)
+  finally:
+    writer.close()
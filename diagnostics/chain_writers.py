@@ -0,0 +1,178 @@
+import json
+import os
+
+import uproot
+
+import numpy as np
+
+# Writers for the merged chains. Each one is fed the chunks of
+# iterate_merged_chunks in order, and writes every chunk as one basket, row
+# group or record batch. The optional formats import their library only when
+# used.
+
+COMPRESSIONS = {
+  "zlib": uproot.ZLIB,
+  "lz4": uproot.LZ4,
+  "zstd": uproot.ZSTD,
+  "lzma": uproot.LZMA,
+  "none": None,
+}
+
+def get_compression(name="zlib", level=1):
+  if COMPRESSIONS[name] is None:
+    return None
+  return COMPRESSIONS[name](level)
+
+def missing_dependency(package, output_format):
+  return ImportError(f"Writing the {output_format} format needs {package}, please install it (pip install {package})")
+
+class RootWriter:
+  def __init__(self, output_file, ttree_location, types, n_entries, compression="zlib", compression_level=1, basket_size=100_000):
+    self.ttree_location = ttree_location
+    self.file = uproot.recreate(output_file, compression=get_compression(compression, compression_level))
+    self.file.mktree(ttree_location, types)
+
+  def write(self, arrays):
+    self.file[self.ttree_location].extend(arrays)
+
+  def close(self):
+    self.file.close()
+
+class ParquetWriter:
+  CODECS = {"zlib": "gzip", "lz4": "lz4", "zstd": "zstd", "none": "none"}
+
+  def __init__(self, output_file, ttree_location, types, n_entries, compression="zlib", compression_level=1, basket_size=100_000):
+    try:
+      import pyarrow as pa
+      import pyarrow.parquet as pq
+    except ImportError:
+      raise missing_dependency("pyarrow", "parquet")
+    if compression not in self.CODECS:
+      raise ValueError(f"Compression {compression} is not supported by parquet, use one of {list(self.CODECS)}")
+
+    self.pa = pa
+    self.schema = pa.schema([(key, pa.from_numpy_dtype(dtype)) for key, dtype in types.items()])
+    self.writer = pq.ParquetWriter(output_file, self.schema,
+                                   compression=self.CODECS[compression],
+                                   compression_level=compression_level if compression not in ["none", "lz4"] else None)
+
+  def write(self, arrays):
+    table = self.pa.Table.from_pydict(arrays, schema=self.schema)
+    self.writer.write_table(table, row_group_size=table.num_rows)
+
+  def close(self):
+    self.writer.close()
+
+class ArrowWriter:
+  # Arrow IPC file. Without compression it can be memory-mapped with
+  # pyarrow.memory_map and read without any copy.
+  CODECS = {"lz4": "lz4", "zstd": "zstd", "none": None}
+
+  def __init__(self, output_file, ttree_location, types, n_entries, compression="none", compression_level=1, basket_size=100_000):
+    try:
+      import pyarrow as pa
+    except ImportError:
+      raise missing_dependency("pyarrow", "arrow")
+    if compression not in self.CODECS:
+      raise ValueError(f"Compression {compression} is not supported by arrow, use one of {list(self.CODECS)}")
+
+    self.pa = pa
+    self.schema = pa.schema([(key, pa.from_numpy_dtype(dtype)) for key, dtype in types.items()])
+    self.sink = pa.OSFile(output_file, "wb")
+    options = pa.ipc.IpcWriteOptions(compression=self.CODECS[compression])
+    self.writer = pa.ipc.new_file(self.sink, self.schema, options=options)
+
+  def write(self, arrays):
+    self.writer.write_batch(self.pa.RecordBatch.from_pydict(arrays, schema=self.schema))
+
+  def close(self):
+    self.writer.close()
+    self.sink.close()
+
+class HDF5Writer:
+  # One dataset per branch in a group named after the tree, chunked like the
+  # merge chunks
+  CODECS = {"zlib": "gzip", "none": None}
+
+  def __init__(self, output_file, ttree_location, types, n_entries, compression="zlib", compression_level=1, basket_size=100_000):
+    try:
+      import h5py
+    except ImportError:
+      raise missing_dependency("h5py", "hdf5")
+    if compression not in self.CODECS:
+      raise ValueError(f"Compression {compression} is not supported by hdf5, use one of {list(self.CODECS)}")
+
+    self.file = h5py.File(output_file, "w")
+    group = self.file.require_group(ttree_location)
+    chunks = (max(1, min(basket_size, n_entries)),) if n_entries > 0 else None
+    options = {}
+    if self.CODECS[compression] is not None:
+      options = {"compression": self.CODECS[compression], "compression_opts": compression_level}
+    self.datasets = {key: group.create_dataset(key.replace("/", "_"), shape=(n_entries,), dtype=dtype, chunks=chunks, **options)
+                     for key, dtype in types.items()}
+    self.position = 0
+
+  def write(self, arrays):
+    n = len(next(iter(arrays.values())))
+    for key, data in arrays.items():
+      self.datasets[key][self.position:self.position + n] = data
+    self.position += n
+
+  def close(self):
+    self.file.close()
+
+class NumpyWriter:
+  """
+  A directory with one contiguous .npy array per branch, which can be opened
+  with np.load(mmap_mode="r"). index.json maps the branch names to the files.
+  """
+
+  def __init__(self, output_file, ttree_location, types, n_entries, compression="none", compression_level=1, basket_size=100_000):
+    if compression != "none":
+      print(f"The npy format is not compressed, ignoring compression {compression}")
+
+    os.makedirs(output_file, exist_ok=True)
+    index = {key: key.replace("/", "_") + ".npy" for key in types}
+    with open(os.path.join(output_file, "index.json"), "w") as f:
+      json.dump({"ttree_location": ttree_location, "n_entries": n_entries, "branches": index}, f, indent=2)
+
+    self.arrays = {key: np.lib.format.open_memmap(os.path.join(output_file, index[key]), mode="w+", dtype=dtype, shape=(n_entries,))
+                   for key, dtype in types.items()}
+    self.position = 0
+
+  def write(self, arrays):
+    n = len(next(iter(arrays.values())))
+    for key, data in arrays.items():
+      self.arrays[key][self.position:self.position + n] = data
+    self.position += n
+
+  def close(self):
+    for array in self.arrays.values():
+      array.flush()
+    self.arrays = {}
+
+WRITERS = {
+  "root": RootWriter,
+  "parquet": ParquetWriter,
+  "arrow": ArrowWriter,
+  "hdf5": HDF5Writer,
+  "npy": NumpyWriter,
+}
+
+# Default output names for each format
+EXTENSIONS = {
+  "root": ".root",
+  "parquet": ".parquet",
+  "arrow": ".arrow",
+  "hdf5": ".h5",
+  "npy": "",
+}
+
+# Compression used when none is given
+DEFAULT_COMPRESSIONS = {
+  "root": "zlib",
+  "parquet": "zstd",
+  "arrow": "none",
+  "hdf5": "zlib",
+  "npy": "none",
+}
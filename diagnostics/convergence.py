@@ -0,0 +1,265 @@
+import atexit
+import csv
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from colorama import Back
+
+from .autocorrelations import next_fast_len
+from .chain_loader import ChainAccumulator, get_keys, get_num_entries, run_accumulators
+from .profiling import profile_stage
+
+# Vehtari et al. (2021), "Rank-normalization, folding, and localization: An
+# improved R-hat for assessing convergence of MCMC". Everything here works on
+# arrays of shape (..., n_chains, n_draws), vectorised over the leading axes.
+
+# Maximum number of array elements per block of parameters. Bounds the memory
+# used by the sorting and the FFTs.
+MAX_BLOCK_ELEMENTS = 2**24
+
+def inverse_normal_cdf(p):
+  # Acklam's rational approximation, relative error below 1.2e-9
+  a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+       1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+  b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+       6.680131188771972e+01, -1.328068155288572e+01]
+  c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+       -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+  d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+       3.754408661907416e+00]
+  p_low = 0.02425
+
+  p = np.asarray(p, dtype=np.float64)
+  z = np.empty_like(p)
+
+  # Tails
+  tail = np.minimum(p, 1 - p)
+  lower = tail < p_low
+  q = np.sqrt(-2 * np.log(tail[lower]))
+  z_tail = (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / \
+           ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1)
+  z[lower] = np.where(p[lower] < 0.5, z_tail, -z_tail)
+
+  # Central region
+  q = p[~lower] - 0.5
+  r = q * q
+  z[~lower] = (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5])*q / \
+              (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1)
+  return z
+
+def average_ranks(x):
+  # Ranks (starting at 1) along the last axis, with ties getting the average
+  # rank. MCMC chains have lots of ties from the rejected steps.
+  order = np.argsort(x, axis=-1, kind="stable")
+  sorted_x = np.take_along_axis(x, order, axis=-1)
+  n = x.shape[-1]
+  idx = np.broadcast_to(np.arange(n), x.shape)
+
+  new_group = np.ones(x.shape, dtype=bool)
+  new_group[..., 1:] = sorted_x[..., 1:] != sorted_x[..., :-1]
+  last_of_group = np.ones(x.shape, dtype=bool)
+  last_of_group[..., :-1] = new_group[..., 1:]
+
+  group_start = np.maximum.accumulate(np.where(new_group, idx, 0), axis=-1)
+  group_end = np.minimum.accumulate(np.where(last_of_group, idx, n - 1)[..., ::-1], axis=-1)[..., ::-1]
+
+  ranks = np.empty(x.shape)
+  np.put_along_axis(ranks, order, (group_start + group_end) / 2 + 1, axis=-1)
+  return ranks
+
+def rank_normalize(x):
+  # Pool the chains of each parameter, rank, and map onto a normal
+  shape = x.shape
+  pooled = x.reshape(shape[:-2] + (-1,))
+  s = pooled.shape[-1]
+  return inverse_normal_cdf((average_ranks(pooled) - 3 / 8) / (s + 1 / 4)).reshape(shape)
+
+def split_chains(x):
+  half = x.shape[-1] // 2
+  return np.concatenate([x[..., :half], x[..., x.shape[-1] - half:]], axis=-2)
+
+def rhat(x):
+  # Classic potential scale reduction factor
+  n = x.shape[-1]
+  chain_means = np.mean(x, axis=-1)
+  W = np.mean(np.var(x, axis=-1, ddof=1), axis=-1)
+  B = n * np.var(chain_means, axis=-1, ddof=1)
+  var = (n - 1) / n * W + B / n
+  with np.errstate(divide="ignore", invalid="ignore"):
+    return np.sqrt(var / W)
+
+def autocovariance(x):
+  # Biased autocovariance along the last axis, for all the lags
+  n = x.shape[-1]
+  fsize = next_fast_len(2 * n - 1)
+  xp = x - x.mean(axis=-1, keepdims=True)
+  cf = np.fft.rfft(xp, fsize, axis=-1)
+  return np.fft.irfft(cf.real**2 + cf.imag**2, fsize, axis=-1)[..., :n] / n
+
+def geyer_tau(rho):
+  """
+  Integrated autocorrelation time from autocorrelations rho (lags along the
+  last axis), using Geyer's initial monotone sequence: sums of consecutive
+  pairs of lags are kept while they are positive, and forced to be
+  non-increasing.
+  """
+  n_pairs = rho.shape[-1] // 2
+  pairs = rho[..., 0:2 * n_pairs:2] + rho[..., 1:2 * n_pairs:2]
+  positive = np.logical_and.accumulate(pairs > 0, axis=-1)
+  pairs = np.minimum.accumulate(np.where(positive, pairs, 0), axis=-1)
+  return -1 + 2 * np.sum(pairs, axis=-1)
+
+def ess(x):
+  # Multi-chain effective sample size
+  m, n = x.shape[-2:]
+
+  # Loop over the chains, so that the FFT of a block of chains stays bounded
+  chains_per_block = max(1, MAX_BLOCK_ELEMENTS // max(1, int(np.prod(x.shape[:-2])) * 2 * n))
+  sum_acov = np.zeros(x.shape[:-2] + (n,))
+  for start in range(0, m, chains_per_block):
+    sum_acov += np.sum(autocovariance(x[..., start:start + chains_per_block, :]), axis=-2)
+  mean_acov = sum_acov / m
+
+  mean_var = mean_acov[..., 0] * n / (n - 1)
+  var_plus = mean_var * (n - 1) / n
+  if m > 1:
+    var_plus = var_plus + np.var(np.mean(x, axis=-1), axis=-1, ddof=1)
+
+  with np.errstate(divide="ignore", invalid="ignore"):
+    rho = 1 - (mean_var[..., None] - mean_acov) / var_plus[..., None]
+    rho[..., 0] = 1
+    tau = np.maximum(geyer_tau(rho), 1 / np.log10(m * n))
+    return m * n / tau
+
+def convergence_diagnostics(x):
+  """
+  Rank-normalised split-Rhat, folded split-Rhat and bulk/tail ESS for draws of
+  shape (..., n_chains, n_draws).
+  """
+  split = split_chains(x)
+  rhat_bulk = rhat(rank_normalize(split))
+
+  pooled = split.reshape(split.shape[:-2] + (-1,))
+  median = np.median(pooled, axis=-1)
+  folded = np.abs(split - median[..., None, None])
+  rhat_folded = rhat(rank_normalize(folded))
+
+  ess_bulk = ess(rank_normalize(split))
+
+  q05, q95 = np.quantile(x.reshape(x.shape[:-2] + (-1,)), [0.05, 0.95], axis=-1)
+  ess_tail = np.minimum(ess((split <= q05[..., None, None]).astype(np.float64)),
+                        ess((split <= q95[..., None, None]).astype(np.float64)))
+
+  return {"rhat": np.maximum(rhat_bulk, rhat_folded),
+          "rhat_bulk": rhat_bulk,
+          "rhat_folded": rhat_folded,
+          "ess_bulk": ess_bulk,
+          "ess_tail": ess_tail}
+
+def within_chain_rhats(x):
+  # Rank-normalised split-Rhat of each chain on its own, shape (..., n_chains)
+  return rhat(rank_normalize(split_chains(x[..., None, :])))
+
+class ConvergenceAccumulator(ChainAccumulator):
+  """
+  Spills the post-burn-in draws of every chain to an .npy file of shape
+  (n_parameters, n_draws) in `directory`, chunk by chunk, and computes the
+  rank-normalised diagnostics for blocks of parameters read back from them at
+  the end. Only the paths and lengths of the chains are kept in memory (and
+  sent back by the workers, or saved with a shard). Chains of different
+  lengths are cut to the shortest one.
+
+  Without a directory, the draws go to a temporary one that is removed when
+  the program exits.
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, burn_in, directory=None):
+    if burn_in == 0:
+      print(Back.RED + "Warning: burn-in is 0, this may lead to incorrect rhat results" + Back.RESET)
+
+    self.metadata = metadata
+    self.branches = keys
+    self.burn_in = burn_in
+    if directory is None:
+      directory = tempfile.mkdtemp(prefix="mcmc_draws_")
+      atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    self.directory = os.path.abspath(directory)
+    self.reset()
+
+  def reset(self):
+    # Path and number of draws written of every chain
+    self.chains = {}
+
+  def fill(self, file_idx, columns):
+    n_steps = len(columns[self.branches[0]])
+    if file_idx not in self.chains:
+      expected = max(0, get_num_entries(self.metadata.files[file_idx], self.metadata) - self.burn_in)
+      os.makedirs(self.directory, exist_ok=True)
+      path = os.path.join(self.directory, f"chain_{file_idx}.npy")
+      np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(len(self.branches), expected))
+      self.chains[file_idx] = (path, 0)
+    path, n = self.chains[file_idx]
+
+    draws = np.load(path, mmap_mode="r+")
+    n_steps = min(n_steps, draws.shape[1] - n)
+    for i, key in enumerate(self.branches):
+      draws[i, n:n + n_steps] = columns[key][:n_steps]
+    draws.flush()
+    self.chains[file_idx] = (path, n + n_steps)
+
+  def merge(self, other):
+    if set(self.chains) & set(other.chains):
+      raise ValueError("Can't merge the draws of the same chain")
+    self.chains.update(other.chains)
+
+  def result(self):
+    paths = [self.chains[file_idx][0] for file_idx in sorted(self.chains)]
+    n = min((n for _, n in self.chains.values()), default=0)
+    if n < 4:
+      return {}
+    block_size = max(1, MAX_BLOCK_ELEMENTS // (len(paths) * n))
+
+    summary = {}
+    for start in range(0, len(self.branches), block_size):
+      block_keys = self.branches[start:start + block_size]
+      # Mapped again for every block, so that the pages read don't pile up
+      x = np.stack([np.load(path, mmap_mode="r")[start:start + len(block_keys), :n] for path in paths], axis=1)
+
+      with profile_stage("convergence diagnostics"):
+        diagnostics = convergence_diagnostics(x)
+        within = within_chain_rhats(x)
+      for i, key in enumerate(block_keys):
+        summary[key] = {name: float(values[i]) for name, values in diagnostics.items()}
+        summary[key]["within_chain_rhats"] = within[i].tolist()
+    return summary
+
+def get_convergence_summary(metadata, burn_in):
+  accumulator = ConvergenceAccumulator(metadata, get_keys(metadata), burn_in)
+  run_accumulators(metadata, [accumulator], desc="Reading chains for Rhat and ESS")
+  return accumulator.result()
+
+def get_rhat_dicts(summary):
+  # The input of plot_rhat_matrix: the Rhat of all the chains together and the
+  # split-Rhat of every chain on its own
+  dict_rhat = {}
+  dict_within_chain_rhat = {}
+  for key, values in summary.items():
+    newkey = key
+    if newkey.startswith("_"):
+      newkey = newkey[1:]
+    dict_rhat[newkey] = values["rhat"]
+    dict_within_chain_rhat[newkey] = values["within_chain_rhats"]
+  return dict_rhat, dict_within_chain_rhat
+
+def write_convergence_summary(summary, output_file="convergence_summary.csv"):
+  columns = ["rhat", "rhat_bulk", "rhat_folded", "ess_bulk", "ess_tail"]
+  with open(output_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["parameter"] + columns)
+    for key, values in summary.items():
+      writer.writerow([key] + [values[column] for column in columns])
+  print(f"Convergence summary saved to {output_file}")
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+from .binning import MAX_BLOCK_ELEMENTS
+from .chain_loader import ChainAccumulator, get_important_keys
+from .plot_pages import new_figure, open_pdf
+
+def combine_comoments(a, b):
+  """
+  Combines (count, mean, C) of two sets of samples, where C is the matrix of
+  the sums of products of the deviations from the mean (Chan et al. 1979).
+  """
+  n_a, mean_a, comoments_a = a
+  n_b, mean_b, comoments_b = b
+  if n_a == 0:
+    return b
+  if n_b == 0:
+    return a
+
+  n = n_a + n_b
+  delta = mean_b - mean_a
+  mean = mean_a + delta * n_b / n
+  comoments = comoments_a + comoments_b + np.outer(delta, delta) * (n_a * n_b / n)
+  return n, mean, comoments
+
+class CovarianceAccumulator(ChainAccumulator):
+  """
+  Posterior covariance of all the parameters. Every block of samples is
+  centred on its own mean and its products summed with a single matrix
+  product, and the blocks (and chunks, files and processes) are combined with
+  combine_comoments. The memory is O(P^2) for P parameters, whatever the
+  length of the chains.
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, burn_in=0):
+    self.branches = keys
+    self.burn_in = burn_in
+    self.reset()
+
+  def reset(self):
+    n_parameters = len(self.branches)
+    self.comoments = (0, np.zeros(n_parameters), np.zeros((n_parameters, n_parameters)))
+
+  def fill(self, file_idx, columns):
+    n = len(columns[self.branches[0]])
+    # Blocks of rows, so that the copy of the columns stays small
+    block_size = max(1, MAX_BLOCK_ELEMENTS // len(self.branches))
+    for start in range(0, n, block_size):
+      data = np.stack([np.asarray(columns[key][start:start + block_size], dtype=np.float64) for key in self.branches], axis=1)
+      mean = np.mean(data, axis=0)
+      data -= mean
+      self.comoments = combine_comoments(self.comoments, (len(data), mean, data.T @ data))
+
+  def merge(self, other):
+    self.comoments = combine_comoments(self.comoments, other.comoments)
+
+  def result(self):
+    # Mean, covariance and correlation matrices
+    n, mean, comoments = self.comoments
+    covariance = comoments / (n - 1) if n > 1 else np.full_like(comoments, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      std = np.sqrt(np.diag(covariance))
+      correlation = covariance / np.outer(std, std)
+    return mean, covariance, correlation
+
+def print_correlations(keys, correlation, n_pairs=10):
+  # The most correlated pairs of different parameters
+  upper = np.triu_indices(len(keys), k=1)
+  values = correlation[upper]
+  order = np.argsort(-np.abs(np.nan_to_num(values)))[:n_pairs]
+  print(f"Strongest correlations of {len(keys)} parameters:")
+  for i in order:
+    print(f"  - {keys[upper[0][i]]} and {keys[upper[1][i]]}: {values[i]:+.3f}")
+
+def write_covariance(keys, covariance, correlation, output_file="covariance.npy"):
+  """
+  Saves the covariance matrix for proposal tuning. A .npy file holds the
+  matrix, with the parameter names one per line in <name>_parameters.txt. A
+  .root file gets "covariance" and "correlation" trees with a branch per
+  parameter and an entry per row.
+  """
+  if output_file.endswith(".root"):
+    import uproot
+
+    with uproot.recreate(output_file) as f:
+      f["covariance"] = {key: covariance[:, i] for i, key in enumerate(keys)}
+      f["correlation"] = {key: correlation[:, i] for i, key in enumerate(keys)}
+    print(f"Covariance saved to {output_file}")
+    return
+
+  np.save(output_file, covariance)
+  keys_file = os.path.splitext(output_file)[0] + "_parameters.txt"
+  with open(keys_file, "w") as f:
+    f.write("\n".join(keys) + "\n")
+  print(f"Covariance saved to {output_file} and {keys_file}")
+
+def plot_correlations(metadata, keys, correlation, output_file="correlations.pdf"):
+  # Correlation heatmap of the key parameters
+  important = get_important_keys(metadata, keys)
+  indices = [keys.index(key) for key in important]
+  matrix = correlation[np.ix_(indices, indices)]
+
+  figure = new_figure((10, 8))
+  axes = figure.add_subplot()
+  image = axes.imshow(matrix, cmap="RdBu_r", vmin=-1, vmax=1)
+  figure.colorbar(image, ax=axes, label="Correlation")
+  for i in range(len(indices)):
+    for j in range(len(indices)):
+      axes.text(j, i, f"{matrix[i, j]:.2f}", ha="center", va="center", fontsize=8)
+  axes.set_xticks(np.arange(len(important)))
+  axes.set_yticks(np.arange(len(important)))
+  axes.set_xticklabels(important, rotation=45, ha="right", fontsize=8)
+  axes.set_yticklabels(important, fontsize=8)
+  axes.set_title("Correlations of the key parameters")
+  figure.tight_layout()
+
+  with open_pdf(output_file) as pdf:
+    pdf.savefig(figure)
+  print(f"Correlations saved to {output_file}")
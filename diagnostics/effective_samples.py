@@ -0,0 +1,108 @@
+import json
+import os
+
+import numpy as np
+
+from colorama import Fore, Back
+
+from .autocorrelations import AutocorrelationAccumulator
+from .chain_loader import get_keys, get_important_keys, run_accumulators
+from .convergence import geyer_tau
+
+# Results of the diagnostics that merge_chains can pick up with "auto"
+RECOMMENDATIONS_FILE = "mcmc_recommendations.json"
+
+def get_effective_sample_sizes(autocorrelations, n_draws):
+  """
+  Integrated autocorrelation time and ESS per parameter, from the
+  chain-averaged autocorrelations (as returned by get_autocorrelations) and the
+  total number of post-burn-in draws over all chains.
+  """
+  keys = list(autocorrelations)
+  rho = np.stack([autocorrelations[key] for key in keys])
+
+  tau = np.maximum(geyer_tau(rho), 1.0)
+
+  # If the pairs of lags never turn negative before max_lag, the sum was cut
+  # short and tau is underestimated
+  n_pairs = rho.shape[-1] // 2
+  truncated = np.all(rho[:, 0:2 * n_pairs:2] + rho[:, 1:2 * n_pairs:2] > 0, axis=-1)
+
+  return {key: {"tau": float(tau[i]), "ess": float(n_draws / tau[i]), "truncated": bool(truncated[i])}
+          for i, key in enumerate(keys)}
+
+def recommend_thinning(metadata, effective):
+  # Thin by the shortest autocorrelation time of the key parameters, so that
+  # the kept steps are close to independent. This still costs that parameter
+  # about a quarter of its ESS (less for the slower ones). A truncated tau is
+  # only a lower bound, so there is no recommendation when the shortest one is
+  keys = get_important_keys(metadata, list(effective)) or list(effective)
+  shortest = min(keys, key=lambda key: effective[key]["tau"])
+  if effective[shortest]["truncated"]:
+    return None
+  return max(1, int(np.floor(effective[shortest]["tau"])))
+
+def print_effective_sample_sizes(metadata, effective, thin):
+  print(f"Effective sample sizes for chains from {metadata.sampler_name} sampler:")
+  for key, values in effective.items():
+    foreground = Fore.RED if values["truncated"] else Fore.GREEN
+    print(f"  - {key}: tau = {foreground}{values['tau']:.1f}{Fore.RESET}, ESS = {values['ess']:.0f}")
+
+  if any(values["truncated"] for values in effective.values()):
+    print(Back.RED + "Warning: autocorrelations still positive at max lag, increase --max-lag to get the full autocorrelation time" + Back.RESET)
+  if thin is None:
+    print(Back.RED + "Warning: the shortest autocorrelation time of the key parameters is truncated, no thinning factor recommended" + Back.RESET)
+  else:
+    print(f"Recommended thinning factor: {thin}")
+
+def load_recommendations(path=RECOMMENDATIONS_FILE):
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
+
+def save_recommendations(path=RECOMMENDATIONS_FILE, **values):
+  # Update rather than overwrite, other diagnostics may have added their own
+  recommendations = load_recommendations(path)
+  recommendations.update(values)
+  with open(path, "w") as f:
+    json.dump(recommendations, f, indent=2)
+  print(f"Recommendations saved to {path}")
+
+def report_effective_samples(metadata, autocorrelations, n_draws, burn_in, output_file=RECOMMENDATIONS_FILE):
+  effective = get_effective_sample_sizes(autocorrelations, n_draws)
+  thin = recommend_thinning(metadata, effective)
+  print_effective_sample_sizes(metadata, effective, thin)
+
+  # Without a recommendation the thinning is saved as null, so that an older
+  # factor isn't picked up by --thin auto
+  save_recommendations(output_file,
+                       sampler_name=metadata.sampler_name,
+                       n_files=len(metadata.files),
+                       thin=thin,
+                       thin_burn_in=burn_in,
+                       effective_sample_sizes=effective)
+  return effective, thin
+
+def get_recommended_thinning(metadata, burn_in, max_lag=None, recommendations_file=RECOMMENDATIONS_FILE):
+  """
+  The thinning factor for the chains: taken from the recommendations file if
+  it was made for the same chains and burn-in, calculated otherwise.
+  """
+  recommendations = load_recommendations(recommendations_file)
+  if recommendations.get("thin") is not None and recommendations.get("thin_burn_in") == burn_in \
+     and recommendations.get("n_files") == len(metadata.files) \
+     and recommendations.get("sampler_name") == metadata.sampler_name:
+    print(f"Using the thinning factor from {recommendations_file}")
+    return recommendations["thin"]
+
+  if max_lag is None:
+    max_lag = metadata.get_default_maxlag()
+
+  accumulator = AutocorrelationAccumulator(metadata, get_keys(metadata), max_lag, burn_in)
+  run_accumulators(metadata, [accumulator], desc="Getting autocorrelations")
+  _, thin = report_effective_samples(metadata, accumulator.result(), accumulator.n_draws, burn_in, recommendations_file)
+  if thin is None:
+    raise ValueError(f"No thinning factor found, the autocorrelations are still positive at lag {max_lag}. "
+                     "Give a larger --max-lag, or --thin explicitly.")
+  return thin
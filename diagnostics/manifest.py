@@ -0,0 +1,156 @@
+import json
+import os
+
+import numpy as np
+import uproot
+
+from concurrent.futures import ThreadPoolExecutor
+
+from colorama import Back
+from tqdm import tqdm
+
+from .sampler_metadata import SAMPLER_TREES, detect_sampler
+
+# Sidecar index next to the chains, and its version
+MANIFEST_FILE = ".mcmc_manifest.json"
+MANIFEST_VERSION = 1
+
+# Files opened at once while indexing. Opening a file is mostly waiting for
+# the disk (or the network file system), so threads are enough.
+MANIFEST_THREADS = 16
+
+def get_identity(filename):
+  # A file is indexed again when its size or modification time changes
+  stat = os.stat(filename)
+  return stat.st_size, stat.st_mtime_ns
+
+def get_dtype(branch):
+  # numpy dtype of a branch of plain numbers, None for anything else
+  to_dtype = getattr(branch.interpretation, "to_dtype", None)
+  return str(np.dtype(to_dtype)) if to_dtype is not None and to_dtype.shape == () else None
+
+def index_file(filename):
+  """
+  Sampler, tree, branches with their dtypes, and number of entries of one
+  chain file, or the error met while opening it.
+  """
+  size, mtime_ns = get_identity(filename)
+  record = {"size": size, "mtime_ns": mtime_ns}
+  try:
+    with uproot.open(filename) as f:
+      sampler_name = detect_sampler(f)
+      chain = f[SAMPLER_TREES[sampler_name]]
+      record.update({"sampler_name": sampler_name,
+                     "ttree_location": SAMPLER_TREES[sampler_name],
+                     "entries": int(chain.num_entries),
+                     "branches": {key: get_dtype(chain[key]) for key in chain.keys()}})
+  except (OSError, ValueError, KeyError, uproot.deserialization.DeserializationError) as error:
+    record["error"] = str(error).splitlines()[0]
+  return record
+
+class Manifest:
+  """
+  Index of the chain files: for every file (in order) its size, modification
+  time, sampler, tree, branches with their dtypes and number of entries. The
+  first readable file is the reference the other files are checked against.
+  """
+
+  def __init__(self, records):
+    self.records = records
+    readable = [record for record in records.values() if "error" not in record]
+    if not readable:
+      raise ValueError("None of the chain files could be read")
+    reference = readable[0]
+    self.sampler_name = reference["sampler_name"]
+    self.ttree_location = reference["ttree_location"]
+    self.dtypes = reference["branches"]
+    self.branches = list(self.dtypes)
+    self.entries = {filename: record["entries"] for filename, record in records.items() if "error" not in record}
+
+  def problems(self):
+    """
+    (file, problem, usable) for every file that does not match the reference.
+    Files that can't be read, have another tree or miss some branches are not
+    usable.
+    """
+    problems = []
+    reference_entries = next(iter(self.entries.values()))
+    for filename, record in self.records.items():
+      if "error" in record:
+        problems.append((filename, f"could not be read ({record['error']})", False))
+        continue
+      if record["ttree_location"] != self.ttree_location:
+        problems.append((filename, f"is a {record['sampler_name']} chain, not {self.sampler_name}", False))
+        continue
+
+      missing = [key for key in self.branches if key not in record["branches"]]
+      if missing:
+        problems.append((filename, f"misses the branches {', '.join(missing)}", False))
+      extra = [key for key in record["branches"] if key not in self.dtypes]
+      if extra:
+        problems.append((filename, f"has extra branches {', '.join(extra)}", True))
+      changed = [key for key in self.branches if key in record["branches"] and record["branches"][key] != self.dtypes[key]]
+      if changed:
+        problems.append((filename, f"has other types for {', '.join(changed)}", True))
+      if record["entries"] != reference_entries:
+        problems.append((filename, f"has {record['entries']} entries, the first chain has {reference_entries}", True))
+    return problems
+
+  def usable_files(self):
+    unusable = {filename for filename, _, usable in self.problems() if not usable}
+    return [filename for filename in self.records if filename not in unusable]
+
+def load_manifest(files, path=None, threads=MANIFEST_THREADS):
+  """
+  Manifest of the files. Files already in the sidecar index at `path` (by
+  default MANIFEST_FILE next to the first file) with the same size and
+  modification time are not opened again, the others are indexed in parallel
+  and the sidecar is updated.
+  """
+  if path is None:
+    path = os.path.join(os.path.dirname(os.path.abspath(files[0])), MANIFEST_FILE)
+
+  cached = {}
+  if os.path.exists(path):
+    try:
+      with open(path) as f:
+        index = json.load(f)
+      if index.get("version") == MANIFEST_VERSION:
+        cached = index["files"]
+    except (OSError, ValueError):
+      pass
+
+  records = {}
+  stale = []
+  for filename in files:
+    record = cached.get(os.path.abspath(filename))
+    if record is not None and (record["size"], record["mtime_ns"]) == get_identity(filename):
+      records[filename] = record
+    else:
+      records[filename] = None
+      stale.append(filename)
+
+  if stale:
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+      for filename, record in zip(stale, tqdm(executor.map(index_file, stale), total=len(stale), desc="Indexing the chains")):
+        records[filename] = record
+
+    # Unreadable files may still be being written, they are tried again next time
+    cached.update({os.path.abspath(filename): records[filename] for filename in stale if "error" not in records[filename]})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+      with open(tmp_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": cached}, f)
+      os.replace(tmp_path, path)
+    except OSError as error:
+      print(Back.RED + f"Warning: could not save the manifest to {path} ({error})" + Back.RESET)
+
+  print(f"Manifest of {len(files)} files: {len(files) - len(stale)} from {path}, {len(stale)} indexed")
+  return Manifest(records)
+
+def check_manifest(manifest):
+  # Warns about the files that don't match the first one, and returns the
+  # files the diagnostics can use
+  for filename, problem, usable in manifest.problems():
+    print(Back.RED + f"Warning: {filename} {problem}" + (", skipping it" if not usable else "") + Back.RESET)
+  return manifest.usable_files()
@@ -0,0 +1,208 @@
+import csv
+
+import numpy as np
+
+from colorama import Fore, Back
+
+from .autocorrelations import lagged_covariances, lagged_products
+from .chain_loader import ChainAccumulator, get_num_entries, get_important_keys
+from .profiling import profile_stage
+
+# Estimators of the variance of the chain means: overlapping batch means with
+# batches of sqrt(n) and n^(1/3) samples, and the spectral variance with a
+# Tukey-Hanning window of sqrt(n) lags
+MCSE_METHODS = ["obm_sqrt", "obm_cbrt", "sv"]
+
+# The chains have enough steps when the MCSE of every posterior mean is below
+# this fraction of its posterior standard deviation (0.05 is an ESS of 400)
+MCSE_THRESHOLD = 0.05
+
+def get_batch_sizes(n):
+  # sqrt(n) and n^(1/3), at least 1 and below n
+  return max(1, min(n - 1, int(np.sqrt(n)))), max(1, min(n - 1, int(np.cbrt(n))))
+
+def obm_variance(n, batch, sums, window_sums, window_squares):
+  """
+  Overlapping batch means estimate of the asymptotic variance of the mean of
+  n samples (Flegal & Jones 2010), from the sums of the samples and the sums
+  and squares of the sums of all the n - batch + 1 windows of `batch`
+  consecutive samples.
+  """
+  n_windows = n - batch + 1
+  mean = sums / n
+  deviations = window_squares / batch**2 - 2 * mean * window_sums / batch + n_windows * mean**2
+  return n * batch / ((n - batch) * n_windows) * np.maximum(deviations, 0)
+
+def spectral_variance(n, covariances):
+  # Sum of the autocovariances with a Tukey-Hanning window over their lags
+  truncation = covariances.shape[1]
+  weights = (1 + np.cos(np.pi * np.arange(truncation) / truncation)) / 2
+  weights[1:] *= 2
+  return np.maximum(covariances @ weights / n, 0)
+
+class MCSEAccumulator(ChainAccumulator):
+  """
+  Monte Carlo standard errors of the posterior means, from the variance of
+  the mean of every chain estimated with overlapping batch means and with the
+  spectral variance, in the same pass as the other diagnostics.
+
+  While a chain is read, it keeps per parameter the sums of the samples, the
+  sums and squares of the window sums for both batch sizes, the lagged
+  products up to sqrt(n) and the first and last sqrt(n) samples, like the
+  streaming autocorrelations of --watch. Once all its entries are in, this is
+  reduced to the mean, variance and the three variance estimates of the chain,
+  so the memory is O(P sqrt(n)) for the chains being read and O(P) for the
+  others. The samples are shifted by the mean of the first chunk of the chain
+  for precision.
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, burn_in=0, block_size=32):
+    self.metadata = metadata
+    self.branches = keys
+    self.burn_in = burn_in
+    self.block_size = block_size
+    self.reset()
+
+  def reset(self):
+    self.chains = {}
+
+  def new_chain(self, file_idx, columns):
+    n_parameters = len(self.branches)
+    expected = max(0, get_num_entries(self.metadata.files[file_idx], self.metadata) - self.burn_in)
+    batches = get_batch_sizes(expected)
+    return {"expected": expected,
+            "batches": batches,
+            "reference": np.array([np.mean(columns[key], dtype=np.float64) for key in self.branches]),
+            "n": 0,
+            "sums": np.zeros(n_parameters),
+            "window_sums": np.zeros((2, n_parameters)),
+            "window_squares": np.zeros((2, n_parameters)),
+            # Lags up to the largest batch, whose windows need that long a tail
+            "products": np.zeros((n_parameters, batches[0])),
+            "head": np.zeros((n_parameters, 0)),
+            "tail": np.zeros((n_parameters, 0))}
+
+  def fill(self, file_idx, columns):
+    n_steps = len(columns[self.branches[0]])
+    if n_steps == 0:
+      return
+    if file_idx not in self.chains:
+      self.chains[file_idx] = self.new_chain(file_idx, columns)
+    chain = self.chains[file_idx]
+    max_lag = chain["products"].shape[1]
+
+    heads, tails = [], []
+    for start in range(0, len(self.branches), self.block_size):
+      rows = slice(start, start + self.block_size)
+      block = np.stack([np.asarray(columns[key], dtype=np.float64) for key in self.branches[rows]])
+      block -= chain["reference"][rows, None]
+      tail = chain["tail"][rows]
+      extended = np.concatenate([tail, block], axis=1)
+
+      with profile_stage("mcse lagged products"):
+        chain["products"][rows] += lagged_products(extended, max_lag) - lagged_products(tail, max_lag)
+
+      # The windows that end in the new samples. The tail is longer than the
+      # largest batch, so they all start in `extended`.
+      cumulative = np.concatenate([np.zeros((len(block), 1)), np.cumsum(extended, axis=1)], axis=1)
+      for i, batch in enumerate(chain["batches"]):
+        ends = np.arange(max(batch, tail.shape[1] + 1), extended.shape[1] + 1)
+        window_sums = cumulative[:, ends] - cumulative[:, ends - batch]
+        chain["window_sums"][i, rows] += np.sum(window_sums, axis=1)
+        chain["window_squares"][i, rows] += np.einsum("ij,ij->i", window_sums, window_sums)
+
+      chain["sums"][rows] += np.sum(block, axis=1)
+      heads.append(np.concatenate([chain["head"][rows], block[:, :max_lag]], axis=1)[:, :max_lag])
+      tails.append(extended[:, -max_lag:])
+
+    chain["head"] = np.concatenate(heads)
+    chain["tail"] = np.concatenate(tails)
+    chain["n"] += n_steps
+    if chain["n"] >= chain["expected"]:
+      self.chains[file_idx] = self.finish_chain(chain)
+
+  def finish_chain(self, chain):
+    # The mean, variance and variance estimates of a chain that is read
+    n = chain["n"]
+    if "variances" in chain or n < 4:
+      return chain
+    covariances = lagged_covariances(n, chain["sums"], chain["products"], chain["head"], chain["tail"])
+    variances = [obm_variance(n, batch, chain["sums"], chain["window_sums"][i], chain["window_squares"][i])
+                 for i, batch in enumerate(chain["batches"])]
+    variances.append(spectral_variance(n, covariances))
+    return {"n": n,
+            "mean": chain["reference"] + chain["sums"] / n,
+            "variance": covariances[:, 0] / n,
+            "variances": np.stack(variances)}
+
+  def merge(self, other):
+    if set(self.chains) & set(other.chains):
+      raise ValueError("Can't merge the MCSE of the same chain")
+    self.chains.update(other.chains)
+
+  def result(self):
+    """
+    Per parameter: the MCSE of the posterior mean with every method, the
+    largest of them (mcse), the ESS it corresponds to, and the MCSE as a
+    fraction of the posterior standard deviation. The chains are weighted by
+    their number of samples, as in the posterior of all of them.
+    """
+    chains = [self.finish_chain(chain) for _, chain in sorted(self.chains.items())]
+    chains = [chain for chain in chains if "variances" in chain]
+    if not chains:
+      return {}
+
+    counts = np.array([chain["n"] for chain in chains], dtype=np.float64)
+    n = np.sum(counts)
+    means = np.stack([chain["mean"] for chain in chains])
+    mean = counts @ means / n
+    variance = counts @ (np.stack([chain["variance"] for chain in chains]) + (means - mean)**2) / n
+    mcse = np.sqrt(np.einsum("c,cmp->mp", counts, np.stack([chain["variances"] for chain in chains]))) / n
+
+    results = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+      largest = np.max(mcse, axis=0)
+      ess = variance / largest**2
+      ratio = largest / np.sqrt(variance)
+    for i, key in enumerate(self.branches):
+      results[key] = {f"mcse_{method}": float(mcse[j, i]) for j, method in enumerate(MCSE_METHODS)}
+      results[key].update({"mcse": float(largest[i]), "ess_mcse": float(ess[i]), "mcse_ratio": float(ratio[i])})
+    return results
+
+def get_enough_steps(mcse, threshold=MCSE_THRESHOLD):
+  """
+  Whether the posterior means of all the parameters are known to within
+  `threshold` of their standard deviations, and about how many times longer
+  the chains need to be for that (the MCSE goes down like 1/sqrt(n)).
+  """
+  ratios = [values["mcse_ratio"] for values in mcse.values() if np.isfinite(values["mcse_ratio"])]
+  worst = max(ratios, default=0.0)
+  return worst <= threshold, max(1.0, (worst / threshold)**2)
+
+def print_mcse(metadata, mcse, threshold=MCSE_THRESHOLD):
+  # The key parameters, and whether the chains have enough steps
+  print(f"Monte Carlo standard errors of the posterior means ({', '.join(MCSE_METHODS)}):")
+  for key in get_important_keys(metadata, list(mcse)):
+    values = mcse[key]
+    foreground = Fore.RED if values["mcse_ratio"] > threshold else Fore.GREEN
+    estimates = ", ".join(f"{values[f'mcse_{method}']:.3g}" for method in MCSE_METHODS)
+    print(f"  - {key}: MCSE = {foreground}{values['mcse']:.3g}{Fore.RESET} ({estimates}), "
+          f"{values['mcse_ratio']:.1%} of the posterior std, ESS = {values['ess_mcse']:.0f}")
+
+  enough, factor = get_enough_steps(mcse, threshold)
+  above = [key for key, values in mcse.items() if values["mcse_ratio"] > threshold]
+  if enough:
+    print(Fore.GREEN + f"Enough MCMC steps: the MCSE of every posterior mean is below {threshold:.0%} of its std" + Fore.RESET)
+  else:
+    print(Back.RED + f"Warning: not enough MCMC steps: the MCSE of {len(above)} of {len(mcse)} posterior means is above "
+          f"{threshold:.0%} of their std, the chains need to be about {factor:.1f} times longer" + Back.RESET)
+
+def write_mcse(mcse, output_file="mcse.csv"):
+  columns = [f"mcse_{method}" for method in MCSE_METHODS] + ["mcse", "ess_mcse", "mcse_ratio"]
+  with open(output_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["parameter"] + columns)
+    for key, values in mcse.items():
+      writer.writerow([key] + [values[column] for column in columns])
+  print(f"MCSE saved to {output_file}")
@@ -0,0 +1,96 @@
+import numpy as np
+
+from .chain_loader import ChainAccumulator
+
+def combine_moments(a, b):
+  """
+  Combines (count, mean, M2, M3, M4) of two sets of samples, where Mk is the
+  sum of the k-th powers of the deviations from the mean (Pebay 2008). Works
+  elementwise on arrays of parameters.
+  """
+  n_a, mean_a, m2_a, m3_a, m4_a = a
+  n_b, mean_b, m2_b, m3_b, m4_b = b
+  if n_a == 0:
+    return b
+  if n_b == 0:
+    return a
+
+  n = n_a + n_b
+  delta = mean_b - mean_a
+  mean = mean_a + delta * n_b / n
+  m2 = m2_a + m2_b + delta**2 * n_a * n_b / n
+  m3 = m3_a + m3_b + delta**3 * n_a * n_b * (n_a - n_b) / n**2 \
+       + 3 * delta * (n_a * m2_b - n_b * m2_a) / n
+  m4 = m4_a + m4_b + delta**4 * n_a * n_b * (n_a**2 - n_a * n_b + n_b**2) / n**3 \
+       + 6 * delta**2 * (n_a**2 * m2_b + n_b**2 * m2_a) / n**2 \
+       + 4 * delta * (n_a * m3_b - n_b * m3_a) / n
+  return n, mean, m2, m3, m4
+
+def get_moments(columns, keys):
+  # (count, mean, M2, M3, M4), minimum and maximum of a non-empty chunk
+  n = len(columns[keys[0]])
+  mean, m2, m3, m4, minimum, maximum = (np.zeros(len(keys)) for _ in range(6))
+  for i, key in enumerate(keys):
+    x = np.asarray(columns[key], dtype=np.float64)
+    mean[i] = np.mean(x)
+    deviations = x - mean[i]
+    squares = deviations * deviations
+    m2[i] = np.sum(squares)
+    m3[i] = np.dot(squares, deviations)
+    m4[i] = np.dot(squares, squares)
+    minimum[i] = np.min(x)
+    maximum[i] = np.max(x)
+  return (n, mean, m2, m3, m4), minimum, maximum
+
+class MomentsAccumulator(ChainAccumulator):
+  """
+  Mean, standard deviation, skewness, excess kurtosis, minimum and maximum of
+  every parameter over all the chains. The central moments of each file are
+  combined with combine_moments, so the result does not depend on how the
+  files are split between processes.
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, burn_in=0):
+    self.branches = keys
+    self.burn_in = burn_in
+    self.reset()
+
+  def reset(self):
+    n_parameters = len(self.branches)
+    self.moments = (0, np.zeros(n_parameters), np.zeros(n_parameters), np.zeros(n_parameters), np.zeros(n_parameters))
+    self.minimum = np.full(n_parameters, np.inf)
+    self.maximum = np.full(n_parameters, -np.inf)
+
+  def fill(self, file_idx, columns):
+    if len(columns[self.branches[0]]) == 0:
+      return
+
+    moments, minimum, maximum = get_moments(columns, self.branches)
+    self.moments = combine_moments(self.moments, moments)
+    self.minimum = np.minimum(self.minimum, minimum)
+    self.maximum = np.maximum(self.maximum, maximum)
+
+  def merge(self, other):
+    self.moments = combine_moments(self.moments, other.moments)
+    self.minimum = np.minimum(self.minimum, other.minimum)
+    self.maximum = np.maximum(self.maximum, other.maximum)
+
+  def result(self):
+    return moments_summary(self.branches, self.moments, self.minimum, self.maximum)
+
+def moments_summary(keys, moments, minimum, maximum):
+  n, mean, m2, m3, m4 = moments
+  with np.errstate(divide="ignore", invalid="ignore"):
+    std = np.sqrt(m2 / (n - 1))
+    skewness = np.sqrt(n) * m3 / m2**1.5
+    kurtosis = n * m4 / m2**2 - 3
+
+  return {key: {"n": int(n),
+                "mean": float(mean[i]),
+                "std": float(std[i]),
+                "min": float(minimum[i]),
+                "max": float(maximum[i]),
+                "skewness": float(skewness[i]),
+                "kurtosis": float(kurtosis[i])}
+          for i, key in enumerate(keys)}
@@ -0,0 +1,164 @@
+import copy
+import os
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+from colorama import Back
+from tqdm import tqdm
+
+from .chain_loader import get_important_keys
+from .profiling import profile_stage
+
+# Choices of --plots: which parameters get their own pages
+PLOT_SELECTIONS = ["key-only", "flagged", "all"]
+
+# matplotlib is only imported once something is drawn, so that the modules of
+# the diagnostics can be used without it
+
+def new_figure(figsize=None):
+  from matplotlib.figure import Figure
+  return Figure(figsize=figsize)
+
+def open_pdf(output_file):
+  from matplotlib.backends.backend_pdf import PdfPages
+  return PdfPages(output_file)
+
+class PageRenderer:
+  """
+  Draws one pdf page per key of `data`. `setup` creates the figure and its
+  artists once, and `draw` only updates their data, titles and limits for the
+  next key, which is much cheaper than making a new figure for every page.
+
+  Subclasses keep everything a page needs in `data` (keyed like the pages), so
+  that `subset` can send a range of pages to a worker process without the data
+  of the other pages.
+
+  The tight layout is only recalculated when the widest y tick label changes
+  (`layout_key`), as that is what moves the margins from page to page. It is
+  the slowest part of a page otherwise. Renderers with a fixed layout set
+  `tight_layout = False`.
+  """
+  tight_layout = True
+
+  def __init__(self, data):
+    self.data = data
+    self.figure = None
+
+  @property
+  def pages(self):
+    return list(self.data)
+
+  def setup(self):
+    raise NotImplementedError
+
+  def draw(self, key):
+    raise NotImplementedError
+
+  def layout_key(self):
+    ticks = self.axes.yaxis.get_major_formatter().format_ticks(self.axes.get_yticks())
+    return max((len(tick) for tick in ticks), default=0)
+
+  def subset(self, keys):
+    renderer = copy.copy(self)
+    renderer.data = {key: self.data[key] for key in keys}
+    renderer.figure = None
+    return renderer
+
+  def render(self, pdf, desc=None):
+    if self.figure is None:
+      self.setup()
+    layout = None
+    for key in tqdm(self.pages, desc=desc, disable=desc is None):
+      self.draw(key)
+      if self.tight_layout and self.layout_key() != layout:
+        self.figure.tight_layout()
+        layout = self.layout_key()
+      pdf.savefig(self.figure)
+
+def render_part(renderers, output_file):
+  # Runs in the worker processes
+  with open_pdf(output_file) as pdf:
+    for renderer in renderers:
+      renderer.render(pdf)
+  return output_file
+
+def split_pages(renderers, n_parts):
+  # Contiguous ranges with about the same number of pages, each a list of
+  # renderer subsets
+  pages = [(i, key) for i, renderer in enumerate(renderers) for key in renderer.pages]
+  size = max(1, -(-len(pages) // n_parts))
+
+  parts = []
+  for start in range(0, len(pages), size):
+    part = []
+    for i, key in pages[start:start + size]:
+      if part and part[-1][0] == i:
+        part[-1][1].append(key)
+      else:
+        part.append((i, [key]))
+    parts.append([renderers[i].subset(keys) for i, keys in part])
+  return parts
+
+def render_pdf(output_file, renderers, jobs=1, desc="Rendering pages"):
+  """
+  Renders the pages of all the renderers, in order, into one pdf. With more
+  than one job, contiguous page ranges are rendered into temporary pdfs by
+  worker processes and concatenated at the end (this needs pypdf).
+  """
+  n_pages = sum(len(renderer.pages) for renderer in renderers)
+  if jobs > 1:
+    try:
+      from pypdf import PdfWriter
+    except ImportError:
+      print(Back.RED + "Warning: rendering the pages in parallel needs pypdf (pip install pypdf), using a single process" + Back.RESET)
+      jobs = 1
+
+  if jobs <= 1 or n_pages < 2:
+    with open_pdf(output_file) as pdf:
+      for renderer in renderers:
+        with profile_stage(f"render {type(renderer).__name__}"):
+          renderer.render(pdf, desc=desc)
+    return
+
+  parts = split_pages(renderers, jobs)
+  with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as directory:
+    paths = [os.path.join(directory, f"part_{i}.pdf") for i in range(len(parts))]
+    with profile_stage("render pages in parallel"), ProcessPoolExecutor(max_workers=jobs) as executor:
+      futures = [executor.submit(render_part, part, path) for part, path in zip(parts, paths)]
+      for future in tqdm(futures, desc=desc):
+        future.result()
+
+    with profile_stage("join pdf parts"):
+      writer = PdfWriter()
+      for path in paths:
+        writer.append(path)
+      with open(output_file, "wb") as f:
+        writer.write(f)
+
+def get_flagged_keys(summary=None, effective=None, rhat_threshold=1.01, min_ess=400):
+  """
+  Parameters failing any of the diagnostics given: Rhat above the threshold or
+  bulk/tail ESS below min_ess in the convergence summary, or autocorrelations
+  that have not decayed by the maximum lag.
+  """
+  flagged = set()
+  if summary is not None:
+    flagged |= {key for key, values in summary.items()
+                if values["rhat"] > rhat_threshold or min(values["ess_bulk"], values["ess_tail"]) < min_ess}
+  if effective is not None:
+    flagged |= {key for key, values in effective.items() if values["truncated"]}
+  return flagged
+
+def select_pages(metadata, keys, plots="all", flagged=None):
+  # The key parameters always get their pages, "flagged" adds the parameters
+  # failing a diagnostic
+  if plots == "all":
+    return list(keys)
+  if plots not in PLOT_SELECTIONS:
+    raise ValueError(f"Unknown plot selection {plots}, use one of {PLOT_SELECTIONS}")
+
+  selected = set(get_important_keys(metadata, keys))
+  if plots == "flagged":
+    selected |= set(flagged or [])
+  return [key for key in keys if key in selected]
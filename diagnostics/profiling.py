@@ -0,0 +1,146 @@
+import json
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+
+from contextlib import contextmanager
+
+# The profile of this process, None unless enable_profiling was called. The
+# stages cost a function call when profiling is off.
+PROFILE = None
+
+class Profile:
+  """
+  Time and calls per stage, and time, bytes and baskets read per branch.
+  Stages can be nested, their times include the nested ones.
+
+  With track_allocations, the numpy and Python allocations of every stage are
+  traced with tracemalloc too: the net allocation and the peak above the
+  allocations at the start. This slows down allocation-heavy code (e.g.
+  matplotlib) a few times, so it is off by default.
+  """
+
+  def __init__(self, track_allocations=False):
+    self.start = time.perf_counter()
+    self.track_allocations = track_allocations
+    self.stages = {}
+    self.branches = {}
+    self.worker_peak_rss = 0
+    # Running peak allocation of every open stage, innermost last
+    self.open_peaks = []
+
+  def add_stage(self, name, elapsed, allocated=0, peak_allocated=0):
+    stage = self.stages.setdefault(name, {"calls": 0, "time": 0.0, "allocated": 0, "peak_allocated": 0})
+    stage["calls"] += 1
+    stage["time"] += elapsed
+    stage["allocated"] += allocated
+    stage["peak_allocated"] = max(stage["peak_allocated"], peak_allocated)
+
+  def add_branch_read(self, branch, entry_start, entry_stop, elapsed, uncompressed_bytes):
+    # The baskets overlapping the entries read, and their size on disk
+    offsets = branch.entry_offsets
+    first = max(0, int(np.searchsorted(offsets, entry_start, side="right")) - 1)
+    last = min(branch.num_baskets, int(np.searchsorted(offsets, entry_stop, side="left")))
+    compressed_bytes = sum(branch.basket_compressed_bytes(i) for i in range(first, last))
+
+    record = self.branches.setdefault(branch.name, {"reads": 0, "time": 0.0, "compressed_bytes": 0, "uncompressed_bytes": 0, "baskets": 0})
+    record["reads"] += 1
+    record["time"] += elapsed
+    record["compressed_bytes"] += compressed_bytes
+    record["uncompressed_bytes"] += uncompressed_bytes
+    record["baskets"] += max(0, last - first)
+
+  def merge(self, records):
+    # Adds the records of a worker process
+    for name, stage in records["stages"].items():
+      total = self.stages.setdefault(name, {"calls": 0, "time": 0.0, "allocated": 0, "peak_allocated": 0})
+      for key in ["calls", "time", "allocated"]:
+        total[key] += stage[key]
+      total["peak_allocated"] = max(total["peak_allocated"], stage["peak_allocated"])
+    for name, branch in records["branches"].items():
+      total = self.branches.setdefault(name, {key: 0 for key in branch})
+      for key, value in branch.items():
+        total[key] += value
+    self.worker_peak_rss = max(self.worker_peak_rss, records["peak_rss"], records["worker_peak_rss"])
+
+  def to_dict(self):
+    totals = {key: sum(branch[key] for branch in self.branches.values())
+              for key in ["time", "compressed_bytes", "uncompressed_bytes", "baskets"]}
+    return {"total_time": time.perf_counter() - self.start,
+            "track_allocations": self.track_allocations,
+            "peak_rss": peak_rss(),
+            "worker_peak_rss": self.worker_peak_rss,
+            "read": totals,
+            "stages": self.stages,
+            "branches": self.branches}
+
+def peak_rss():
+  # ru_maxrss is in kB on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def enable_profiling(track_allocations=False):
+  global PROFILE
+  PROFILE = Profile(track_allocations)
+  if track_allocations and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  return PROFILE
+
+def get_profile():
+  return PROFILE
+
+@contextmanager
+def profile_stage(name):
+  profile = PROFILE
+  if profile is None:
+    yield
+    return
+
+  if profile.track_allocations:
+    current, peak = tracemalloc.get_traced_memory()
+    if profile.open_peaks:
+      profile.open_peaks[-1] = max(profile.open_peaks[-1], peak)
+    tracemalloc.reset_peak()
+    profile.open_peaks.append(current)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    allocated = peak_allocated = 0
+    if profile.track_allocations:
+      after, peak = tracemalloc.get_traced_memory()
+      stage_peak = max(profile.open_peaks.pop(), peak)
+      allocated = after - current
+      peak_allocated = stage_peak - current
+      if profile.open_peaks:
+        profile.open_peaks[-1] = max(profile.open_peaks[-1], stage_peak)
+    profile.add_stage(name, elapsed, allocated, peak_allocated)
+
+def print_profile(records, n_branches=10):
+  total_time = records["total_time"]
+  allocations = records["track_allocations"]
+  print(f"Profile of {total_time:.2f} s (stage times include their nested stages):")
+  print(f"  {'stage':<40} {'calls':>8} {'time [s]':>10} {'share':>7}" +
+        (f" {'allocated [MB]':>15} {'peak [MB]':>10}" if allocations else ""))
+  for name, stage in sorted(records["stages"].items(), key=lambda item: -item[1]["time"]):
+    print(f"  {name:<40} {stage['calls']:>8} {stage['time']:>10.3f} {100 * stage['time'] / total_time:>6.1f}%" +
+          (f" {stage['allocated'] / 1024**2:>15.1f} {stage['peak_allocated'] / 1024**2:>10.1f}" if allocations else ""))
+
+  read = records["read"]
+  if records["branches"]:
+    print(f"Slowest branches to read ({read['baskets']} baskets, {read['compressed_bytes'] / 1024**2:.1f} MB compressed, "
+          f"{read['uncompressed_bytes'] / 1024**2:.1f} MB uncompressed in total):")
+    print(f"  {'branch':<40} {'time [s]':>10} {'baskets':>8} {'compressed [MB]':>16} {'uncompressed [MB]':>18}")
+    for name, branch in sorted(records["branches"].items(), key=lambda item: -item[1]["time"])[:n_branches]:
+      print(f"  {name:<40} {branch['time']:>10.3f} {branch['baskets']:>8} "
+            f"{branch['compressed_bytes'] / 1024**2:>16.2f} {branch['uncompressed_bytes'] / 1024**2:>18.2f}")
+
+  print(f"Peak RSS: {records['peak_rss'] / 1024**2:.0f} MB" +
+        (f" (workers: {records['worker_peak_rss'] / 1024**2:.0f} MB)" if records["worker_peak_rss"] else ""))
+
+def save_profile(records, output_file="profile.json"):
+  with open(output_file, "w") as f:
+    json.dump(records, f, indent=2)
+  print(f"Profile saved to {output_file}")
@@ -0,0 +1,226 @@
+import csv
+
+import numpy as np
+
+from colorama import Back
+
+from .chain_loader import ChainAccumulator, get_num_entries, get_important_keys
+
+# Probability inside the 1, 2 and 3 sigma credible intervals
+CREDIBLE_MASSES = {"1s": 0.6827, "2s": 0.9545, "3s": 0.9973}
+
+# The same splits as the split posteriors
+SPLITS = ["full", "left", "right", "first", "second"]
+
+# Capacity of the largest compactor of a sketch. A sketch holds at most about
+# 3k items, and the rank error of its quantiles is about 2 / k (0.2% of the
+# samples for k = 1000).
+DEFAULT_SKETCH_SIZE = 1000
+
+class KLLSketch:
+  """
+  Quantile sketch of Karnin, Lang and Liberty (2016): a stack of compactors,
+  where level h holds items that each stand for 2^h samples. A level over its
+  capacity is sorted and either its odd or its even items move up a level, so
+  the sketch keeps O(k) items however many samples it sees. The choice is
+  random, but seeded by the samples seen so far, so that the same chunks give
+  the same sketch. Sketches of different samples can be merged level by level
+  into the sketch of all of them.
+  """
+
+  def __init__(self, k=DEFAULT_SKETCH_SIZE):
+    self.k = k
+    self.levels = [np.zeros(0)]
+    self.n = 0
+    self.minimum = np.inf
+    self.maximum = -np.inf
+
+  def capacity(self, level):
+    # Lower levels get geometrically smaller compactors
+    return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - level))))
+
+  def update(self, values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+      return
+    self.n += len(values)
+    self.minimum = min(self.minimum, np.min(values))
+    self.maximum = max(self.maximum, np.max(values))
+    self.levels[0] = np.concatenate([self.levels[0], values])
+    self.compress()
+
+  def merge(self, other):
+    while len(self.levels) < len(other.levels):
+      self.levels.append(np.zeros(0))
+    for level, items in enumerate(other.levels):
+      self.levels[level] = np.concatenate([self.levels[level], items])
+    self.n += other.n
+    self.minimum = min(self.minimum, other.minimum)
+    self.maximum = max(self.maximum, other.maximum)
+    self.compress()
+
+  def compress(self):
+    rng = np.random.default_rng([self.n, len(self.levels)])
+    level = 0
+    while level < len(self.levels):
+      if len(self.levels[level]) > self.capacity(level):
+        if level + 1 == len(self.levels):
+          self.levels.append(np.zeros(0))
+        items = np.sort(self.levels[level])
+        # An odd item out stays where it is
+        n_even = len(items) - len(items) % 2
+        offset = rng.integers(2)
+        self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[offset:n_even:2]])
+        self.levels[level] = items[n_even:]
+      level += 1
+
+  def n_items(self):
+    return sum(len(items) for items in self.levels)
+
+  def weighted_items(self):
+    items = np.concatenate(self.levels)
+    weights = np.concatenate([np.full(len(items), 2.0**level) for level, items in enumerate(self.levels)])
+    order = np.argsort(items, kind="stable")
+    return items[order], weights[order]
+
+  def quantile(self, levels):
+    levels = np.asarray(levels, dtype=np.float64)
+    if self.n == 0:
+      return np.full(levels.shape, np.nan)
+    items, weights = self.weighted_items()
+    cumulative = np.cumsum(weights)
+    indices = np.searchsorted(cumulative, levels * cumulative[-1], side="left")
+    values = items[np.minimum(indices, len(items) - 1)]
+    # The extremes are known exactly
+    return np.where(levels <= 0, self.minimum, np.where(levels >= 1, self.maximum, values))
+
+  def hpd(self, mass, n_grid=1000):
+    # The narrowest interval holding `mass` of the samples. Like a histogram
+    # HPD, a single interval, so it spans the gaps of multimodal posteriors.
+    lows = np.linspace(0, 1 - mass, n_grid)
+    starts = self.quantile(lows)
+    ends = self.quantile(lows + mass)
+    if self.n == 0:
+      return np.nan, np.nan
+    best = np.argmin(ends - starts)
+    return float(starts[best]), float(ends[best])
+
+def merge_sketches(sketches, k=DEFAULT_SKETCH_SIZE):
+  merged = KLLSketch(k)
+  for sketch in sketches:
+    merged.merge(sketch)
+  return merged
+
+class QuantileAccumulator(ChainAccumulator):
+  """
+  Medians and credible intervals of every parameter, with no histogram
+  ranges to fix beforehand. Every chain gets a KLLSketch per parameter for
+  each of its halves, filled chunk by chunk, so the memory only depends on
+  the number of chains and parameters. The sketches of the splits of the
+  split posteriors (full, left/right side of the chains, first/second half of
+  the chains) are merged from them at the end.
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, burn_in=0, k=DEFAULT_SKETCH_SIZE):
+    self.metadata = metadata
+    self.branches = keys
+    self.burn_in = burn_in
+    self.k = k
+    self.nfiles = len(metadata.files)
+    self.reset()
+
+  def reset(self):
+    self.chains = {}
+
+  def new_chain(self, file_idx):
+    # The left side ends halfway through the entries after the burn-in
+    n_entries = get_num_entries(self.metadata.files[file_idx], self.metadata)
+    return {"entries": 0,
+            "half": max(0, n_entries - self.burn_in) // 2,
+            "sketches": {key: [KLLSketch(self.k), KLLSketch(self.k)] for key in self.branches}}
+
+  def fill(self, file_idx, columns):
+    n = len(columns[self.branches[0]])
+    if n == 0:
+      return
+    if file_idx not in self.chains:
+      self.chains[file_idx] = self.new_chain(file_idx)
+    chain = self.chains[file_idx]
+
+    split = int(np.clip(chain["half"] - chain["entries"], 0, n))
+    for key in self.branches:
+      data = np.asarray(columns[key], dtype=np.float64)
+      left, right = chain["sketches"][key]
+      left.update(data[:split])
+      right.update(data[split:])
+    chain["entries"] += n
+
+  def merge(self, other):
+    for file_idx, chain in other.chains.items():
+      if file_idx not in self.chains:
+        self.chains[file_idx] = chain
+        continue
+      for key, sketches in chain["sketches"].items():
+        for mine, theirs in zip(self.chains[file_idx]["sketches"][key], sketches):
+          mine.merge(theirs)
+      self.chains[file_idx]["entries"] += chain["entries"]
+
+  def split_sketches(self, key):
+    sides = {split: [] for split in SPLITS}
+    for file_idx, chain in sorted(self.chains.items()):
+      half = "first" if file_idx / self.nfiles < 0.5 else "second"
+      for side, sketch in zip(("left", "right"), chain["sketches"][key]):
+        for split in ("full", side, half):
+          sides[split].append(sketch)
+    return {split: merge_sketches(sketches, self.k) for split, sketches in sides.items()}
+
+  def result(self):
+    """
+    Per parameter and split: the number of samples, the median, and the
+    central and highest-density 1, 2 and 3 sigma intervals.
+    """
+    results = {}
+    for key in self.branches:
+      results[key] = {}
+      for split, sketch in self.split_sketches(key).items():
+        tails = [(1 - mass) / 2 for mass in CREDIBLE_MASSES.values()]
+        lows = sketch.quantile(tails)
+        highs = sketch.quantile([1 - tail for tail in tails])
+        results[key][split] = {"n": sketch.n,
+                               "median": float(sketch.quantile(0.5)),
+                               "central": {sigma: (float(low), float(high)) for sigma, low, high in zip(CREDIBLE_MASSES, lows, highs)},
+                               "hpd": {sigma: sketch.hpd(mass) for sigma, mass in CREDIBLE_MASSES.items()}}
+    return results
+
+def print_quantiles(metadata, quantiles, keys=None):
+  # Median and 1 sigma HPD of the key parameters, warning when the halves of
+  # the chains disagree by more than the width of their 1 sigma intervals
+  if keys is None:
+    keys = get_important_keys(metadata, list(quantiles))
+  print("Medians and 1 sigma highest-density intervals:")
+  for key in keys:
+    full = quantiles[key]["full"]
+    low, high = full["hpd"]["1s"]
+    print(f"  - {key}: {full['median']:.6g} [{low:.6g}, {high:.6g}]")
+
+  for key, splits in quantiles.items():
+    for first, second in [("left", "right"), ("first", "second")]:
+      if splits[first]["n"] == 0 or splits[second]["n"] == 0:
+        continue
+      difference = abs(splits[first]["median"] - splits[second]["median"])
+      width = min(np.subtract(*splits[split]["hpd"]["1s"][::-1]) for split in (first, second))
+      if difference > width:
+        print(Back.RED + f"Warning: the medians of {key} in the {first} and {second} splits differ by more than their 1 sigma intervals" + Back.RESET)
+
+def write_quantiles(quantiles, output_file="quantiles.csv"):
+  intervals = [f"{kind}_{sigma}_{end}" for kind in ("central", "hpd") for sigma in CREDIBLE_MASSES for end in ("low", "high")]
+  with open(output_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["parameter", "split", "n", "median"] + intervals)
+    for key, splits in quantiles.items():
+      for split, values in splits.items():
+        writer.writerow([key, split, values["n"], values["median"]] +
+                        [end for kind in ("central", "hpd") for sigma in CREDIBLE_MASSES for end in values[kind][sigma]])
+  print(f"Quantiles saved to {output_file}")
@@ -0,0 +1,342 @@
+import numpy as np
+import uproot
+
+from concurrent.futures import ProcessPoolExecutor
+
+from colorama import Fore, Back
+from tqdm import tqdm
+
+from .autocorrelations import lagged_products
+from .chain_loader import get_important_keys
+from .convergence import geyer_tau
+from .moments import combine_moments, get_moments, moments_summary
+
+# Number of pieces read from every chain, spread evenly over it. They are the
+# blocks the bootstrap resamples for the error bars, so there are at least
+# MIN_SEGMENTS of them.
+QUICK_SEGMENTS = 20
+MIN_SEGMENTS = 4
+
+# Lags of the short-lag autocorrelations
+QUICK_MAX_LAG = 100
+
+BOOTSTRAP_SAMPLES = 100
+
+# Rhat threshold the quick look decides on
+QUICK_RHAT_THRESHOLD = 1.01
+
+def get_basket_boundaries(chain, branches):
+  # Entries where all the branches start a new basket
+  boundaries = None
+  for branch in branches:
+    offsets = set(int(offset) for offset in chain[branch].entry_offsets)
+    boundaries = offsets if boundaries is None else boundaries & offsets
+  return np.array(sorted(boundaries), dtype=np.int64)
+
+def get_segments(boundaries, entry_start, entry_stop, fraction, n_segments=QUICK_SEGMENTS):
+  """
+  Up to n_segments entry ranges, with about `fraction` of the entries between
+  entry_start and entry_stop, centred on evenly spaced points of the chain.
+  Their ends are moved to the nearest basket boundaries, so that only whole
+  baskets are read. When the baskets are longer than the ranges, every range
+  would still decompress a whole basket, so whole baskets spread over the
+  chain are taken instead (about `fraction` of them, at least MIN_SEGMENTS
+  for the bootstrap) if that reads fewer baskets.
+  """
+  n = entry_stop - entry_start
+  if n <= 0:
+    return []
+  boundaries = boundaries[(boundaries >= entry_start) & (boundaries <= entry_stop)]
+  boundaries = np.unique(np.concatenate([boundaries, [entry_start, entry_stop]]))
+
+  def nearest(entry):
+    return int(boundaries[np.argmin(np.abs(boundaries - entry))])
+
+  length = max(1.0, fraction * n / n_segments)
+  segments = []
+  for centre in entry_start + (np.arange(n_segments) + 0.5) * n / n_segments:
+    start, stop = nearest(centre - length / 2), nearest(centre + length / 2)
+    if stop <= start:
+      # Baskets longer than the segments, only part of one is read
+      start, stop = int(np.floor(centre - length / 2)), int(np.ceil(centre + length / 2))
+    # The segments can't overlap
+    start = max(start, segments[-1][1] if segments else entry_start)
+    stop = min(stop, entry_stop)
+    if stop > start:
+      segments.append((start, stop))
+
+  n_baskets = len(boundaries) - 1
+  n_whole = min(n_baskets, max(MIN_SEGMENTS, int(round(fraction * n_baskets))))
+  if n_whole < count_baskets(boundaries, segments):
+    picked = ((np.arange(n_whole) + 0.5) * n_baskets / n_whole).astype(np.int64)
+    segments = [(int(boundaries[i]), int(boundaries[i + 1])) for i in picked]
+  return segments
+
+def count_baskets(offsets, segments):
+  # Baskets of a branch overlapping the segments
+  baskets = set()
+  for start, stop in segments:
+    first = int(np.searchsorted(offsets, start, side="right")) - 1
+    last = int(np.searchsorted(offsets, stop, side="left"))
+    baskets.update(range(max(0, first), last))
+  return len(baskets)
+
+def segment_statistics(columns, keys, max_lag, shift):
+  """
+  Everything the quick look needs from one segment, as sums that can be
+  added up over any (resampled) set of segments: the moments, the accepted
+  steps, and the lagged products with the sums of the first and last `lag`
+  entries of every parameter (shifted by `shift` for precision).
+  """
+  x = np.stack([np.asarray(columns[key], dtype=np.float64) for key in keys]) - shift[:, None]
+  n = x.shape[1]
+  moments, minimum, maximum = get_moments(columns, keys)
+  sums = np.sum(x, axis=1)
+  cumulative = np.concatenate([np.zeros((len(keys), 1)), np.cumsum(x, axis=1)], axis=1)
+  lags = np.minimum(np.arange(max_lag), n)
+  return {"n": n,
+          "moments": moments,
+          "minimum": minimum,
+          "maximum": maximum,
+          "sums": sums,
+          "squares": np.einsum("ij,ij->i", x, x),
+          "accepted": int(np.count_nonzero(x[0, 1:] != x[0, :-1])),
+          "steps": n - 1,
+          "products": lagged_products(x, max_lag),
+          "heads": cumulative[:, lags],
+          "tails": sums[:, None] - cumulative[:, n - lags]}
+
+def quick_look_file(file_idx, metadata, keys, burn_in, fraction, max_lag):
+  # Reads the segments of one chain, in the worker processes
+  wanted = set(keys)
+  with uproot.open(metadata.files[file_idx]) as f:
+    chain = f[metadata.ttree_location]
+    n_entries = chain.num_entries
+    segments = get_segments(get_basket_boundaries(chain, keys), min(burn_in, n_entries), n_entries, fraction)
+    offsets = np.asarray(chain[keys[0]].entry_offsets)
+
+    statistics = []
+    shift = None
+    for start, stop in segments:
+      columns = chain.arrays(filter_name=lambda name: name in wanted, entry_start=start, entry_stop=stop, library="np")
+      if shift is None:
+        shift = np.array([np.asarray(columns[key][0], dtype=np.float64) for key in keys])
+      statistics.append(segment_statistics(columns, keys, max_lag, shift))
+
+  baskets_total = int(np.searchsorted(offsets, n_entries, side="left")) - max(0, int(np.searchsorted(offsets, burn_in, side="right")) - 1)
+  return {"file_idx": file_idx,
+          "entries": max(0, n_entries - burn_in),
+          "segments": segments,
+          "baskets_read": count_baskets(offsets, segments),
+          "baskets": baskets_total,
+          "shift": shift,
+          "statistics": statistics}
+
+def stack_statistics(statistics):
+  return {name: np.array([segment[name] for segment in statistics]) for name in ["n", "sums", "squares", "accepted", "steps", "products", "heads", "tails"]}
+
+def weighted_moments(stats, weights):
+  """
+  Length, mean (shifted) and variance of a chain made of its segments
+  repeated `weights` times, for every row of weights (B, S).
+  """
+  n = weights @ stats["n"]
+  sums = weights @ stats["sums"]
+  squares = weights @ stats["squares"]
+  with np.errstate(divide="ignore", invalid="ignore"):
+    mean = sums / n[:, None]
+    variance = (squares - sums * mean) / (n[:, None] - 1)
+  return n, mean, variance
+
+def weighted_autocorrelations(stats, weights, mean, max_lag):
+  # sum over t of (x_t - mean)(x_t+lag - mean), with the sums of the first
+  # n - lag and the last n - lag entries of every segment
+  lags = np.arange(max_lag)
+  products = np.einsum("bs,spl->bpl", weights, stats["products"])
+  firsts = np.einsum("bs,spl->bpl", weights, stats["sums"][:, :, None] - stats["tails"])
+  lasts = np.einsum("bs,spl->bpl", weights, stats["sums"][:, :, None] - stats["heads"])
+  pairs = weights @ np.maximum(stats["n"][:, None] - lags[None, :], 0)
+  covariance = products - mean[:, :, None] * (firsts + lasts) + pairs[:, None, :] * mean[:, :, None]**2
+  # Resampled rows can have no pair of entries at the longer lags, which are
+  # left out (NaN) rather than divided by zero
+  with np.errstate(divide="ignore", invalid="ignore"):
+    covariance = np.where(pairs[:, None, :] > 0, covariance / pairs[:, None, :], np.nan)
+    return covariance / covariance[:, :, :1]
+
+def split_rhat(n, means, variances):
+  # Classic Gelman-Rubin Rhat of the half chains, (B, chains, parameters)
+  W = np.mean(variances, axis=1)
+  n = np.mean(n, axis=1)[:, None]
+  var = (n - 1) / n * W + np.var(means, axis=1, ddof=1)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    return np.sqrt(var / W)
+
+def quick_estimates(chains, weights, max_lag):
+  """
+  Split-Rhat, acceptance, mean, standard deviation and short-lag
+  autocorrelation time for every row of the segment weights of every chain.
+  """
+  halves = []
+  acceptances = []
+  totals = []
+  rhos = []
+  for chain, chain_weights in zip(chains, weights):
+    stats = chain["stacked"]
+    n_segments = len(stats["n"])
+    for half in (slice(0, n_segments // 2), slice(n_segments // 2, n_segments)):
+      half_weights = np.zeros_like(chain_weights)
+      half_weights[:, half] = chain_weights[:, half]
+      n, mean, variance = weighted_moments(stats, half_weights)
+      halves.append((n, mean + chain["shift"], variance))
+    n, mean, variance = weighted_moments(stats, chain_weights)
+    totals.append((n, mean + chain["shift"], variance))
+    rhos.append(weighted_autocorrelations(stats, chain_weights, mean, max_lag))
+
+    steps = chain_weights @ stats["steps"]
+    accepted = chain_weights @ stats["accepted"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+      acceptances.append((accepted / steps * 100.0, steps, accepted))
+
+  rhat = split_rhat(np.stack([h[0] for h in halves], axis=1),
+                    np.stack([h[1] for h in halves], axis=1),
+                    np.stack([h[2] for h in halves], axis=1))
+
+  # Pooled mean and standard deviation of all the chains
+  n = np.stack([t[0] for t in totals], axis=1)
+  means = np.stack([t[1] for t in totals], axis=1)
+  variances = np.stack([t[2] for t in totals], axis=1)
+  n_total = np.sum(n, axis=1)
+  mean = np.sum(n[:, :, None] * means, axis=1) / n_total[:, None]
+  m2 = np.sum((n[:, :, None] - 1) * variances + n[:, :, None] * (means - mean[:, None, :])**2, axis=1)
+  std = np.sqrt(m2 / (n_total[:, None] - 1))
+
+  steps = np.sum([a[1] for a in acceptances], axis=0)
+  accepted = np.sum([a[2] for a in acceptances], axis=0)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    total_acceptance = accepted / steps * 100.0
+
+  # Mean over the chains that have the lag. The lags longer than all the
+  # pieces stay NaN, and end the sums of tau like the last lag does.
+  rhos = np.stack(rhos)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    rho = np.nansum(rhos, axis=0) / np.sum(~np.isnan(rhos), axis=0)
+  tau = np.maximum(geyer_tau(rho), 1.0)
+  n_pairs = max_lag // 2
+  truncated = np.all(~(rho[..., 0:2 * n_pairs:2] + rho[..., 1:2 * n_pairs:2] <= 0), axis=-1)
+  return {"rhat": rhat, "mean": mean, "std": std, "acceptance": total_acceptance,
+          "chain_acceptances": np.stack([a[0] for a in acceptances], axis=1),
+          "tau": tau, "truncated": truncated}
+
+def quick_look(metadata, keys, burn_in, fraction, max_lag=QUICK_MAX_LAG, jobs=1, bootstrap_samples=BOOTSTRAP_SAMPLES, seed=0):
+  """
+  Approximate diagnostics from about `fraction` of every chain: QUICK_SEGMENTS
+  pieces spread over each chain, aligned to its baskets, so the reading time
+  scales with the fraction. The error bars are the standard deviations of a
+  bootstrap that resamples the pieces of every chain.
+  """
+  max_lag = max(2, max_lag)
+  n_files = len(metadata.files)
+  arguments = ([metadata] * n_files, [keys] * n_files, [burn_in] * n_files, [fraction] * n_files, [max_lag] * n_files)
+  executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+  try:
+    results = (executor.map if executor is not None else map)(quick_look_file, range(n_files), *arguments)
+    chains = list(tqdm(results, total=n_files, desc=f"Reading {fraction:.1%} of the MCMC chains"))
+  finally:
+    if executor is not None:
+      executor.shutdown()
+
+  chains = [chain for chain in chains if len(chain["statistics"]) >= 2]
+  if len(chains) < n_files:
+    print(Back.RED + f"Warning: only {len(chains)} of {n_files} chains have at least two segments after the burn-in" + Back.RESET)
+  if not chains:
+    raise ValueError("No chain is long enough for the quick look")
+  for chain in chains:
+    chain["stacked"] = stack_statistics(chain["statistics"])
+
+  # The estimates from all the segments, and from the resampled ones. The
+  # halves of the chains are resampled separately, as they are the chains of
+  # the split-Rhat.
+  rng = np.random.default_rng(seed)
+  ones = [np.ones((1, len(chain["statistics"]))) for chain in chains]
+  resampled = []
+  for chain in chains:
+    n_segments = len(chain["statistics"])
+    halves = [n_segments // 2, n_segments - n_segments // 2]
+    resampled.append(np.concatenate([rng.multinomial(size, np.full(size, 1 / size), size=bootstrap_samples) for size in halves], axis=1).astype(np.float64))
+  estimate = quick_estimates(chains, ones, max_lag)
+  bootstrap = quick_estimates(chains, resampled, max_lag)
+  errors = {name: np.nanstd(values, axis=0) for name, values in bootstrap.items() if name != "truncated"}
+
+  moments = (0, 0, 0, 0, 0)
+  minimum = np.full(len(keys), np.inf)
+  maximum = np.full(len(keys), -np.inf)
+  for chain in chains:
+    for segment in chain["statistics"]:
+      moments = combine_moments(moments, segment["moments"])
+      minimum = np.minimum(minimum, segment["minimum"])
+      maximum = np.maximum(maximum, segment["maximum"])
+  parameters = moments_summary(keys, moments, minimum, maximum)
+
+  n_entries = sum(chain["entries"] for chain in chains)
+  for i, key in enumerate(keys):
+    tau = float(estimate["tau"][0, i])
+    parameters[key].update({"mean_error": float(errors["mean"][i]),
+                            "std_error": float(errors["std"][i]),
+                            "rhat": float(estimate["rhat"][0, i]),
+                            "rhat_error": float(errors["rhat"][i]),
+                            "tau": tau,
+                            "tau_error": float(errors["tau"][i]),
+                            "ess": n_entries / tau,
+                            "truncated": bool(estimate["truncated"][0, i])})
+
+  entries_read = sum(int(np.sum(chain["stacked"]["n"])) for chain in chains)
+  return {"sampler_name": metadata.sampler_name,
+          "burn_in": burn_in,
+          "fraction": fraction,
+          "max_lag": max_lag,
+          "entries_read": entries_read,
+          "entries": n_entries,
+          "baskets_read": sum(chain["baskets_read"] for chain in chains),
+          "baskets": sum(chain["baskets"] for chain in chains),
+          "acceptance": float(estimate["acceptance"][0]),
+          "acceptance_error": float(errors["acceptance"]),
+          "chains": [{"file": metadata.files[chain["file_idx"]],
+                      "segments": len(chain["statistics"]),
+                      "acceptance": float(estimate["chain_acceptances"][0, c]),
+                      "acceptance_error": float(errors["chain_acceptances"][c])}
+                     for c, chain in enumerate(chains)],
+          "parameters": parameters}
+
+def print_quick_look(metadata, summary, threshold=QUICK_RHAT_THRESHOLD):
+  # The key parameters, and whether the error bars are small enough to tell
+  # if every parameter is converged
+  print(f"Quick look at {summary['entries_read'] / max(1, summary['entries']):.1%} of the entries "
+        f"({summary['baskets_read']} of {summary['baskets']} baskets of {next(iter(summary['parameters']))}):")
+  if summary["baskets_read"] >= summary["baskets"]:
+    print(Back.RED + f"Warning: the chains have too few baskets for a quick look at {summary['fraction']:.1%} to read less "
+          "than all of them, this is as slow as reading the whole chains" + Back.RESET)
+  print(f"  - Step acceptance: {summary['acceptance']:.2f} ± {summary['acceptance_error']:.2f}% "
+        f"(perfect acceptance for {metadata.sampler_name}: {metadata.perfect_acceptance:.2f}%)")
+  for key in get_important_keys(metadata, list(summary["parameters"])):
+    values = summary["parameters"][key]
+    print(f"  - {key}: mean = {values['mean']:.6g} ± {values['mean_error']:.2g}, "
+          f"Rhat = {values['rhat']:.3f} ± {values['rhat_error']:.3f}, tau = {values['tau']:.1f} ± {values['tau_error']:.1f}")
+
+  converged, undecided, failed = [], [], []
+  for key, values in summary["parameters"].items():
+    if values["rhat"] + 2 * values["rhat_error"] < threshold:
+      converged.append(key)
+    elif values["rhat"] - 2 * values["rhat_error"] > threshold:
+      failed.append(key)
+    else:
+      undecided.append(key)
+  print(f"Rhat below {threshold} within two error bars: {Fore.GREEN}{len(converged)}{Fore.RESET}, "
+        f"above: {Fore.RED}{len(failed)}{Fore.RESET}, undecided: {len(undecided)}")
+  if failed:
+    print(Back.RED + f"Warning: not converged: {', '.join(failed)}" + Back.RESET)
+  if undecided:
+    print(Back.RED + f"The error bars are too large to decide for {', '.join(undecided)}, read a larger fraction" + Back.RESET)
+  truncated = [key for key, values in summary["parameters"].items() if values["truncated"]]
+  if truncated:
+    print(Back.RED + f"Warning: the autocorrelations of {len(truncated)} parameters are still positive at the longest "
+          f"lag the pieces have (at most {summary['max_lag']}), their tau is only a lower bound" + Back.RESET)
@@ -1,10 +1,12 @@
-from colorama import Fore, Back
+import csv
+import os
+
 import uproot
 from tqdm import tqdm
 import numpy as np
 
-from matplotlib.colors import ListedColormap
-import matplotlib.pyplot as plt
+from .convergence import get_convergence_summary, get_rhat_dicts, write_convergence_summary
+from .plot_pages import PageRenderer, new_figure, render_pdf
 
 def calculate_gelman_rubin(x):
   m, n = x.shape
@@ -47,101 +49,130 @@ def get_rhat_naive(files, burn_in, ignore_branches_list):
   
   return dict_rhat, dict_within_chain_rhat
 
-def get_rhat(metadata, burn_in):
-  if burn_in == 0:
-    print(Back.RED + "Warning: burn-in is 0, this may lead to incorrect rhat results" + Back.RESET)
-
-  # Open a sample file to get parameter names
-  with uproot.open(metadata.files[0]) as f:
-      example_chain = f[metadata.ttree_location]
-      keys = [key for key in example_chain.keys() if key not in metadata.ignored_branches]
-  
-  # Data structures to store the statistics
-  M = len(metadata.files) 
-  sum_means = {}
-  sum_vars = {}
-  chain_means = {}
-  for key in keys:
-      newkey = key
-      if newkey.startswith("_"):
-          newkey = newkey[1:]
-      sum_means[newkey] = 0.0
-      sum_vars[newkey] = 0.0
-      chain_means[newkey] = []
-
-  dict_rhat = {}
-  dict_within_chain_rhat = {}
-
-  for file in tqdm(metadata.files, desc="Calculating Rhats (Gellman-Rubin)"):
-      with uproot.open(file) as f:
-          chain = f[metadata.ttree_location]
-
-          for key in keys:
-              # Read only the required portion of the chain
-              data = chain[key].array(library="np")[burn_in:]
-
-              # Compute within-chain R̂ using split chains
-              half = len(data) // 2
-              chain1, chain2 = data[:half], data[half:]
-              within_rhat = calculate_gelman_rubin(np.stack([chain1, chain2]))
-
-              newkey = key
-              if newkey.startswith("_"):
-                newkey = newkey[1:]
-              # Store within-chain rhat
-              dict_within_chain_rhat.setdefault(newkey, []).append(within_rhat)
-
-              # Update statistics for between-chain rhat
-              chain_mean = np.mean(data)
-              chain_var = np.var(data, ddof=1)
-
-              sum_means[newkey] += chain_mean
-              sum_vars[newkey] += chain_var
-              chain_means[newkey].append(chain_mean)
-
-  # Compute final between-chain rhat
-  for key in keys:
-      newkey = key
-      if newkey.startswith("_"):
-        newkey = newkey[1:]
-      global_mean = sum_means[newkey] / M
-      W = sum_vars[newkey] / M
-      B = np.sum((np.array(chain_means[newkey]) - global_mean) ** 2) * (len(data) / (M - 1))
-      var = (len(data) - 1) / len(data) * W + B / len(data)
-      dict_rhat[newkey] = np.sqrt(var / W)
-
-  return dict_rhat, dict_within_chain_rhat
-
-def plot_rhat_matrix(dict_between_rhats, dict_within_rhats):
-  import seaborn as sns
-  import pandas as pd
-
-  df_between = pd.DataFrame(dict_between_rhats, index=["Total"])
-  df_within = pd.DataFrame(dict_within_rhats)
-
-  df = pd.concat([df_between, df_within])
-
-  df = df.T
-
-  cmap = ListedColormap(["white", "lightcoral", "darkred"])
-
-  bounds = [0, 1.01, 1.05, 1.1]
-
-  norm = plt.cm.colors.BoundaryNorm(bounds, cmap.N)
-
-  plt.figure(figsize=(12, 8))
-  ax = sns.heatmap(df, cmap=cmap, norm=norm, cbar=True, linewidths=0.5, linecolor="black")
-  ax.set_title("Rhats")
-  ax.set_xticks(np.arange(df.shape[1]) + 0.5)
-  ax.set_yticks(np.arange(df.shape[0]) + 0.5)
-
-  ax.set_xticklabels(df.columns, rotation=45, ha="right", fontsize=8)
-  ax.set_yticklabels(df.index, rotation=0, fontsize=8)
-
-  plt.tight_layout()
-  plt.savefig("rhats.pdf")
-  plt.close()
-
-def make_rhat_plots(metadata, burn_in):
-  dict_between_rhats, dict_within_rhats = get_rhat(metadata, burn_in)
-  plot_rhat_matrix(dict_between_rhats, dict_within_rhats)
\ No newline at end of file
+# Colour bands of the Rhat matrix
+RHAT_THRESHOLDS = [1.01, 1.05, 1.1]
+
+# Parameters per page of the Rhat matrix, and the most columns that get a
+# label each
+RHAT_PAGE_ROWS = 50
+RHAT_MAX_LABELS = 30
+
+def get_rhat_matrix(dict_between_rhats, dict_within_rhats):
+  """
+  Parameters x (Total, chain 0, chain 1, ...) array of Rhats, with NaN for
+  the chains a parameter has no value for.
+  """
+  keys = list(dict_between_rhats)
+  n_chains = max((len(dict_within_rhats[key]) for key in keys), default=0)
+  matrix = np.full((len(keys), n_chains + 1), np.nan)
+  for i, key in enumerate(keys):
+    matrix[i, 0] = dict_between_rhats[key]
+    matrix[i, 1:len(dict_within_rhats[key]) + 1] = dict_within_rhats[key]
+  columns = ["Total"] + [str(chain) for chain in range(n_chains)]
+  return keys, columns, matrix
+
+def get_flagged_matrix(keys, columns, matrix, threshold=RHAT_THRESHOLDS[0]):
+  # The parameters and chains with any Rhat above the threshold. The Total
+  # column is always kept.
+  above = np.nan_to_num(matrix, nan=0) > threshold
+  rows = np.flatnonzero(above.any(axis=1))
+  chains = [0] + [j for j in np.flatnonzero(above[rows].any(axis=0)) if j > 0]
+  return [keys[i] for i in rows], [columns[j] for j in chains], matrix[np.ix_(rows, chains)]
+
+def get_matrix_pages(keys, columns, matrix, title, rows_per_page=RHAT_PAGE_ROWS):
+  # Blocks of rows_per_page parameters, each a page
+  pages = {}
+  n_pages = -(-len(keys) // rows_per_page)
+  for start in range(0, len(keys), rows_per_page):
+    stop = min(start + rows_per_page, len(keys))
+    page = f"{title}, parameters {start + 1}-{stop} of {len(keys)}" if n_pages > 1 else title
+    pages[page] = (keys[start:stop], columns, matrix[start:stop])
+  return pages
+
+class RhatMatrixRenderer(PageRenderer):
+  """
+  Pages of the Rhat matrix drawn with imshow, which goes into the pdf as a
+  single image, so that the size and drawing time of a page don't grow with
+  the number of cells like a patch per cell does.
+  """
+
+  def setup(self):
+    from matplotlib.colors import BoundaryNorm, ListedColormap
+
+    cmap = ListedColormap(["white", "lightcoral", "darkred"])
+    cmap.set_over("black")
+    cmap.set_bad("lightgrey")
+    norm = BoundaryNorm([0] + RHAT_THRESHOLDS, cmap.N)
+
+    self.figure = new_figure((12, 8))
+    self.axes = self.figure.add_subplot()
+    self.image = self.axes.imshow(np.ones((1, 1)), cmap=cmap, norm=norm, aspect="auto",
+                                  interpolation="nearest")
+    self.figure.colorbar(self.image, ax=self.axes, extend="max", label="Rhat")
+    self.axes.set_xlabel("Chain")
+
+  def draw(self, page):
+    keys, columns, matrix = self.data[page]
+    self.image.set_data(np.ma.masked_invalid(matrix))
+    self.image.set_extent([-0.5, len(columns) - 0.5, len(keys) - 0.5, -0.5])
+
+    # Every column is labelled while they fit, and evenly spaced ones after
+    step = max(1, -(-len(columns) // RHAT_MAX_LABELS))
+    ticks = list(range(0, len(columns), step))
+    self.axes.set_xticks(ticks)
+    self.axes.set_xticklabels([columns[j] for j in ticks], rotation=45, ha="right", fontsize=8)
+    self.axes.set_yticks(np.arange(len(keys)))
+    self.axes.set_yticklabels(keys, fontsize=max(4, min(8, 400 // max(1, len(keys)))))
+    self.axes.set_title(page)
+
+def plot_rhat_matrix(dict_between_rhats, dict_within_rhats, output_file="rhats.pdf",
+                     flagged_only=False, rows_per_page=RHAT_PAGE_ROWS, jobs=1, threshold=RHAT_THRESHOLDS[0]):
+  """
+  The Rhat of all the chains together and of every chain on its own, for
+  every parameter. The parameters and chains with an Rhat above the threshold
+  come first, followed by the whole matrix (unless flagged_only), split into
+  pages of rows_per_page parameters.
+  """
+  keys, columns, matrix = get_rhat_matrix(dict_between_rhats, dict_within_rhats)
+  for band in RHAT_THRESHOLDS:
+    band_keys, band_columns, _ = get_flagged_matrix(keys, columns, matrix, band)
+    print(f"Rhat above {band}: {len(band_keys)} of {len(keys)} parameters, "
+          f"in {len(band_columns) - 1} of {len(columns) - 1} chains")
+
+  flagged_keys, flagged_columns, flagged_matrix = get_flagged_matrix(keys, columns, matrix, threshold)
+  pages = get_matrix_pages(flagged_keys, flagged_columns, flagged_matrix,
+                           f"Rhats above {threshold}", rows_per_page)
+  if not flagged_only:
+    pages.update(get_matrix_pages(keys, columns, matrix, "Rhats", rows_per_page))
+  if not pages:
+    # No stale matrix from an earlier run is left behind
+    if os.path.exists(output_file):
+      os.remove(output_file)
+    print(f"No Rhat above {threshold}, {output_file} not written")
+    return
+  render_pdf(output_file, [RhatMatrixRenderer(pages)], jobs, desc="Drawing the Rhat matrix")
+
+def write_rhat_matrix(dict_between_rhats, dict_within_rhats, files=None, output_file="rhat_matrix.csv"):
+  # The matrix with the largest Rhat of every parameter, worst first. The
+  # chains are named after their files when given.
+  keys, columns, matrix = get_rhat_matrix(dict_between_rhats, dict_within_rhats)
+  if files is not None:
+    columns = ["Total"] + [os.path.basename(file) for file in files[:len(columns) - 1]]
+  with np.errstate(invalid="ignore"):
+    worst = np.nanmax(np.where(np.isnan(matrix), -np.inf, matrix), axis=1)
+  with open(output_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["parameter", "max_rhat"] + columns)
+    for i in np.argsort(-worst, kind="stable"):
+      writer.writerow([keys[i], worst[i]] + list(matrix[i]))
+  print(f"Rhat matrix saved to {output_file}")
+
+def make_rhat_plots(metadata, burn_in, summary=None, summary_file="convergence_summary.csv",
+                    flagged_only=False, jobs=1, threshold=RHAT_THRESHOLDS[0]):
+  # Rank-normalised split-Rhats, with the ESS in the summary file
+  if summary is None:
+    summary = get_convergence_summary(metadata, burn_in)
+  write_convergence_summary(summary, summary_file)
+  dict_between_rhats, dict_within_rhats = get_rhat_dicts(summary)
+  write_rhat_matrix(dict_between_rhats, dict_within_rhats, metadata.files)
+  plot_rhat_matrix(dict_between_rhats, dict_within_rhats, flagged_only=flagged_only, jobs=jobs, threshold=threshold)
@@ -9,22 +9,41 @@ BRANCHES_KEYWORDS_ARIA = ["logprob", "th13", "th23", "delta(pi)", "dmsq32"]
 IGNORE_BRANCHES_MACH3 = ["accProb", "step", "stepTime", "LogL_sample_0", "LogL_sample_1", "LogL_systematic_osc_cov", "LogL_systematic_xsec_cov"]
 BRANCHES_KEYWORDS_MACH3 = ["LogL", "sin2th_13", "sin2th_23", "delta_cp", "delm2_23", "sin2th_12", "delm2_12"]
 
+# Location of the chain tree of every sampler, in the order they are looked for
+SAMPLER_TREES = {"stan": "samples/samples", "aria": "run/samples", "mach3": "posteriors"}
+
+def detect_sampler(f):
+    """
+    Name of the sampler that wrote the open ROOT file f.
+    """
+    for sampler_name, ttree_location in SAMPLER_TREES.items():
+        if ttree_location in f:
+            return sampler_name
+    raise ValueError("Unknown sampler type. Please check the files.")
+
 class SamplerMetadata:
     """
     Class to hold metadata for a sampler.
     """
 
-    def __init__(self, files: list[str]):
+    def __init__(self, files: list[str], manifest=None):
         """
         Initialize the SamplerMetadata object.
 
         Args:
-            name (str): The name of the sampler.
-            description (str): A description of the sampler.
+            files (list[str]): The chain files.
+            manifest (Manifest): Index of the files, to take the sampler,
+                branches and entries from without opening them.
         """
 
         self.files = [f for f in files if f.endswith(".root")]
-        self.__fill_metadata()
+        if not self.files:
+            raise ValueError("No .root chain files given")
+        self.manifest = manifest
+        if manifest is not None:
+            self.__set_sampler(manifest.sampler_name, manifest.branches)
+        else:
+            self.__fill_metadata()
 
     def __init(self, files: list[str], 
                sampler_name: str, 
@@ -67,26 +86,36 @@ class SamplerMetadata:
     def __fill_metadata(self):
 
         with uproot.open(self.files[0]) as f:
-            if "samples/samples" in f:
-                self.sampler_name = "stan"
-                self.ignored_branches = IGNORE_BRANCHES_STAN
-                self.key_branches = BRANCH_KEYWORDS_STAN
-                self.ttree_location = "samples/samples"
-                self.perfect_acceptance = 100.0
-            elif "run/samples" in f:
-                self.sampler_name = "aria"
-                self.ignored_branches = IGNORE_BRANCHES_ARIA
-                self.key_branches = BRANCHES_KEYWORDS_ARIA
-                self.ttree_location = "run/samples"
-                self.perfect_acceptance = 23.4
-            elif "posteriors":
-                self.sampler_name = "mach3"
-                self.ignored_branches = IGNORE_BRANCHES_MACH3
-                self.key_branches = BRANCHES_KEYWORDS_MACH3
-                self.ttree_location = "posteriors"
-                self.perfect_acceptance = 23.4
-            else:
-                raise ValueError("Unknown sampler type. Please check the files.")
+            sampler_name = detect_sampler(f)
+            self.__set_sampler(sampler_name, f[SAMPLER_TREES[sampler_name]].keys())
+
+    def __set_sampler(self, sampler_name: str, branches: list[str]):
+        self.sampler_name = sampler_name
+        self.ttree_location = SAMPLER_TREES[sampler_name]
+        if sampler_name == "stan":
+            self.ignored_branches = IGNORE_BRANCHES_STAN
+            self.key_branches = BRANCH_KEYWORDS_STAN
+            self.perfect_acceptance = 100.0
+            # Mean Metropolis acceptance of the NUTS trajectories, which
+            # Stan adapts the step size to (adapt_delta)
+            self.acceptance_branch = "accept_stat__"
+            self.perfect_acceptance_probability = 80.0
+        elif sampler_name == "aria":
+            self.ignored_branches = IGNORE_BRANCHES_ARIA
+            self.key_branches = BRANCHES_KEYWORDS_ARIA
+            self.perfect_acceptance = 23.4
+            self.acceptance_branch = None
+            self.perfect_acceptance_probability = None
+        else:
+            self.ignored_branches = IGNORE_BRANCHES_MACH3
+            self.key_branches = BRANCHES_KEYWORDS_MACH3
+            self.perfect_acceptance = 23.4
+            self.acceptance_branch = "accProb"
+            self.perfect_acceptance_probability = 23.4
+
+        # Older chains may not have the acceptance branch
+        if self.acceptance_branch is not None and self.acceptance_branch not in branches:
+            self.acceptance_branch = None
 
     def __repr__(self):
         return f"SamplerMetadata(name={self.name}, description={self.description})"
@@ -0,0 +1,179 @@
+import importlib
+import json
+
+import numpy as np
+
+from .burn_in import BurnInScanAccumulator
+from .chain_loader import get_num_entries
+from .sampler_metadata import SamplerMetadata
+
+# Bumped whenever the saved state of an accumulator changes. Parts saved with
+# another version can't be merged.
+STATE_VERSION = 3
+
+# Accumulators (and the objects inside them) that can be saved, and the
+# modules they come from
+STATE_CLASSES = {
+  "RangeAccumulator": "chain_loader",
+  "StepAcceptanceAccumulator": "step_acceptance",
+  "MomentsAccumulator": "moments",
+  "TraceAccumulator": "traces",
+  "ConvergenceAccumulator": "convergence",
+  "AutocorrelationAccumulator": "autocorrelations",
+  "SplitPosteriorAccumulator": "split_chains",
+  "BurnInScanAccumulator": "burn_in",
+  "QuantileAccumulator": "quantiles",
+  "CovarianceAccumulator": "covariance",
+  "MCSEAccumulator": "mcse",
+  "KLLSketch": "quantiles",
+  "Manifest": "manifest",
+}
+
+def parse_shard(text):
+  # "i/N", with 0 <= i < N
+  try:
+    index, count = (int(part) for part in text.split("/"))
+  except ValueError:
+    raise ValueError(f"Shards are given as i/N, got {text}")
+  if not 0 <= index < count:
+    raise ValueError(f"Shard {index} is not between 0 and {count - 1}")
+  return index, count
+
+def get_shard_files(n_files, shard):
+  """
+  Indices of the files of shard (index, count): a contiguous block of the
+  files, so that merging the shards in order keeps the files in order.
+  """
+  index, count = shard
+  return range(index * n_files // count, (index + 1) * n_files // count)
+
+def prepare_shard(metadata, accumulators):
+  # Anything an accumulator takes from the first file it sees has to come from
+  # the first file of all the shards
+  for accumulator in accumulators:
+    if isinstance(accumulator, BurnInScanAccumulator) and accumulator.candidates is None:
+      accumulator.set_candidates(get_num_entries(metadata.files[0], metadata))
+
+def encode(value, arrays):
+  # JSON-able structure, with the numpy arrays moved to `arrays`
+  if isinstance(value, SamplerMetadata):
+    return {"__metadata__": True}
+  if isinstance(value, (np.ndarray, np.generic)):
+    array = np.asarray(value)
+    if array.dtype.hasobject:
+      raise TypeError("Can't save arrays of python objects")
+    arrays.append(array)
+    return {"__array__": len(arrays) - 1, "scalar": isinstance(value, np.generic)}
+  if isinstance(value, dict):
+    return {"__dict__": [[encode(key, arrays), encode(item, arrays)] for key, item in value.items()]}
+  if isinstance(value, tuple):
+    return {"__tuple__": [encode(item, arrays) for item in value]}
+  if isinstance(value, list):
+    return [encode(item, arrays) for item in value]
+  if value is None or isinstance(value, (bool, int, float, str)):
+    return value
+  if type(value).__name__ in STATE_CLASSES:
+    return {"__object__": type(value).__name__, "attributes": encode(vars(value), arrays)}
+  raise TypeError(f"Can't save {type(value).__name__}")
+
+def decode(value, arrays, metadata=None):
+  if isinstance(value, list):
+    return [decode(item, arrays, metadata) for item in value]
+  if not isinstance(value, dict):
+    return value
+  if "__metadata__" in value:
+    return metadata
+  if "__array__" in value:
+    array = arrays[f"array_{value['__array__']}"]
+    return array[()] if value["scalar"] else array
+  if "__tuple__" in value:
+    return tuple(decode(item, arrays, metadata) for item in value["__tuple__"])
+  if "__object__" in value:
+    return new_object(value["__object__"], decode(value["attributes"], arrays, metadata))
+  return {decode(key, arrays, metadata): decode(item, arrays, metadata) for key, item in value["__dict__"]}
+
+def new_object(class_name, attributes):
+  # Restores the attributes without running __init__
+  cls = getattr(importlib.import_module(f".{STATE_CLASSES[class_name]}", __package__), class_name)
+  value = cls.__new__(cls)
+  vars(value).update(attributes)
+  return value
+
+def save_state(path, metadata, accumulators, shard=(0, 1), settings=None, kind="diagnostics"):
+  """
+  Saves the accumulators (a dictionary of name and accumulator), with the
+  metadata they were filled with, to an npz file: a JSON header describing
+  every attribute, and the numpy arrays next to it.
+  """
+  arrays = []
+  header = {"version": STATE_VERSION,
+            "kind": kind,
+            "shard": list(shard),
+            "settings": settings or {},
+            "metadata": encode(vars(metadata), arrays),
+            "accumulators": [[name, type(accumulator).__name__, encode(vars(accumulator), arrays)]
+                             for name, accumulator in accumulators.items()]}
+  for name, class_name, _ in header["accumulators"]:
+    if class_name not in STATE_CLASSES:
+      raise TypeError(f"Can't save the state of {class_name} ({name})")
+
+  with open(path, "wb") as f:
+    np.savez(f, header=np.array(json.dumps(header)), **{f"array_{i}": array for i, array in enumerate(arrays)})
+  where = f" of shard {shard[0]}/{shard[1]}" if shard[1] > 1 else ""
+  print(f"State{where} saved to {path}")
+
+def load_state(path):
+  with np.load(path, allow_pickle=False) as f:
+    header = json.loads(str(f["header"]))
+    if header.get("version") != STATE_VERSION:
+      raise ValueError(f"{path} was saved with state version {header.get('version')}, this version reads {STATE_VERSION}")
+    arrays = {name: f[name] for name in f.files if name != "header"}
+
+  metadata = SamplerMetadata.__new__(SamplerMetadata)
+  vars(metadata).update(decode(header["metadata"], arrays))
+
+  accumulators = {}
+  for name, class_name, attributes in header["accumulators"]:
+    if class_name not in STATE_CLASSES:
+      raise ValueError(f"Unknown accumulator {class_name} in {path}")
+    accumulators[name] = new_object(class_name, decode(attributes, arrays, metadata))
+
+  return {"kind": header["kind"],
+          "shard": tuple(header["shard"]),
+          "settings": header["settings"],
+          "metadata": metadata,
+          "accumulators": accumulators}
+
+def reduce_states(paths):
+  """
+  Merges the states saved by all the shards of a run, in shard order. The
+  shards need to come from the same files and settings, and each of them
+  has to be there exactly once.
+  """
+  states = sorted((load_state(path) for path in paths), key=lambda state: state["shard"][0])
+  first = states[0]
+  for path, state in zip(paths, states):
+    for key in ["kind", "settings"]:
+      if state[key] != first[key]:
+        raise ValueError(f"The parts have different {key}: {state[key]} and {first[key]}")
+    if state["metadata"].files != first["metadata"].files:
+      raise ValueError("The parts were made from different chains")
+    if list(state["accumulators"]) != list(first["accumulators"]):
+      raise ValueError("The parts have different diagnostics")
+
+  count = first["shard"][1]
+  shards = [state["shard"] for state in states]
+  if shards != [(i, count) for i in range(count)]:
+    raise ValueError(f"Need each of the {count} shards once, got {', '.join(f'{i}/{n}' for i, n in shards)}")
+
+  accumulators = first["accumulators"]
+  for state in states[1:]:
+    for name, accumulator in accumulators.items():
+      accumulator.merge(state["accumulators"][name])
+
+  print(f"Merged the state of {count} shards")
+  return {"kind": first["kind"],
+          "shard": (0, 1),
+          "settings": first["settings"],
+          "metadata": first["metadata"],
+          "accumulators": accumulators}
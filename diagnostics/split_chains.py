@@ -1,10 +1,11 @@
-import uproot
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
-from matplotlib.backends.backend_pdf import PdfPages
 from itertools import combinations
-from tqdm import tqdm
+
+from .binning import bin_indices
+from .chain_loader import ChainAccumulator, get_keys, get_important_keys, run_accumulators
+from .plot_pages import PageRenderer, new_figure, render_pdf
+
+SPLITS = ["full", "left", "right", "first", "second"]
 
 # Calculate the quantiles
 def get_quantile_thresholds(arr, quantile_levels):
@@ -19,111 +20,154 @@ def get_quantile_thresholds(arr, quantile_levels):
     return (arr[sorting_indices[np.searchsorted(cdf, qlevel)]] for qlevel in breakpoint_sums)
 
 
-def update_histograms(data, key, hist_dict, xedges_dict, split_type):
-    hist, _ = np.histogram(data, bins=xedges_dict[key])
-    hist_dict[key][split_type] += hist
- 
-def update_2d_histograms(data_x, data_y, pair, hist_dict, xedges_dict, split_type):
-    hist, _, _ = np.histogram2d(data_x, data_y, bins=(xedges_dict[pair[0]], xedges_dict[pair[1]]))
-    hist_dict[pair][split_type] += hist
-
-def make_split_posteriors(metadata, n_bins, burn_in, output_file="split_posterior.pdf"):
-    pdf = PdfPages(output_file)
-    example_chain = uproot.open(metadata.files[0])[metadata.ttree_location]
-    keys = [key for key in example_chain.keys() if key not in metadata.ignored_branches]
-    keys_important = [key for key in keys if any(samplerkey in key for samplerkey in metadata.key_branches)]
-    pairs_important = list(combinations(keys_important, 2))
-
-    quantile_thresholds = np.array([0.6827, 0.9545, 0.9973])
-    sigma_styles = {"1s": "solid", "2s": "dashdot", "3s": "dotted"}
-    chain_names = ["Full posterior", "Left side of chains", "Right side of chains", "First half of chains", "Second half of chains"]
-    chain_colors = {"full": "black", "left": "darkred", "right": "lightcoral", "first": "blue", "second": "cornflowerblue"}
-    
-    histograms = {key: {split: np.zeros(n_bins) for split in chain_colors.keys()} for key in keys}
-    histograms_2d = {pair: {split: np.zeros((n_bins, n_bins)) for split in chain_colors.keys()} for pair in pairs_important}
-    
-    xedges_dict = {}
-    nfiles = len(metadata.files)
-
-    for file_idx, file in enumerate(tqdm(metadata.files, desc="Processing MCMC files")):
-        chain = uproot.open(file)[metadata.ttree_location]
-        
-        for key in keys:
-            data = chain[key].array(library="np")[burn_in:]
-            half = len(data) // 2
+class SplitPosteriorAccumulator(ChainAccumulator):
+    # Ranges from all the chains, rather than from the first one
+    needs_ranges = True
+
+    def __init__(self, metadata, keys, n_bins, burn_in):
+        self.branches = keys
+        self.burn_in = burn_in
+        self.keys_important = get_important_keys(metadata, keys)
+        self.pairs_important = list(combinations(self.keys_important, 2))
+        self.nfiles = len(metadata.files)
+        self.n_bins = n_bins
+        self.xedges_dict = {}
+        self.reset()
+
+    def set_ranges(self, ranges):
+        for key in self.branches:
+            low, high = ranges.get_range(key, absolute="32" in key)
+            self.xedges_dict[key] = np.linspace(low, high, self.n_bins + 1)
+
+    def reset(self):
+        self.histograms = {key: {split: np.zeros(self.n_bins) for split in SPLITS} for key in self.branches}
+        self.histograms_2d = {pair: {split: np.zeros((self.n_bins, self.n_bins)) for split in SPLITS} for pair in self.pairs_important}
+
+    def add_counts(self, hist_dict, flat_indices, minlength, shape, half, file_idx):
+        # Left and right side of this chain in a single bincount, with the
+        # right side offset by minlength. Both also go into the full posterior
+        # and into the first or second half of the chains.
+        sides = np.where(np.arange(len(flat_indices)) < half, 0, minlength) + flat_indices
+        hists = np.bincount(sides[flat_indices >= 0], minlength=2 * minlength).reshape((2,) + shape)
+
+        split = "first" if file_idx / self.nfiles < 0.5 else "second"
+        for side, hist in zip(("left", "right"), hists):
+            hist_dict[side] += hist
+            hist_dict["full"] += hist
+            hist_dict[split] += hist
+
+    def fill(self, file_idx, columns):
+        n_bins = self.n_bins
+
+        # Digitize every branch once, the 2D histograms reuse the indices
+        indices = {}
+        for key in self.branches:
+            data = np.asarray(columns[key], dtype=np.float64)
             if "32" in key:
                 data = np.abs(data)
-            
-            if key not in xedges_dict:
-                xedges_dict[key] = np.linspace(np.min(data), np.max(data), n_bins + 1)
-
-            update_histograms(data[:half], key, histograms, xedges_dict, "left")
-            update_histograms(data[half:], key, histograms, xedges_dict, "right")
-            histsum = histograms[key]["left"] + histograms[key]["right"]
-            histograms[key]["full"] += histsum
-            
-            if file_idx / nfiles < 0.5:
-                histograms[key]["first"] += histsum
-            else:
-                histograms[key]["second"] += histsum
-
-        for pair in pairs_important:
-            data_x = chain[pair[0]].array(library="np")[burn_in:]
-            data_y = chain[pair[1]].array(library="np")[burn_in:]
-            half = len(data_x) // 2
-            
-            update_2d_histograms(data_x[:half], data_y[:half], pair, histograms_2d, xedges_dict, "left")
-            update_2d_histograms(data_x[half:], data_y[half:], pair, histograms_2d, xedges_dict, "right")
-            histsum = histograms_2d[pair]["left"] + histograms_2d[pair]["right"]
-            histograms_2d[pair]["full"] += histsum
-            
-            if file_idx / nfiles < 0.5:
-                histograms_2d[pair]["first"] += histsum
-            else:
-                histograms_2d[pair]["second"] += histsum
-
-    def plot_contours(pair):
-        plt.figure(figsize=(10, 8))
-        for chain, color in chain_colors.items():
-            contour_breakpoints = np.array(list(get_quantile_thresholds(histograms_2d[pair][chain.lower()], quantile_thresholds)))[::-1]
-            plt.contour(xedges_dict[pair[0]][:-1], xedges_dict[pair[1]][:-1],
-                        histograms_2d[pair][chain.lower()].T, levels=contour_breakpoints,
-                        colors=color, linestyles=[sigma_styles["3s"], sigma_styles["2s"], sigma_styles["1s"]], linewidths=1)
-
-        all_handles = [mlines.Line2D([], [], color=color, visible=False, label=f"{chain_name}:")
-                       for chain_name in chain_names]
-
-        legend_handles = [mlines.Line2D([], [], color=color, linestyle=sigma_styles[sigma], label=sigma.replace('s', r'$\sigma$')) 
-                         for sigma in ["1s", "2s", "3s"] for chain, color in chain_colors.items() ]
-        
-        legend_handles = all_handles + legend_handles
-
-        plt.title(f"Split posterior for {pair[0]} vs {pair[1]}")
-        plt.xlabel(pair[0])
-        plt.ylabel(pair[1])
-        plt.legend(handles=legend_handles, title="Credible intervals", loc="upper right", ncol=4)
-        plt.tight_layout()
-        pdf.savefig()
-        plt.close()
-
-    for pair in tqdm(pairs_important, desc="Generating 2D posterior plots"):
-        plot_contours(pair)
-
-    for key in tqdm(keys, desc="Generating split posteriors"):
-        plt.figure(figsize=(10, 8))
-
-        for (split, color), label in zip(chain_colors.items(), chain_names):
-            if np.sum(histograms[key][split]) > 0:
-                histograms[key][split] /= np.sum(histograms[key][split])
-                bincenters = 0.5 * (xedges_dict[key][1:] + xedges_dict[key][:-1])
-                plt.step(bincenters, histograms[key][split], where='mid', color=color, linestyle='--' if split != "full" else '-', label=label)
-
-        plt.title(f"Split posterior for {key}")
-        plt.xlabel(key)
-        plt.ylabel("Posterior probability density")
-        plt.legend()
-        plt.tight_layout()
-        pdf.savefig()
-        plt.close()
-
-    pdf.close()
+
+            edges = self.xedges_dict[key]
+            indices[key] = bin_indices(data[None, :], [edges[0]], [edges[-1]], n_bins)[0]
+            half = len(data) // 2
+            self.add_counts(self.histograms[key], indices[key], n_bins, (n_bins,), half, file_idx)
+
+        for pair in self.pairs_important:
+            index_x = indices[pair[0]]
+            index_y = indices[pair[1]]
+            flat = np.where((index_x >= 0) & (index_y >= 0), index_x * n_bins + index_y, -1)
+            half = len(flat) // 2
+            self.add_counts(self.histograms_2d[pair], flat, n_bins * n_bins, (n_bins, n_bins), half, file_idx)
+
+    def merge(self, other):
+        for key in self.branches:
+            for split in SPLITS:
+                self.histograms[key][split] += other.histograms[key][split]
+        for pair in self.pairs_important:
+            for split in SPLITS:
+                self.histograms_2d[pair][split] += other.histograms_2d[pair][split]
+
+QUANTILE_THRESHOLDS = np.array([0.6827, 0.9545, 0.9973])
+SIGMA_STYLES = {"1s": "solid", "2s": "dashdot", "3s": "dotted"}
+CHAIN_NAMES = ["Full posterior", "Left side of chains", "Right side of chains", "First half of chains", "Second half of chains"]
+CHAIN_COLORS = {"full": "black", "left": "darkred", "right": "lightcoral", "first": "blue", "second": "cornflowerblue"}
+
+class SplitContourRenderer(PageRenderer):
+    # Contours can't be updated in place, they are redrawn on the same axes
+    def __init__(self, histograms_2d, xedges_dict):
+        super().__init__(histograms_2d)
+        self.xedges_dict = xedges_dict
+
+    def setup(self):
+        import matplotlib.lines as mlines
+
+        self.figure = new_figure((10, 8))
+        self.axes = self.figure.add_subplot()
+        self.contours = []
+
+        all_handles = [mlines.Line2D([], [], visible=False, label=f"{chain_name}:")
+                       for chain_name in CHAIN_NAMES]
+
+        legend_handles = [mlines.Line2D([], [], color=color, linestyle=SIGMA_STYLES[sigma], label=sigma.replace('s', r'$\sigma$'))
+                          for sigma in ["1s", "2s", "3s"] for chain, color in CHAIN_COLORS.items()]
+
+        self.axes.legend(handles=all_handles + legend_handles, title="Credible intervals", loc="upper right", ncol=4)
+
+    def draw(self, pair):
+        for contour in self.contours:
+            contour.remove()
+        self.contours = []
+
+        histograms_2d = self.data[pair]
+        for chain, color in CHAIN_COLORS.items():
+            contour_breakpoints = np.array(list(get_quantile_thresholds(histograms_2d[chain], QUANTILE_THRESHOLDS)))[::-1]
+            self.contours.append(self.axes.contour(self.xedges_dict[pair[0]][:-1], self.xedges_dict[pair[1]][:-1],
+                                                   histograms_2d[chain].T, levels=contour_breakpoints,
+                                                   colors=color, linestyles=[SIGMA_STYLES["3s"], SIGMA_STYLES["2s"], SIGMA_STYLES["1s"]], linewidths=1))
+
+        self.axes.set_xlim(self.xedges_dict[pair[0]][0], self.xedges_dict[pair[0]][-2])
+        self.axes.set_ylim(self.xedges_dict[pair[1]][0], self.xedges_dict[pair[1]][-2])
+        self.axes.set_title(f"Split posterior for {pair[0]} vs {pair[1]}")
+        self.axes.set_xlabel(pair[0])
+        self.axes.set_ylabel(pair[1])
+
+class SplitPosteriorRenderer(PageRenderer):
+    def __init__(self, histograms, xedges_dict):
+        super().__init__(histograms)
+        self.xedges_dict = xedges_dict
+
+    def setup(self):
+        self.figure = new_figure((10, 8))
+        self.axes = self.figure.add_subplot()
+        self.lines = {split: self.axes.step([], [], where='mid', color=color, linestyle='--' if split != "full" else '-', label=label)[0]
+                      for (split, color), label in zip(CHAIN_COLORS.items(), CHAIN_NAMES)}
+        self.axes.set_ylabel("Posterior probability density")
+
+    def draw(self, key):
+        bincenters = 0.5 * (self.xedges_dict[key][1:] + self.xedges_dict[key][:-1])
+        for split, line in self.lines.items():
+            total = np.sum(self.data[key][split])
+            line.set_visible(total > 0)
+            if total > 0:
+                line.set_data(bincenters, self.data[key][split] / total)
+
+        self.axes.relim(visible_only=True)
+        self.axes.autoscale_view()
+        self.axes.set_title(f"Split posterior for {key}")
+        self.axes.set_xlabel(key)
+        self.axes.legend(handles=[line for line in self.lines.values() if line.get_visible()])
+
+def make_split_posteriors(metadata, n_bins, burn_in, output_file="split_posterior.pdf", accumulator=None, keys=None, jobs=1):
+    if accumulator is None:
+        accumulator = SplitPosteriorAccumulator(metadata, get_keys(metadata), n_bins, burn_in)
+        run_accumulators(metadata, [accumulator], desc="Processing MCMC files")
+
+    if keys is None:
+        keys = accumulator.branches
+    histograms = accumulator.histograms
+    histograms_2d = accumulator.histograms_2d
+    xedges_dict = accumulator.xedges_dict
+
+    # The 2D posteriors of the key parameters first, then a page per parameter
+    renderers = [SplitContourRenderer({pair: histograms_2d[pair] for pair in accumulator.pairs_important}, xedges_dict),
+                 SplitPosteriorRenderer({key: histograms[key] for key in keys}, xedges_dict)]
+    render_pdf(output_file, renderers, jobs, desc="Generating split posteriors")
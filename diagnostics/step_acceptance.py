@@ -1,43 +1,178 @@
-import uproot
-import numpy as np
+import csv
 
-from tqdm import tqdm
+import numpy as np
 
 from colorama import Fore, Back
 
+from .binning import MAX_BLOCK_ELEMENTS
+from .chain_loader import ChainAccumulator, get_keys, run_accumulators, DEFAULT_CHUNK_ENTRIES
+
+class StepAcceptanceAccumulator(ChainAccumulator):
+  """
+  Step acceptance of every chain. The chains can be filled in chunks: the last
+  sample of each chunk is carried over to difference the next one with, and
+  only counts are kept, so the memory does not grow with the chains. Besides
+  the acceptance of the whole chain, it keeps
+  1. The mean of the sampler's own acceptance branch (e.g. MaCh3's accProb),
+     when the chains have one.
+  2. The acceptance in consecutive windows of `window` steps. There are at
+     most max_windows of them, longer chains double the window size.
+  3. The longest run of steps in which each parameter did not move, to find
+     the parameters stuck for more than stuck_steps (None to only look at the
+     first parameter).
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, burn_in=0, window=1000, max_windows=1000, stuck_steps=1000):
+    if burn_in == 0:
+      print(Back.RED + "Warning: burn-in is 0, this may lead to incorrect step acceptances printed" + Back.RESET)
+
+    # The steps are the differences between consecutive samples of the first
+    # non-ignored branch
+    self.keys = keys if stuck_steps is not None else [keys[0]]
+    self.acceptance_branch = getattr(metadata, "acceptance_branch", None)
+    self.branches = self.keys + ([self.acceptance_branch] if self.acceptance_branch is not None else [])
+    self.burn_in = burn_in
+    self.window = window
+    self.max_windows = max_windows
+    self.stuck_steps = stuck_steps
+    self.reset()
+
+  def reset(self):
+    self.chains = {}
+
+  def new_chain(self):
+    return {"steps": 0,
+            "accepted": 0,
+            "probability": 0.0,
+            "last": None,
+            "runs": np.zeros(len(self.keys), dtype=np.int64),
+            "longest_runs": np.zeros(len(self.keys), dtype=np.int64),
+            "window": self.window,
+            "window_steps": np.zeros(self.max_windows, dtype=np.int64),
+            "window_accepted": np.zeros(self.max_windows, dtype=np.int64),
+            "window_probability": np.zeros(self.max_windows)}
+
+  def fill(self, file_idx, columns):
+    n_entries = len(columns[self.keys[0]])
+    if n_entries == 0:
+      return
+    chain = self.chains.setdefault(file_idx, self.new_chain())
+
+    # The first entry of a chain is not a step
+    first = 1 if chain["last"] is None else 0
+    n_steps = n_entries - first
+    last = []
+    block_size = max(1, MAX_BLOCK_ELEMENTS // n_entries)
+    for start in range(0, len(self.keys), block_size):
+      rows = slice(start, start + block_size)
+      data = np.stack([columns[key] for key in self.keys[rows]])
+      previous = data[:, :-1] if first else np.concatenate([chain["last"][rows, None], data[:, :-1]], axis=1)
+      moved = data[:, first:] != previous
+      last.append(data[:, -1])
+      if start == 0:
+        accepted = moved[0]
+
+      # Steps since the last move, carried over from the previous chunk
+      steps = np.arange(n_steps)
+      last_move = np.maximum.accumulate(np.where(moved, steps, -1 - chain["runs"][rows, None]), axis=1)
+      runs = steps - last_move
+      if n_steps > 0:
+        chain["longest_runs"][rows] = np.maximum(chain["longest_runs"][rows], np.max(runs, axis=1))
+        chain["runs"][rows] = runs[:, -1]
+    chain["last"] = np.concatenate(last)
+
+    if n_steps == 0:
+      return
+    probability = np.zeros(n_steps)
+    if self.acceptance_branch is not None:
+      probability = np.asarray(columns[self.acceptance_branch][first:], dtype=np.float64)
+    self.fill_windows(chain, accepted, probability)
+    chain["steps"] += n_steps
+    chain["accepted"] += int(np.sum(accepted))
+    chain["probability"] += float(np.sum(probability))
+
+  def fill_windows(self, chain, accepted, probability):
+    # Double the windows (adding up pairs of them) until the new steps fit
+    while (chain["steps"] + len(accepted) - 1) // chain["window"] >= self.max_windows:
+      half = self.max_windows // 2
+      for name in ["window_steps", "window_accepted", "window_probability"]:
+        windows = chain[name]
+        pairs = windows[0:2 * half:2] + windows[1:2 * half:2]
+        windows[:] = 0
+        windows[:half] = pairs
+      chain["window"] *= 2
+
+    indices = (chain["steps"] + np.arange(len(accepted))) // chain["window"]
+    chain["window_steps"] += np.bincount(indices, minlength=self.max_windows)
+    chain["window_accepted"] += np.bincount(indices, weights=accepted, minlength=self.max_windows).astype(np.int64)
+    chain["window_probability"] += np.bincount(indices, weights=probability, minlength=self.max_windows)
+
+  def merge(self, other):
+    self.chains.update(other.chains)
+
+  def result(self, n_files=None):
+    # Percentage of accepted steps for each chain, with the total across all
+    # files first. Files without steps after the burn-in get NaN.
+    if n_files is None:
+      n_files = max(self.chains, default=-1) + 1
+    chains = [self.chains.get(i) for i in range(n_files)]
+    acceptances = [chain["accepted"] / chain["steps"] * 100.0 if chain is not None and chain["steps"] else np.nan
+                   for chain in chains]
+    steps = sum(chain["steps"] for chain in self.chains.values())
+    total_acceptance = sum(chain["accepted"] for chain in self.chains.values()) / steps * 100.0 if steps else np.nan
+    acceptances.insert(0, total_acceptance)
+
+    return acceptances
+
+  def probabilities(self, n_files=None):
+    # Same as result, with the mean of the acceptance branch in percent. None
+    # if there is no acceptance branch.
+    if self.acceptance_branch is None:
+      return None
+    if n_files is None:
+      n_files = max(self.chains, default=-1) + 1
+    chains = [self.chains.get(i) for i in range(n_files)]
+    probabilities = [chain["probability"] / chain["steps"] * 100.0 if chain is not None and chain["steps"] else np.nan
+                     for chain in chains]
+    steps = sum(chain["steps"] for chain in self.chains.values())
+    probabilities.insert(0, sum(chain["probability"] for chain in self.chains.values()) / steps * 100.0 if steps else np.nan)
+    return probabilities
+
+  def windows(self):
+    # First step (counted from the start of the chain), number of steps,
+    # acceptance and mean acceptance probability of the windows of every chain
+    windows = {}
+    for file_idx, chain in sorted(self.chains.items()):
+      filled = chain["window_steps"] > 0
+      first_steps = self.burn_in + 1 + np.flatnonzero(filled) * chain["window"]
+      n_steps = chain["window_steps"][filled]
+      windows[file_idx] = (first_steps,
+                           n_steps,
+                           chain["window_accepted"][filled] / n_steps * 100.0,
+                           chain["window_probability"][filled] / n_steps * 100.0)
+    return windows
+
+  def stuck(self):
+    # Parameters that did not move for more than stuck_steps in a row, with the
+    # longest run of every chain
+    if self.stuck_steps is None:
+      return {}
+    stuck = {}
+    for file_idx, chain in sorted(self.chains.items()):
+      for key, longest_run in zip(self.keys, chain["longest_runs"]):
+        if longest_run > self.stuck_steps:
+          stuck.setdefault(key, {})[file_idx] = int(longest_run)
+    return stuck
+
 def get_step_acceptances(metadata, burn_in):
-  if burn_in == 0:
-    print(Back.RED + "Warning: burn-in is 0, this may lead to incorrect step acceptances printed" + Back.RESET)
-
-  acceptances = []
-  
-  # Go over each file and calculate the step acceptance
-  for file in tqdm(metadata.files, desc="Getting step acceptances"):
-    diffs = []
-    with uproot.open(file) as f:
-      example_chain = f[metadata.ttree_location]
-      keys = [key for key in example_chain.keys() if key not in metadata.ignored_branches]
-
-      # Get the differences between consecutive samples for the first non-ignored branch
-      data = np.asarray(example_chain[keys[0]].array()[burn_in:])
-      data_diff = np.diff(data)
-      diffs.append(data_diff)
-
-      # Calculate the percentage of accepted steps for the chain
-      acceptance = np.sum(data_diff != 0) / len(data_diff)
-      acceptance *= 100.0;
-      acceptances.append(acceptance)
-
-  # Calculate the total acceptance across all files
-  diffs = np.concatenate(diffs)
-  total_acceptance = np.sum(diffs != 0) / len(diffs)
-  total_acceptance *= 100.0
-  acceptances.insert(0, total_acceptance)
-
-  return acceptances
-
-def print_step_acceptance(metadata, burn_in=0):
-  acceptances = get_step_acceptances(metadata,  burn_in)
+  accumulator = StepAcceptanceAccumulator(metadata, get_keys(metadata), burn_in, stuck_steps=None)
+  run_accumulators(metadata, [accumulator], desc="Getting step acceptances", chunk_entries=DEFAULT_CHUNK_ENTRIES)
+  return accumulator.result()
+
+def print_step_acceptance(metadata, burn_in=0, acceptances=None):
+  if acceptances is None:
+    acceptances = get_step_acceptances(metadata,  burn_in)
 
   print(f"Step acceptances for chains from {metadata.sampler_name} sampler:")
 
@@ -59,4 +194,33 @@ def print_step_acceptance(metadata, burn_in=0):
     else:
       print(Back.RED + Fore.WHITE + "Step-sizes need to be increased." + Back.RESET + Fore.RESET)
   else:
-    print(Back.GREEN + f"Total step acceptance is close to the perfect acceptance of {metadata.sampler_name}!" + Back.RESET)
\ No newline at end of file
+    print(Back.GREEN + f"Total step acceptance is close to the perfect acceptance of {metadata.sampler_name}!" + Back.RESET)
+
+def print_acceptance_details(metadata, accumulator, max_distance=25.0):
+  # The sampler's acceptance probability, the windows far away from the
+  # perfect acceptance (e.g. a step size still adapting), and stuck parameters
+  probabilities = accumulator.probabilities(len(metadata.files))
+  if probabilities is not None:
+    target = metadata.perfect_acceptance_probability
+    foreground = Fore.RED if np.abs(probabilities[0] - target) / target * 100.0 > max_distance else Fore.GREEN
+    print(f"  - Mean {accumulator.acceptance_branch}: {foreground}{probabilities[0]:.2f}%{Fore.RESET} (target for {metadata.sampler_name}: {target:.2f}%)")
+
+  for file_idx, (first_steps, n_steps, acceptances, _) in accumulator.windows().items():
+    far = np.abs(acceptances - metadata.perfect_acceptance) / metadata.perfect_acceptance * 100.0 > max_distance
+    if np.any(far):
+      print(Back.RED + f"Warning: {np.sum(far)} of {len(far)} windows of {metadata.files[file_idx]} are far away from the perfect acceptance, "
+            f"the first one starting at step {first_steps[far][0]} ({acceptances[far][0]:.2f}%)" + Back.RESET)
+
+  for key, longest_runs in accumulator.stuck().items():
+    runs = ", ".join(f"{metadata.files[file_idx]}: {run} steps" for file_idx, run in longest_runs.items())
+    print(Back.RED + f"Warning: {key} did not move for more than {accumulator.stuck_steps} steps ({runs})" + Back.RESET)
+
+def write_acceptance_windows(metadata, accumulator, output_file="step_acceptance_windows.csv"):
+  with open(output_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["file", "first_step", "steps", "acceptance", "acceptance_probability"])
+    for file_idx, windows in accumulator.windows().items():
+      for first_step, n_steps, acceptance, probability in zip(*windows):
+        writer.writerow([metadata.files[file_idx], first_step, n_steps, acceptance,
+                         probability if accumulator.acceptance_branch is not None else ""])
+  print(f"Step acceptance windows saved to {output_file}")
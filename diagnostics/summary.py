@@ -0,0 +1,79 @@
+import csv
+import json
+import os
+
+from .mcse import get_enough_steps
+
+# Columns of the per-parameter summary, from the moments, the rank-normalised
+# convergence diagnostics, the autocorrelations and the Monte Carlo errors
+SUMMARY_COLUMNS = ["mean", "std", "min", "max", "skewness", "kurtosis",
+                   "median", "hpd_1s_low", "hpd_1s_high", "hpd_2s_low", "hpd_2s_high",
+                   "rhat", "rhat_bulk", "rhat_folded", "ess_bulk", "ess_tail",
+                   "tau", "ess", "truncated",
+                   "mcse", "mcse_obm_sqrt", "mcse_obm_cbrt", "mcse_sv", "ess_mcse", "mcse_ratio"]
+
+def make_summary(metadata, burn_in, acceptances, moments=None, convergence=None, effective=None,
+                 probabilities=None, stuck=None, quantiles=None, mcse=None):
+  """
+  All the numbers of the diagnostics in one dictionary: the step acceptances
+  and acceptance probabilities (as returned by StepAcceptanceAccumulator), the
+  parameters stuck in some chains, and per parameter the moments, the median
+  and highest-density intervals of all the chains (from QuantileAccumulator),
+  the Rhat and ESS, the autocorrelation time, and the Monte Carlo standard
+  error of the mean (from MCSEAccumulator), which decides whether the chains
+  have enough steps.
+  """
+  intervals = {}
+  for key, splits in (quantiles or {}).items():
+    full = splits["full"]
+    intervals[key] = {"median": full["median"]}
+    for sigma in ["1s", "2s"]:
+      intervals[key][f"hpd_{sigma}_low"], intervals[key][f"hpd_{sigma}_high"] = full["hpd"][sigma]
+
+  parameters = {}
+  for results in [moments, intervals, convergence, effective, mcse]:
+    for key, values in (results or {}).items():
+      parameters.setdefault(key, {}).update(values)
+
+  chains = [{"file": filename, "acceptance": acceptance}
+            for filename, acceptance in zip(metadata.files, acceptances[1:])]
+  summary = {"sampler_name": metadata.sampler_name,
+             "burn_in": burn_in,
+             "acceptance": acceptances[0],
+             "chains": chains,
+             "parameters": parameters}
+
+  if probabilities is not None:
+    summary["acceptance_probability"] = probabilities[0]
+    for chain, probability in zip(chains, probabilities[1:]):
+      chain["acceptance_probability"] = probability
+  if mcse:
+    summary["enough_steps"], summary["steps_factor"] = get_enough_steps(mcse)
+  if stuck is not None:
+    summary["stuck_parameters"] = {key: {metadata.files[file_idx]: run for file_idx, run in runs.items()}
+                                   for key, runs in stuck.items()}
+  return summary
+
+def write_summary(summary, output_file="summary.json"):
+  # json keeps everything. A csv gets a row per parameter, and the chain
+  # acceptances go to a second file next to it.
+  if not output_file.endswith(".csv"):
+    with open(output_file, "w") as f:
+      json.dump(summary, f, indent=2)
+    print(f"Summary saved to {output_file}")
+    return
+
+  with open(output_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["parameter"] + SUMMARY_COLUMNS)
+    for key, values in summary["parameters"].items():
+      writer.writerow([key] + [values.get(column, "") for column in SUMMARY_COLUMNS])
+
+  chains_file = os.path.splitext(output_file)[0] + "_chains.csv"
+  with open(chains_file, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["file", "acceptance"])
+    writer.writerow(["total", summary["acceptance"]])
+    for chain in summary["chains"]:
+      writer.writerow([chain["file"], chain["acceptance"]])
+  print(f"Summary saved to {output_file} and {chains_file}")
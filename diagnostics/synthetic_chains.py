@@ -0,0 +1,149 @@
+import json
+import os
+
+import uproot
+
+import numpy as np
+
+from tqdm import tqdm
+
+from .sampler_metadata import BRANCH_KEYWORDS_STAN, BRANCHES_KEYWORDS_ARIA, BRANCHES_KEYWORDS_MACH3
+
+# Written next to the chains, with the parameters of the generator and the
+# properties the diagnostics should find
+TRUTH_FILE = "synthetic_truth.json"
+
+# Tree location, key parameters and the name of the other parameters for the
+# layouts that SamplerMetadata detects
+SAMPLER_LAYOUTS = {
+  "stan": {"ttree_location": "samples/samples", "key_branches": BRANCH_KEYWORDS_STAN, "systematic": "syst_{}", "acceptance": 1.0},
+  "aria": {"ttree_location": "run/samples", "key_branches": BRANCHES_KEYWORDS_ARIA, "systematic": "syst_{}", "acceptance": 0.234},
+  "mach3": {"ttree_location": "posteriors", "key_branches": BRANCHES_KEYWORDS_MACH3, "systematic": "xsec_{}", "acceptance": 0.234},
+}
+
+def sampler_branches(sampler, steps, acceptance):
+  # The bookkeeping branches of each sampler, which the diagnostics ignore
+  n = len(steps)
+  if sampler == "stan":
+    return {"accept_stat__": np.full(n, acceptance),
+            "stepsize__": np.full(n, 0.1),
+            "treedepth__": np.full(n, 3, dtype=np.int32),
+            "n_leapfrog__": np.full(n, 7, dtype=np.int32),
+            "divergent__": np.zeros(n, dtype=np.int32),
+            "energy__": np.zeros(n),
+            "stepnum": steps.astype(np.int32)}
+  if sampler == "aria":
+    return {"MH": np.ones(n, dtype=np.int32),
+            "stepnum": steps.astype(np.int32)}
+  return {"accProb": np.full(n, acceptance),
+          "step": steps.astype(np.int32),
+          "stepTime": np.full(n, 0.01)}
+
+def get_parameter_names(sampler, n_parameters):
+  layout = SAMPLER_LAYOUTS[sampler]
+  names = list(layout["key_branches"][:n_parameters])
+  names += [layout["systematic"].format(i) for i in range(n_parameters - len(names))]
+  return names
+
+def ar1(noise, phi, start):
+  """
+  Solves y[t] = phi * y[t-1] + noise[t] along the last axis, with y[-1] =
+  start. Inside a block of length L, y[t] = phi^(t+1) * (start + cumsum of
+  noise[i] / phi^(i+1)), so only the blocks are looped over. L is short enough
+  for phi^-L to stay below 1e6, which keeps the precision.
+  """
+  if phi == 0:
+    return noise.copy()
+
+  n = noise.shape[-1]
+  block = int(max(1, min(n, np.log(1e6) / -np.log(abs(phi)))))
+  powers = phi ** np.arange(1, block + 1)
+
+  y = np.empty_like(noise)
+  carry = np.asarray(start, dtype=np.float64)
+  for begin in range(0, n, block):
+    end = min(n, begin + block)
+    p = powers[:end - begin]
+    y[..., begin:end] = p * (carry[..., None] + np.cumsum(noise[..., begin:end] / p, axis=-1))
+    carry = y[..., end - 1]
+  return y
+
+def lazy_ar1(rng, start, n_steps, phi, acceptance):
+  """
+  n_steps of a Metropolis-like AR(1) chain for all the parameters in start:
+  with probability `acceptance` all of them move to phi * x + sqrt(1 - phi^2) *
+  noise, otherwise the step is rejected and they stay. The stationary
+  distribution is a standard normal, and the autocorrelation at lag k is r^k
+  with r = 1 - acceptance * (1 - phi).
+  """
+  accepted = rng.random(n_steps) < acceptance
+  noise = rng.standard_normal((len(start), int(np.sum(accepted)))) * np.sqrt(1 - phi**2)
+  values = np.concatenate([start[:, None], ar1(noise, phi, start)], axis=1)
+  return values[:, np.cumsum(accepted)], accepted
+
+def expected_properties(n_chains, n_steps, phi, acceptance, chain_offset=0.0, max_lag=10):
+  """
+  The properties of the generated chains, in the limit of long chains: step
+  acceptance (in %), autocorrelation, integrated autocorrelation time and ESS
+  (same for every parameter) and the Gelman-Rubin Rhat, which is above 1 only
+  when the chains are offset from each other.
+  """
+  r = 1 - acceptance * (1 - phi)
+  tau = (1 + r) / (1 - r) if r < 1 else np.inf
+  offsets = chain_offset * (np.arange(n_chains) - (n_chains - 1) / 2)
+  between = np.var(offsets, ddof=1) if n_chains > 1 else 0.0
+  return {"acceptance": 100.0 * acceptance,
+          "autocorrelation": (r ** np.arange(max_lag)).tolist(),
+          "tau": tau,
+          "ess": n_chains * n_steps / tau,
+          "rhat": float(np.sqrt(1 + between)),
+          "chain_means": offsets.tolist()}
+
+def generate_chains(directory, sampler="mach3", n_chains=4, n_steps=100_000, n_parameters=10,
+                    phi=0.9, acceptance=None, chain_offset=0.0, seed=1, basket_size=100_000):
+  """
+  Writes n_chains ROOT files with the layout of the sampler, filled with the
+  chains of lazy_ar1, and the truth file. Chain c is shifted by chain_offset *
+  (c - (n_chains - 1) / 2). The chains are written one basket at a time, so
+  the memory does not grow with n_steps. Returns the list of files.
+  """
+  if sampler not in SAMPLER_LAYOUTS:
+    raise ValueError(f"Unknown sampler {sampler}, use one of {list(SAMPLER_LAYOUTS)}")
+  if not -1 < phi < 1:
+    raise ValueError(f"phi needs to be between -1 and 1 for a stationary chain, got {phi}")
+
+  layout = SAMPLER_LAYOUTS[sampler]
+  if acceptance is None:
+    acceptance = layout["acceptance"]
+  names = get_parameter_names(sampler, n_parameters)
+  truth = expected_properties(n_chains, n_steps, phi, acceptance, chain_offset)
+
+  os.makedirs(directory, exist_ok=True)
+  rng = np.random.default_rng(seed)
+
+  files = []
+  for chain in tqdm(range(n_chains), desc="Writing synthetic chains"):
+    filename = os.path.join(directory, f"chain_{chain}.root")
+    state = rng.standard_normal(len(names))
+    with uproot.recreate(filename) as f:
+      for begin in range(0, n_steps, basket_size):
+        steps = np.arange(begin, min(n_steps, begin + basket_size))
+        values, accepted = lazy_ar1(rng, state, len(steps), phi, acceptance)
+        state = values[:, -1]
+
+        arrays = {name: values[i] + truth["chain_means"][chain] for i, name in enumerate(names)}
+        arrays.update(sampler_branches(sampler, steps, acceptance))
+        if begin == 0:
+          f.mktree(layout["ttree_location"], {name: array.dtype for name, array in arrays.items()})
+        f[layout["ttree_location"]].extend(arrays)
+    files.append(filename)
+
+  with open(os.path.join(directory, TRUTH_FILE), "w") as f:
+    json.dump({"sampler": sampler, "n_chains": n_chains, "n_steps": n_steps, "n_parameters": n_parameters,
+               "phi": phi, "acceptance": acceptance, "chain_offset": chain_offset, "seed": seed,
+               "parameters": names, "expected": truth}, f, indent=2)
+  return files
+
+def load_truth(directory):
+  with open(os.path.join(directory, TRUTH_FILE)) as f:
+    return json.load(f)
@@ -1,58 +1,89 @@
-import uproot
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-from tqdm import tqdm
-
-from .sampler_metadata import SamplerMetadata
-
-def make_trace_plots(metadata, xbins=1000, ybins=100, output_file="trace_plots.pdf"):
-    pdf = PdfPages(f"trace_plots.pdf")
-
-    # Open one file to get parameter names
-    with uproot.open(metadata.files[0]) as f:
-        example_chain = f[metadata.ttree_location]
-        keys = [key for key in example_chain.keys() if key not in metadata.ignored_branches]
-        length = len(example_chain[keys[0]].array())
-
-    # Initialise histograms for each parameter
-    histograms = {key: np.zeros((xbins, ybins)) for key in keys}
-    xedges = np.linspace(0, length, xbins+1)#len(files) * 100_000, bins + 1)  # Approximate iteration range
-    yedges_dict = {}
-
-    # Process one file at a time, adding to the histograms
-    for file in tqdm(metadata.files, desc="Processing MCMC chains for trace heatmaps"):
-        with uproot.open(file) as f:
-            chain = f[metadata.ttree_location]
-
-            for key in keys:
-                data = chain[key].array(library="np")
-                # Take abs of dm32, the bimodality is difficult to look at
-                if "32" in key:
-                    data = np.abs(data)
-                iterations = np.arange(len(data))
-
-                # Set y-bins dynamically (first file defines the range)
-                if key not in yedges_dict:
-                    yedges_dict[key] = np.linspace(np.min(data), np.max(data), 101)
-
-                # Update histogram incrementally (no need to store full chains!)
-                hist, _, _ = np.histogram2d(iterations, data, bins=(xedges, yedges_dict[key]))
-                histograms[key] += hist  # Accumulate counts
-
-    # Generate plots
-    for key in tqdm(keys, desc="Generating trace heatmaps"):
-        plt.figure(figsize=(10, 4))
-
-        plt.imshow(histograms[key].T, aspect="auto", origin="lower",
-                   extent=[xedges[0], xedges[-1], yedges_dict[key][0], yedges_dict[key][-1]],
-                   cmap="inferno", interpolation="nearest")
-
-        plt.colorbar(label="Density (number of samples)")
-        plt.title(f"Heatmap trace plot for {key}")
-        plt.xlabel("Iteration")
-        plt.ylabel(key)
-        plt.tight_layout()
-        pdf.savefig()
-        plt.close()
-    pdf.close()
\ No newline at end of file
+
+from .binning import bin_traces, MAX_BLOCK_ELEMENTS
+from .chain_loader import ChainAccumulator, get_keys, run_accumulators
+from .plot_pages import PageRenderer, new_figure, render_pdf
+
+class TraceAccumulator(ChainAccumulator):
+    # The ranges come from all the chains, not just the first one, so that
+    # no samples fall outside of the heatmaps
+    needs_ranges = True
+
+    def __init__(self, metadata, keys, xbins=1000, ybins=100):
+        # Traces are always made from the start of the chain, burn-in included
+        self.branches = keys
+        self.burn_in = 0
+        self.xbins = xbins
+        self.ybins = ybins
+        self.length = None
+        self.xedges = None
+        self.yedges_dict = {}
+        self.reset()
+
+    def set_ranges(self, ranges):
+        # The iteration axis covers the longest chain
+        self.length = ranges.max_entries
+        self.xedges = np.linspace(0, self.length, self.xbins+1)
+        for key in self.branches:
+            # Take abs of dm32, the bimodality is difficult to look at
+            low, high = ranges.get_range(key, absolute="32" in key)
+            self.yedges_dict[key] = np.linspace(low, high, self.ybins+1)
+
+    def reset(self):
+        # Initialise histograms for all the parameters
+        self.counts = np.zeros((len(self.branches), self.xbins, self.ybins), dtype=np.int64)
+
+    @property
+    def histograms(self):
+        return {key: self.counts[i] for i, key in enumerate(self.branches)}
+
+    def fill(self, file_idx, columns):
+        n_steps = len(columns[self.branches[0]])
+        block_size = max(1, MAX_BLOCK_ELEMENTS // max(1, n_steps))
+
+        # Bin blocks of parameters at once (no need to store full chains!)
+        for start in range(0, len(self.branches), block_size):
+            block_keys = self.branches[start:start + block_size]
+            data = np.stack([np.abs(columns[key]) if "32" in key else columns[key] for key in block_keys]).astype(np.float64)
+            low = [self.yedges_dict[key][0] for key in block_keys]
+            high = [self.yedges_dict[key][-1] for key in block_keys]
+            self.counts[start:start + len(block_keys)] += bin_traces(data, low, high, self.xbins, self.ybins, self.length)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+class TraceRenderer(PageRenderer):
+    def __init__(self, histograms, xedges, yedges_dict):
+        super().__init__(histograms)
+        self.xedges = xedges
+        self.yedges_dict = yedges_dict
+
+    def setup(self):
+        self.figure = new_figure((10, 4))
+        self.axes = self.figure.add_subplot()
+        self.image = self.axes.imshow(np.zeros((1, 1)), aspect="auto", origin="lower",
+                                      cmap="inferno", interpolation="nearest")
+        self.figure.colorbar(self.image, ax=self.axes, label="Density (number of samples)")
+        self.axes.set_xlabel("Iteration")
+
+    def draw(self, key):
+        extent = [self.xedges[0], self.xedges[-1], self.yedges_dict[key][0], self.yedges_dict[key][-1]]
+        self.image.set_data(self.data[key].T)
+        self.image.set_extent(extent)
+        self.image.autoscale()
+        self.axes.set_xlim(extent[0], extent[1])
+        self.axes.set_ylim(extent[2], extent[3])
+        self.axes.set_title(f"Heatmap trace plot for {key}")
+        self.axes.set_ylabel(key)
+
+def make_trace_plots(metadata, xbins=1000, ybins=100, output_file="trace_plots.pdf", accumulator=None, keys=None, jobs=1):
+    if accumulator is None:
+        accumulator = TraceAccumulator(metadata, get_keys(metadata), xbins, ybins)
+        run_accumulators(metadata, [accumulator], desc="Processing MCMC chains for trace heatmaps")
+
+    if keys is None:
+        keys = accumulator.branches
+    histograms = accumulator.histograms
+
+    renderer = TraceRenderer({key: histograms[key] for key in keys}, accumulator.xedges, accumulator.yedges_dict)
+    render_pdf(output_file, [renderer], jobs, desc="Generating trace heatmaps")
@@ -0,0 +1,420 @@
+import os
+import pickle
+
+import uproot
+
+import numpy as np
+
+from colorama import Fore, Back
+
+from .autocorrelations import lagged_covariances, lagged_products
+from .binning import bin_traces, MAX_BLOCK_ELEMENTS
+from .chain_loader import ChainAccumulator, fill_accumulators, get_keys, get_needed_branches, get_num_entries, read_root_chain
+from .effective_samples import get_effective_sample_sizes
+from .moments import combine_moments, get_moments, moments_summary
+from .profiling import profile_stage
+from .sampler_metadata import SamplerMetadata
+from .step_acceptance import StepAcceptanceAccumulator
+from .summary import make_summary
+from .traces import TraceAccumulator
+
+WATCH_STATE_FILE = "mcmc_watch_state.pkl"
+
+# Bumped whenever the pickled state changes, older states are started over
+WATCH_STATE_VERSION = 3
+
+# Streaming versions of the diagnostics, fed with the new entries of every
+# file. `merge` adds the chains of other files.
+
+class ChainMomentsAccumulator(ChainAccumulator):
+  """
+  Count, mean and central moments of every chain (combined with
+  combine_moments, the Welford update generalised to chunks), which give the
+  moments of all the chains together and the classic Rhat.
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, burn_in=0):
+    self.branches = keys
+    self.burn_in = burn_in
+    self.reset()
+
+  def reset(self):
+    self.chains = {}
+
+  def fill(self, file_idx, columns):
+    if len(columns[self.branches[0]]) == 0:
+      return
+
+    moments, minimum, maximum = get_moments(columns, self.branches)
+    if file_idx in self.chains:
+      old_moments, old_minimum, old_maximum = self.chains[file_idx]
+      moments = combine_moments(old_moments, moments)
+      minimum = np.minimum(old_minimum, minimum)
+      maximum = np.maximum(old_maximum, maximum)
+    self.chains[file_idx] = (moments, minimum, maximum)
+
+  def merge(self, other):
+    self.chains.update(other.chains)
+
+  def result(self):
+    if not self.chains:
+      return {}
+    moments, minima, maxima = zip(*self.chains.values())
+    total = moments[0]
+    for chain_moments in moments[1:]:
+      total = combine_moments(total, chain_moments)
+    return moments_summary(self.branches, total, np.min(minima, axis=0), np.max(maxima, axis=0))
+
+  def rhats(self):
+    # Gelman-Rubin Rhat of the chains with at least two draws, with the mean
+    # chain length standing in for n as the chains grow at different rates
+    chains = [moments for moments, _, _ in self.chains.values() if moments[0] > 1]
+    if len(chains) < 2:
+      return {}
+
+    n = np.mean([moments[0] for moments in chains])
+    means = np.stack([moments[1] for moments in chains])
+    variances = np.stack([moments[2] / (moments[0] - 1) for moments in chains])
+    W = np.mean(variances, axis=0)
+    var = (n - 1) / n * W + np.var(means, axis=0, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      rhat = np.sqrt(var / W)
+    return {key: {"rhat": float(rhat[i])} for i, key in enumerate(self.branches)}
+
+class StreamingTraceAccumulator(TraceAccumulator):
+  """
+  Trace heatmaps of chains that keep growing. The ranges can't be known in
+  advance, so both axes start from the first chunk and double when samples
+  fall outside of them, merging pairs of bins. xbins and ybins need to be
+  even for that.
+  """
+  needs_ranges = False
+  streaming = True
+
+  def __init__(self, metadata, keys, xbins=1000, ybins=100):
+    if xbins % 2 or ybins % 2:
+      raise ValueError(f"The number of bins needs to be even to grow the heatmaps, got {xbins} x {ybins}")
+    super().__init__(metadata, keys, xbins, ybins)
+
+  def reset(self):
+    super().reset()
+    self.entries = {}
+    self.length = self.xbins
+    self.xedges = np.linspace(0, self.length, self.xbins+1)
+    self.yedges_dict = {}
+
+  def grow_length(self):
+    half = self.xbins // 2
+    self.counts[:, :half] = self.counts[:, 0::2] + self.counts[:, 1::2]
+    self.counts[:, half:] = 0
+    self.length *= 2
+    self.xedges = np.linspace(0, self.length, self.xbins+1)
+
+  def grow_range(self, i, key, low, high):
+    # Double the value range of one parameter until [low, high] fits
+    half = self.ybins // 2
+    edges = self.yedges_dict[key]
+    while low < edges[0] or high > edges[-1]:
+      pairs = self.counts[i, :, 0::2] + self.counts[i, :, 1::2]
+      self.counts[i] = 0
+      span = edges[-1] - edges[0]
+      if high > edges[-1]:
+        self.counts[i, :, :half] = pairs
+        edges = np.linspace(edges[0], edges[-1] + span, self.ybins+1)
+      else:
+        self.counts[i, :, half:] = pairs
+        edges = np.linspace(edges[0] - span, edges[-1], self.ybins+1)
+    self.yedges_dict[key] = edges
+
+  def fill(self, file_idx, columns):
+    n_steps = len(columns[self.branches[0]])
+    if n_steps == 0:
+      return
+
+    start = self.entries.get(file_idx, 0)
+    while start + n_steps > self.length:
+      self.grow_length()
+
+    block_size = max(1, MAX_BLOCK_ELEMENTS // n_steps)
+    for block_start in range(0, len(self.branches), block_size):
+      block_keys = self.branches[block_start:block_start + block_size]
+      data = np.stack([np.abs(columns[key]) if "32" in key else columns[key] for key in block_keys]).astype(np.float64)
+      for i, key in enumerate(block_keys):
+        finite = data[i][np.isfinite(data[i])]
+        if len(finite) == 0:
+          continue
+        low, high = np.min(finite), np.max(finite)
+        if key not in self.yedges_dict:
+          self.yedges_dict[key] = np.linspace(low, high if high > low else low + 1.0, self.ybins+1)
+        self.grow_range(block_start + i, key, low, high)
+
+      low = [self.yedges_dict.get(key, [0.0])[0] for key in block_keys]
+      high = [self.yedges_dict.get(key, [1.0])[-1] for key in block_keys]
+      self.counts[block_start:block_start + len(block_keys)] += bin_traces(data, low, high, self.xbins, self.ybins, self.length, start)
+
+    self.entries[file_idx] = start + n_steps
+
+  def merge(self, other):
+    if any(not np.array_equal(self.yedges_dict[key], other.yedges_dict[key])
+           for key in self.branches if key in self.yedges_dict and key in other.yedges_dict):
+      raise ValueError("Can't merge streaming trace heatmaps with different value ranges")
+    while self.length < other.length:
+      self.grow_length()
+    counts = other.counts.copy()
+    length = other.length
+    while length < self.length:
+      counts[:, :self.xbins // 2] = counts[:, 0::2] + counts[:, 1::2]
+      counts[:, self.xbins // 2:] = 0
+      length *= 2
+    self.counts += counts
+    self.entries.update(other.entries)
+    for key, edges in other.yedges_dict.items():
+      self.yedges_dict.setdefault(key, edges)
+
+class StreamingAutocorrelationAccumulator(ChainAccumulator):
+  """
+  Autocorrelations of chains that keep growing, from running sums kept per
+  chain: the sum of the samples, the lagged products up to max_lag, and the
+  first and last max_lag samples. A new chunk only adds the products that
+  involve its samples (with the previous tail in front of it), so the work is
+  proportional to the new entries.
+
+  The samples are shifted by the mean of the first chunk of each chain, which
+  keeps the sums from losing precision when subtracting the mean at the end.
+  Chains shorter than max_lag are left out until they are long enough.
+  """
+  streaming = True
+
+  def __init__(self, metadata, keys, max_lag=100, burn_in=0, block_size=32):
+    self.branches = keys
+    self.burn_in = burn_in
+    self.max_lag = max_lag
+    self.block_size = block_size
+    self.reset()
+
+  def reset(self):
+    self.chains = {}
+
+  @property
+  def long_chains(self):
+    return [chain for chain in self.chains.values() if chain["n"] >= max(self.max_lag, 2)]
+
+  @property
+  def n_chains(self):
+    return len(self.long_chains)
+
+  @property
+  def n_draws(self):
+    return sum(chain["n"] for chain in self.long_chains)
+
+  def fill(self, file_idx, columns):
+    n_steps = len(columns[self.branches[0]])
+    if n_steps == 0:
+      return
+
+    n_parameters = len(self.branches)
+    chain = self.chains.get(file_idx)
+    if chain is None:
+      chain = {"reference": np.array([np.mean(columns[key], dtype=np.float64) for key in self.branches]),
+               "n": 0,
+               "sums": np.zeros(n_parameters),
+               "products": np.zeros((n_parameters, self.max_lag)),
+               "head": np.zeros((n_parameters, 0)),
+               "tail": np.zeros((n_parameters, 0))}
+      self.chains[file_idx] = chain
+
+    heads, tails = [], []
+    for start in range(0, n_parameters, self.block_size):
+      rows = slice(start, start + self.block_size)
+      block = np.stack([np.asarray(columns[key], dtype=np.float64) for key in self.branches[rows]])
+      block -= chain["reference"][rows, None]
+      tail = chain["tail"][rows]
+
+      # Products with both samples in the old tail were added by the earlier
+      # chunks already
+      extended = np.concatenate([tail, block], axis=1)
+      with profile_stage("lagged products"):
+        chain["products"][rows] += lagged_products(extended, self.max_lag) - lagged_products(tail, self.max_lag)
+
+      chain["sums"][rows] += np.sum(block, axis=1)
+      heads.append(np.concatenate([chain["head"][rows], block[:, :self.max_lag]], axis=1)[:, :self.max_lag])
+      tails.append(extended[:, -self.max_lag:])
+
+    chain["head"] = np.concatenate(heads)
+    chain["tail"] = np.concatenate(tails)
+    chain["n"] += n_steps
+
+  def merge(self, other):
+    if set(self.chains) & set(other.chains):
+      raise ValueError("Can't merge streaming autocorrelations of the same chain")
+    self.chains.update(other.chains)
+
+  def result(self):
+    # Average over the chains that are long enough, with the same (biased)
+    # normalisation as autocorr_rfft_batched
+    chains = self.long_chains
+    if not chains:
+      return {}
+
+    total = np.zeros((len(self.branches), self.max_lag))
+    for chain in chains:
+      covariance = lagged_covariances(chain["n"], chain["sums"], chain["products"], chain["head"], chain["tail"])
+      with np.errstate(divide="ignore", invalid="ignore"):
+        total += covariance / covariance[:, :1]
+    return {key: total[i] / len(chains) for i, key in enumerate(self.branches)}
+
+class ChainWatcher:
+  """
+  Incremental diagnostics of chains that are still being written. Remembers
+  how many entries of every file were processed, and on each update only
+  reads the new ones into the streaming accumulators. The whole watcher is
+  pickled between runs with save_watcher.
+
+  The watch can start before the sampler wrote its first file: the metadata
+  and the accumulators are only made once a chain can be opened.
+  """
+
+  def __init__(self, files, burn_in=0, max_lag=-1, block_size=32, traces=False, xbins=1000, ybins=100):
+    self.version = WATCH_STATE_VERSION
+    self.settings = {"burn_in": burn_in, "max_lag": max_lag, "block_size": block_size,
+                     "traces": traces, "xbins": xbins, "ybins": ybins}
+    self.metadata = None
+    self.keys = []
+    self.files = []
+    self.entries = {}
+    self.accumulators = {}
+
+  @property
+  def started(self):
+    return self.metadata is not None
+
+  def start(self, files):
+    # The sampler and branches come from the first file
+    self.metadata = SamplerMetadata(files)
+    if self.settings["max_lag"] == -1:
+      self.settings["max_lag"] = self.metadata.get_default_maxlag()
+    self.keys = get_keys(self.metadata)
+    self.metadata.print_metadata()
+
+    burn_in, max_lag = self.settings["burn_in"], self.settings["max_lag"]
+    self.accumulators = {
+      "step_acceptance": StepAcceptanceAccumulator(self.metadata, self.keys, burn_in),
+      "moments": ChainMomentsAccumulator(self.metadata, self.keys, burn_in),
+      "autocorrelations": StreamingAutocorrelationAccumulator(self.metadata, self.keys, max_lag, burn_in,
+                                                              self.settings["block_size"]),
+    }
+    if self.settings["traces"]:
+      self.accumulators["traces"] = StreamingTraceAccumulator(self.metadata, self.keys,
+                                                              self.settings["xbins"], self.settings["ybins"])
+
+  def reset(self):
+    self.files = []
+    self.entries = {}
+    for accumulator in self.accumulators.values():
+      accumulator.reset()
+
+  def update(self, files):
+    """
+    Reads the entries added to the files since the last update, and returns
+    how many there were. Files that can't be read yet (e.g. while ROOT is
+    writing them) are retried on the next update.
+    """
+    files = [f for f in files if f.endswith(".root")]
+    if not self.started:
+      if not files:
+        return 0
+      try:
+        self.start(files)
+      except (OSError, ValueError, KeyError, uproot.deserialization.DeserializationError) as error:
+        print(Back.RED + f"Warning: could not read {files[0]} ({str(error).splitlines()[0]}), trying again on the next update" + Back.RESET)
+        self.metadata = None
+        return 0
+
+    for filename in files:
+      if filename not in self.files:
+        self.files.append(filename)
+    self.metadata.files = list(self.files)
+
+    accumulators = list(self.accumulators.values())
+    branches = get_needed_branches(accumulators)
+    n_new = 0
+    for file_idx, filename in enumerate(self.files):
+      processed = self.entries.get(filename, 0)
+      try:
+        n_entries = get_num_entries(filename, self.metadata)
+        if n_entries < processed:
+          print(Back.RED + f"Warning: {filename} got shorter, starting the diagnostics over" + Back.RESET)
+          self.reset()
+          return self.update(files)
+        if n_entries == processed:
+          continue
+        columns = read_root_chain(filename, self.metadata, branches, processed, n_entries)
+      except (OSError, ValueError, KeyError, uproot.deserialization.DeserializationError) as error:
+        print(Back.RED + f"Warning: could not read {filename} ({error}), trying again on the next update" + Back.RESET)
+        continue
+
+      fill_accumulators(file_idx, columns, accumulators, processed)
+      self.entries[filename] = n_entries
+      n_new += n_entries - processed
+    return n_new
+
+  def summary(self):
+    # The summary of make_summary, with the classic Rhat of the chain moments
+    # and the number of entries read from every file
+    acceptance = self.accumulators["step_acceptance"]
+    autocorrelations = self.accumulators["autocorrelations"]
+    moments = self.accumulators["moments"]
+    effective = None
+    if autocorrelations.n_chains > 0:
+      effective = get_effective_sample_sizes(autocorrelations.result(), autocorrelations.n_draws)
+
+    summary = make_summary(self.metadata,
+                           self.settings["burn_in"],
+                           acceptance.result(len(self.files)),
+                           moments.result(),
+                           moments.rhats(),
+                           effective,
+                           acceptance.probabilities(len(self.files)),
+                           acceptance.stuck())
+    for chain in summary["chains"]:
+      chain["entries"] = self.entries.get(chain["file"], 0)
+    return summary
+
+def load_watcher(path, files, **settings):
+  # The saved watcher if it was made with the same settings, a new one
+  # otherwise
+  if os.path.exists(path):
+    with open(path, "rb") as f:
+      watcher = pickle.load(f)
+    if getattr(watcher, "version", None) == WATCH_STATE_VERSION and \
+       all(watcher.settings.get(key) == value for key, value in settings.items() if key != "max_lag" or value != -1):
+      print(f"Continuing from {path}: {sum(watcher.entries.values())} entries of {len(watcher.files)} files already processed")
+      return watcher
+    print(Back.RED + f"Warning: {path} was made with different settings, starting over" + Back.RESET)
+  return ChainWatcher(files, **settings)
+
+def save_watcher(watcher, path=WATCH_STATE_FILE):
+  # Written next to the old state and renamed, so that an interrupted save
+  # doesn't lose it
+  with open(path + ".tmp", "wb") as f:
+    pickle.dump(watcher, f)
+  os.replace(path + ".tmp", path)
+
+def print_watch_status(summary, n_new, rhat_threshold=1.01, min_ess=400):
+  parameters = summary["parameters"]
+  n_entries = sum(chain["entries"] for chain in summary["chains"])
+  print(f"Read {n_new} new entries, {n_entries} in {len(summary['chains'])} files. "
+        f"Step acceptance: {summary['acceptance']:.2f}%")
+
+  rhats = [values["rhat"] for values in parameters.values() if "rhat" in values]
+  if rhats:
+    foreground = Fore.RED if max(rhats) > rhat_threshold else Fore.GREEN
+    print(f"  - Largest Rhat: {foreground}{max(rhats):.4f}{Fore.RESET}")
+
+  ess = [values["ess"] for values in parameters.values() if "ess" in values]
+  if ess:
+    foreground = Fore.RED if min(ess) < min_ess else Fore.GREEN
+    print(f"  - Smallest ESS: {foreground}{min(ess):.0f}{Fore.RESET}")
+  else:
+    print("  - No chain is longer than the burn-in and max lag yet, no autocorrelations")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The diagnostics package is used from the repository, like the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
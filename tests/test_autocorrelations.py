@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from diagnostics.autocorrelations import autocorr_batched, autocorr_naive, lagged_products
+from diagnostics.synthetic_chains import lazy_ar1
+
+MAX_LAG = 50
+
+@pytest.fixture
+def columns():
+  # A synthetic chain with rejected steps, offset from zero like real
+  # parameters
+  rng = np.random.default_rng(0)
+  values, _ = lazy_ar1(rng, rng.standard_normal(3), 5000, 0.9, 0.3)
+  return {f"param_{i}": 100.0 + row for i, row in enumerate(values)}
+
+@pytest.mark.parametrize("method", ["direct", "fft", "auto"])
+def test_autocorr_batched_matches_naive(columns, method):
+  keys = list(columns)
+  result = autocorr_batched(columns, keys, MAX_LAG, block_size=2, method=method)
+  for key in keys:
+    np.testing.assert_allclose(result[key], autocorr_naive(columns[key], range(MAX_LAG)), atol=1e-12)
+
+@pytest.mark.parametrize("n_steps", [MAX_LAG // 2, 5000])
+def test_lagged_products_match_naive(columns, n_steps):
+  x = np.stack([values[:n_steps] - np.mean(values[:n_steps]) for values in columns.values()])
+  products = lagged_products(x, MAX_LAG)
+  lags = min(MAX_LAG, n_steps)
+  for row, values in zip(products, x):
+    expected = autocorr_naive(values, range(lags)) * np.sum(values**2)
+    np.testing.assert_allclose(row[:lags], expected, atol=1e-8)
+    assert np.all(row[lags:] == 0)